@@ -0,0 +1,128 @@
+import asyncio, logging, signal
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+
+# Chat an update belongs to, so that updates of one chat are handled in order
+def update_chat_id(update):
+    for field in ('message', 'edited_message', 'callback_query'):
+        value = getattr(update, field, None)
+        if value is not None:
+            message = getattr(value, 'message', value)
+            chat = getattr(message, 'chat', None)
+            if chat is not None:
+                return chat.id
+    return ('update', update.update_id)
+
+
+# asyncio runtime for the bot.
+# Updates are long polled on the event loop, or taken from another source such
+# as the webhook front end's queue, and handled by a bounded pool of
+# worker threads. Updates of the same chat run strictly one after another, so
+# register_next_step_handler flows see messages in order, while different
+# chats run concurrently. Polling pauses when max_pending updates are waiting.
+class AsyncRuntime:
+    def __init__(self, bot, workers=16, max_pending=256, poll_timeout=20, shutdown_timeout=30):
+        self.bot = bot
+        self.workers = workers
+        self.poll_timeout = poll_timeout
+        self.shutdown_timeout = shutdown_timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='handler')
+        self.poll_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='poll')
+        self.max_pending = max_pending
+        self.pending = None
+        self.chains = {}
+        self.tasks = set()
+        self.stopping = None
+        self.loop = None
+
+        # Handlers run inline in the runtime's worker threads instead of telebot's own pool
+        self.bot.threaded = False
+
+    def _handle(self, update):
+        try:
+            self.bot.process_new_updates([update])
+        except Exception as e:
+            log.exception("Error: %s", e)
+
+    async def _run_in_order(self, previous, update):
+        try:
+            if previous is not None:
+                await asyncio.wait({previous})
+            await asyncio.get_running_loop().run_in_executor(self.executor, self._handle, update)
+        finally:
+            self.pending.release()
+
+    async def submit(self, update):
+        await self.pending.acquire()
+        chat_id = update_chat_id(update)
+        task = asyncio.create_task(self._run_in_order(self.chains.get(chat_id), update))
+        self.chains[chat_id] = task
+        self.tasks.add(task)
+
+        def done(finished):
+            self.tasks.discard(finished)
+            if self.chains.get(chat_id) is finished:
+                del self.chains[chat_id]
+
+        task.add_done_callback(done)
+
+    async def poll(self):
+        loop = asyncio.get_running_loop()
+        offset = None
+        while not self.stopping.is_set():
+            try:
+                updates = await loop.run_in_executor(self.poll_executor, lambda: self.bot.get_updates(
+                    offset=offset, timeout=self.poll_timeout, long_polling_timeout=self.poll_timeout))
+            except Exception as e:
+                log.error("Polling failed: %s", e)
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                await self.submit(update)
+
+    # Take updates from a blocking receive function instead of polling. receive returns the next
+    # update or None when none arrived within its timeout, and raises EOFError when the source is closed.
+    async def consume(self, receive):
+        loop = asyncio.get_running_loop()
+        while not self.stopping.is_set():
+            try:
+                update = await loop.run_in_executor(self.poll_executor, receive)
+            except EOFError:
+                self.stopping.set()
+                break
+            if update is not None:
+                await self.submit(update)
+
+    async def run(self, scheduler=None, receive=None):
+        loop = self.loop = asyncio.get_running_loop()
+        self.pending = asyncio.Semaphore(self.max_pending)
+        self.stopping = asyncio.Event()
+        # A runtime fed by another source is stopped by closing the source, so it drains what was accepted
+        for sig in (signal.SIGINT, signal.SIGTERM) if receive is None else ():
+            try:
+                loop.add_signal_handler(sig, self.stopping.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+        if scheduler is not None:
+            scheduler.start()
+
+        poller = asyncio.create_task(self.poll() if receive is None else self.consume(receive))
+        await self.stopping.wait()
+
+        # Graceful shutdown: stop taking updates, let the accepted ones finish, then stop the workers
+        log.info('Shutting down')
+        poller.cancel()
+        if scheduler is not None:
+            scheduler.shutdown(wait=False)
+        if self.tasks:
+            await asyncio.wait(set(self.tasks), timeout=self.shutdown_timeout)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.poll_executor.shutdown(wait=False, cancel_futures=True)
+
+    # Request a graceful shutdown, from any thread
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.stopping.set)
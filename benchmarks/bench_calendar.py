@@ -0,0 +1,134 @@
+# Pulls of the iCalendar feed of a group and a teacher from the local feed endpoint: the first pull rendering
+# every day, a pull rendering none, a conditional pull answered 304, and a pull after a prefetch changed one
+# day. Two weeks of synthetic events for every group of items.json, stored by prefetch_events from a local fake
+# schedule service, which must not be asked again by the pulls.
+# Run from the repository root: python benchmarks/bench_calendar.py
+import json, os, random, sys, tempfile, time
+from datetime import datetime
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('TSI_BOT_KEY', '123456:bench')
+
+import main
+from database import StudentGroupCache
+from ics_feed import CalendarFeed, start_calendar_server
+from lookup import ItemsIndex
+from renderer import riga
+from teacher_matcher import TeacherMatcher
+from tsi_client import TsiClient
+
+group = '4201BDA'
+teacher_id = 15596
+# Events served by the fake schedule service, and the number of requests it answered
+events = []
+requests = 0
+
+
+class FakeTsi(BaseHTTPRequestHandler):
+    def do_GET(self):
+        global requests
+        requests += 1
+        params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+        from_time, to_time = int(params['from']), int(params['to'])
+        values = [event for event in events if from_time <= event[0] <= to_time]
+        body = ('(' + json.dumps({'d': json.dumps({'events': {'values': values}})}) + ')').encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def make_events(rng, group_ids, room_ids, from_time, days):
+    events = []
+    for day in range(days):
+        for slot in range(5):
+            begin = from_time + day * 86400 + 9 * 3600 + slot * 6300
+            for group_id in rng.sample(group_ids, len(group_ids) // 3):
+                events.append([begin, [rng.choice(room_ids)], [group_id], rng.choice([teacher_id] + list(range(1, 60))), f'Subject {rng.randrange(40)}'])
+    return events
+
+
+def pull(port, path, etag=None):
+    connection = HTTPConnection('127.0.0.1', port)
+    started = time.perf_counter()
+    connection.request('GET', path, headers={'If-None-Match': etag} if etag else {})
+    response = connection.getresponse()
+    body = response.read()
+    seconds = time.perf_counter() - started
+    connection.close()
+    return response.status, response.getheader('ETag'), body, seconds
+
+
+# Lines end with CRLF, are folded at 75 octets and every event is complete
+def check_document(body):
+    lines = body.split(b'\r\n')
+    assert lines[0] == b'BEGIN:VCALENDAR' and lines[-2] == b'END:VCALENDAR' and lines[-1] == b''
+    assert all(len(line) <= 75 for line in lines)
+    assert body.count(b'BEGIN:VEVENT') == body.count(b'END:VEVENT')
+    return body.count(b'BEGIN:VEVENT')
+
+
+def main_benchmark():
+    main.items = json.load(open('items.json'))
+    main.items_index = ItemsIndex(main.items)
+    main.teacher_matcher = TeacherMatcher(main.items['teachers'], main.match_score)
+    main.DATABASE_FILE = os.path.join(tempfile.mkdtemp(), 'students.db')
+    main.student_groups = StudentGroupCache(main.DATABASE_FILE)
+
+    tsi = ThreadingHTTPServer(('127.0.0.1', 0), FakeTsi)
+    Thread(target=tsi.serve_forever, daemon=True).start()
+    main.tsi_client = TsiClient(f'http://127.0.0.1:{tsi.server_port}/', retries=0, max_concurrency=main.tsi_concurrency)
+
+    rng = random.Random(1)
+    group_ids = [int(key) for key in main.items['groups']]
+    room_ids = [int(key) for key in main.items['rooms']]
+    start = datetime.now(riga).replace(hour=0, minute=0, second=0, microsecond=0)
+    from_time = int(start.timestamp())
+    events[:] = make_events(rng, group_ids, room_ids, from_time, main.calendar_days)
+    group_id = int(main.items_index.find_group_key(group))
+    events.extend([from_time + day * 86400 + 12 * 3600, [room_ids[0]], [group_id], teacher_id, 'Lecture'] for day in range(main.calendar_days))
+    main.prefetch_events()
+    prefetched = requests
+    print(f'{len(events)} prefetched events, feeds of {main.calendar_days} days')
+
+    server = start_calendar_server(0, main.calendar_feed_for, host='127.0.0.1')
+    port = server.server_port
+    for path in (f'/group/{group}.ics', f'/teacher/{teacher_id}.ics'):
+        main.calendar_feed = CalendarFeed(main.lesson_minutes * 60)
+        status, etag, body, first = pull(port, path)
+        assert status == 200, status
+        count = check_document(body)
+        _, same_etag, same_body, again = pull(port, path)
+        assert (same_etag, same_body) == (etag, body), 'feed changed without a change of the events'
+        status, _, _, conditional = pull(port, path, etag)
+        assert status == 304, status
+        print(f'{path}: {count} events, {len(body)} bytes; first pull {first * 1000:.1f} ms, again {again * 1000:.1f} ms, '
+              f'If-None-Match {conditional * 1000:.1f} ms, {main.calendar_feed.stats()}')
+
+    # A prefetch moves one lesson of the group: only its day is rendered again and the ETag changes
+    main.calendar_feed = CalendarFeed(main.lesson_minutes * 60)
+    _, etag, _, _ = pull(port, f'/group/{group}.ics')
+    events[-1][0] += 3600
+    main.prefetch_events()
+    prefetched = requests
+    status, new_etag, body, seconds = pull(port, f'/group/{group}.ics', etag)
+    assert status == 200 and new_etag != etag
+    check_document(body)
+    print(f'after a change of one day: {seconds * 1000:.1f} ms, {main.calendar_feed.stats()}')
+    assert main.calendar_feed.stats()['days_rendered'] == main.calendar_days + 1
+
+    assert pull(port, '/group/nonexistent.ics')[0] == 404
+    assert requests == prefetched, 'feeds were not answered from the prefetched events'
+    server.shutdown()
+    tsi.shutdown()
+
+
+if __name__ == '__main__':
+    main_benchmark()
@@ -0,0 +1,107 @@
+# Time to the first schedule message and to the whole answer for long date periods, with one request
+# for the whole period against chunks of days fetched in parallel.
+# A local fake schedule service answers after a latency growing with the length of the requested window.
+# Run from the repository root: python benchmarks/bench_chunked_fetch.py
+import json, os, sys, tempfile, time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('TSI_BOT_KEY', '123456:bench')
+
+import telebot
+import main
+from database import StudentGroupCache
+from lookup import ItemsIndex
+from renderer import riga
+from reply_cache import ReplyCache
+from schedule_cache import ScheduleCache
+from teacher_matcher import TeacherMatcher
+from tsi_client import TsiClient
+
+# Latency of the fake service: a fixed part and a part per day of the requested window
+base_latency = 0.15
+latency_per_day = 0.02
+group = '4201BDA'
+
+
+class FakeTsi(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+        from_time, to_time = int(params['from']), int(params['to'])
+        groups = [int(g) for g in params.get('groups', '').strip("'").split(',') if g]
+        time.sleep(base_latency + latency_per_day * (to_time - from_time) / 86400)
+        values = []
+        day = datetime.fromtimestamp(from_time, riga).replace(hour=0, minute=0, second=0)
+        while int(day.timestamp()) <= to_time:
+            if day.weekday() < 5:
+                values += [[int(day.replace(hour=9 + 2 * slot).timestamp()), [206], groups, 15596, f'Subject {slot}'] for slot in range(4)]
+            day += timedelta(days=1)
+        values = [event for event in values if from_time <= event[0] <= to_time]
+        body = ('(' + json.dumps({'d': json.dumps({'events': {'values': values}})}) + ')').encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+# Records when each message was queued
+class TimedOutbox:
+    def __init__(self):
+        self.messages = []
+
+    def send_message(self, chat_id, text, bulk=False, **kwargs):
+        self.messages.append((time.perf_counter(), text))
+
+    def submit(self, chat_id, function, *args, **kwargs):
+        pass
+
+
+def ask(days, start):
+    end = start + timedelta(days=days) - timedelta(seconds=1)
+    message = telebot.types.Message.de_json({'message_id': 1, 'date': 0, 'text': f'schedule {group}',
+                                             'chat': {'id': 1, 'type': 'private'}, 'from': {'id': 1, 'is_bot': False, 'first_name': 'Student'}})
+    parameters = {'date-period': {'startDate': start.isoformat(), 'endDate': end.isoformat()}, 'group-text': group}
+    main.outbox = TimedOutbox()
+    main.schedule_cache = ScheduleCache(main.fetch_events, ttl=0)
+    main.reply_cache = ReplyCache(ttl=0)
+    started = time.perf_counter()
+    main.check_schedule(message, parameters)
+    # The first message only repeats the period, the schedule starts with the second
+    sent = main.outbox.messages[1:]
+    return sent[0][0] - started, sent[-1][0] - started, len(sent), ''.join(text for _, text in sent)
+
+
+def main_benchmark():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeTsi)
+    Thread(target=server.serve_forever, daemon=True).start()
+    main.items = json.load(open('items.json'))
+    main.items_index = ItemsIndex(main.items)
+    main.teacher_matcher = TeacherMatcher(main.items['teachers'], main.match_score)
+    main.DATABASE_FILE = os.path.join(tempfile.mkdtemp(), 'students.db')
+    main.student_groups = StudentGroupCache(main.DATABASE_FILE)
+    main.tsi_client = TsiClient(f'http://127.0.0.1:{server.server_port}/', retries=0, max_concurrency=main.tsi_concurrency)
+
+    start = datetime(2024, 2, 12, tzinfo=riga)
+    chunk_days = main.fetch_chunk_days
+    for days in (7, 31, 92):
+        main.fetch_chunk_days = 10 ** 6
+        single = ask(days, start)
+        main.fetch_chunk_days = chunk_days
+        chunked = ask(days, start)
+        # Messages may be cut differently, the schedule must be the same
+        assert single[3].replace('\n', '') == chunked[3].replace('\n', ''), f'{days} days: different schedules'
+        print(f'{days} days: one request first message {single[0] * 1000:.0f} ms, all {single[1] * 1000:.0f} ms ({single[2]} messages); '
+              f'chunks of {chunk_days} days first message {chunked[0] * 1000:.0f} ms, all {chunked[1] * 1000:.0f} ms ({chunked[2]} messages)')
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main_benchmark()
@@ -0,0 +1,94 @@
+# Benchmark of the database layer against the original per-call connections and unindexed tables, with 100k students.
+# Run from the repository root: python benchmarks/bench_database.py [number of students]
+import json, os, random, sqlite3, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+
+groups = list(json.load(open('items.json'))['groups'].values())
+
+
+# The original queries, each opening a new connection
+def original_get_student_group(database_file, chat_id):
+    conn = sqlite3.connect(database_file)
+    c = conn.cursor()
+    c.execute("SELECT * FROM students WHERE chat_id = ?", (chat_id,))
+    rows = c.fetchall()
+    return rows[0][1] if rows else None
+
+
+def original_set_group(database_file, chat_id, group):
+    conn = sqlite3.connect(database_file)
+    c = conn.cursor()
+    c.execute("SELECT * FROM students WHERE chat_id = ?", (chat_id,))
+    if c.fetchall():
+        c.execute("UPDATE students SET group_number = ? WHERE chat_id = ?", (group, chat_id))
+    else:
+        c.execute("INSERT INTO students (chat_id, group_number) VALUES (?, ?)", (chat_id, group))
+    conn.commit()
+
+
+def original_search_groups(database_file, term):
+    conn = sqlite3.connect(database_file)
+    c = conn.cursor()
+    c.execute("SELECT DISTINCT group_number FROM groups WHERE group_number LIKE ?", ('%' + term + '%',))
+    return [row[0] for row in c.fetchall()]
+
+
+def original_fill_groups_table(database_file):
+    conn = sqlite3.connect(database_file)
+    c = conn.cursor()
+    c.execute("DELETE FROM groups")
+    for group in groups:
+        c.execute("INSERT INTO groups (group_number) VALUES (?)", (group,))
+    conn.commit()
+
+
+def timed(name, function, count):
+    started = time.perf_counter()
+    for i in range(count):
+        function(i)
+    duration = time.perf_counter() - started
+    print(f'{name}: {duration / count * 1e6:.0f} us/call')
+
+
+def main():
+    students = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rng = random.Random(1)
+    directory = tempfile.mkdtemp()
+    original_file = os.path.join(directory, 'original.db')
+    layer_file = os.path.join(directory, 'layer.db')
+
+    rows = [(chat_id, rng.choice(groups)) for chat_id in range(students)]
+    for database_file in (original_file, layer_file):
+        conn = sqlite3.connect(database_file)
+        conn.execute("CREATE TABLE students (chat_id integer, group_number text)")
+        conn.execute("CREATE TABLE groups (group_number text)")
+        conn.executemany("INSERT INTO students VALUES (?, ?)", rows)
+        conn.executemany("INSERT INTO groups VALUES (?)", [(g,) for g in groups])
+        conn.commit()
+        conn.close()
+
+    started = time.perf_counter()
+    database.get_connection(layer_file)
+    print(f'{students} students, migration {time.perf_counter() - started:.2f} s')
+
+    chat_ids = [rng.randrange(students) for _ in range(2000)]
+    terms = [rng.choice(groups)[rng.randrange(2):][:4] for _ in range(200)]
+
+    timed('get_student_group original', lambda i: original_get_student_group(original_file, chat_ids[i % 200]), 200)
+    timed('get_student_group layer', lambda i: database.get_student_group(layer_file, chat_ids[i]), 2000)
+    timed('set group original', lambda i: original_set_group(original_file, chat_ids[i % 100], 'X'), 100)
+    timed('set group layer', lambda i: database.set_student_group(layer_file, chat_ids[i % 100], 'X'), 100)
+    timed('search groups original', lambda i: original_search_groups(original_file, terms[i]), 200)
+    timed('search groups layer', lambda i: database.search_groups(layer_file, terms[i]), 200)
+    timed('fill groups original', lambda i: original_fill_groups_table(original_file), 5)
+    timed('fill groups layer', lambda i: database.replace_groups(layer_file, groups), 5)
+
+    # Both must find the same groups
+    assert all(sorted(set(original_search_groups(original_file, t))) == database.search_groups(layer_file, t) for t in terms)
+
+
+if __name__ == '__main__':
+    main()
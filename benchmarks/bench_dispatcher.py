@@ -0,0 +1,165 @@
+# Handler latency when replies are sent inline with bot.send_message against queueing them on the Dispatcher.
+# A local fake Bot API answers after a fixed latency and enforces Telegram's limits, answering 429 with
+# retry_after to chats sending more than one message per second after a burst, or beyond 30 messages per second.
+# Then a notification fan-out queues one bulk message to each of more chats than the dispatcher keeps, with a
+# bot answering at once: queueing must stay linear, and idle chats must be forgotten. Exits non-zero on failure.
+# Run from the repository root: python benchmarks/bench_dispatcher.py [number of chats] [fan-out chats]
+import json, os, sys, time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import telebot
+from dispatcher import Dispatcher, TokenBucket
+
+# Latency of every Bot API call, handler threads like the polling runtime's, and the messages of one reply
+api_latency = 0.05
+handler_threads = 16
+chunks = ['12.02.2024'] + ['Lecture with Teacher\nRoom: 101\nGroups: 4201BDA\nTime: 09:00\n\n' * 20] * 3
+
+
+class FakeBotApi:
+    def __init__(self):
+        self.lock = Lock()
+        self.global_bucket = TokenBucket(30, 30)
+        self.chat_buckets = {}
+        self.delivered = {}
+        self.rejected = 0
+
+    # Returns the retry_after of a 429 answer, or None when the message is accepted
+    def accept(self, chat_id, text):
+        with self.lock:
+            now = time.monotonic()
+            bucket = self.chat_buckets.setdefault(chat_id, TokenBucket(1, 3))
+            delay = max(bucket.delay(now), self.global_bucket.delay(now))
+            if delay > 0:
+                self.rejected += 1
+                return max(1, int(delay + 0.999))
+            bucket.take(now)
+            self.global_bucket.take(now)
+            self.delivered.setdefault(chat_id, []).append((time.perf_counter(), len(text)))
+            return None
+
+    def handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                time.sleep(api_latency)
+                length = int(self.headers.get('Content-Length') or 0)
+                params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+                if length:
+                    params.update({k: v[0] for k, v in parse_qs(self.rfile.read(length).decode()).items()})
+                chat_id = int(params['chat_id'])
+                retry_after = api.accept(chat_id, params.get('text', ''))
+                if retry_after is None:
+                    status, body = 200, {'ok': True, 'result': {'message_id': 1, 'date': int(time.time()),
+                                                                'chat': {'id': chat_id, 'type': 'private'}, 'text': params.get('text', '')}}
+                else:
+                    status, body = 429, {'ok': False, 'error_code': 429, 'description': f'Too Many Requests: retry after {retry_after}',
+                                         'parameters': {'retry_after': retry_after}}
+                body = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def run(name, send, chats, api, flush=None):
+    errors = []
+
+    def handle(chat_id):
+        started = time.perf_counter()
+        try:
+            for chunk in chunks:
+                send(chat_id, chunk)
+        except Exception as e:
+            errors.append(e)
+        return started, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(handler_threads) as executor:
+        results = list(executor.map(handle, range(1, chats + 1)))
+    handled = time.perf_counter() - started
+    if flush:
+        flush()
+    delivered = time.perf_counter() - started
+
+    latencies = sorted(duration for _, duration in results)
+    complete = sum(1 for chat_id in range(1, chats + 1) if sum(length for _, length in api.delivered.get(chat_id, [])) > 0)
+    print(f'{name}: handler p50 {percentile(latencies, 0.5) * 1000:.1f} ms, p99 {percentile(latencies, 0.99) * 1000:.1f} ms, '
+          f'all handled in {handled:.1f} s, delivered in {delivered:.1f} s, {complete}/{chats} chats answered, '
+          f'{sum(len(v) for v in api.delivered.values())} messages, {api.rejected} answered 429, {len(errors)} handler errors')
+
+
+class NoopBot:
+    def send_message(self, chat_id, text, **kwargs):
+        pass
+
+
+# Seconds to queue one bulk message to each of count new chats, starting at chat first
+def fan_out(dispatcher, first, count):
+    started = time.perf_counter()
+    for chat_id in range(first, first + count):
+        dispatcher.send_message(chat_id, 'Reminder', bulk=True)
+    return time.perf_counter() - started
+
+
+def check_fan_out(count):
+    # At the global rate of 30 messages per second nearly every chat still has its message queued
+    dispatcher = Dispatcher(NoopBot())
+    first = fan_out(dispatcher, 1, count)
+    dispatcher.set_global_rate(1000000)
+    dispatcher.flush()
+    # Once the buckets of the first chats are full again, a second fan-out forgets them as it goes
+    time.sleep(dispatcher.chat_burst / dispatcher.chat_rate)
+    second = fan_out(dispatcher, count + 1, count)
+    dispatcher.flush()
+    stats = dispatcher.stats()
+    print(f'fan-out to {count} chats: queued in {first:.2f} s, to {count} more in {second:.2f} s, {stats}')
+    # Linear queueing takes a few microseconds per message, the full scans took seconds per thousand chats
+    return (max(first, second) < count * 100e-6 and stats['sent'] == 2 * count
+            and stats['chats'] <= max(dispatcher.max_chats, count))
+
+
+def main():
+    chats = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    fan_out_chats = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+
+    for name in ('inline', 'dispatcher'):
+        api = FakeBotApi()
+        server = ThreadingHTTPServer(('127.0.0.1', 0), api.handler())
+        Thread(target=server.serve_forever, daemon=True).start()
+        telebot.apihelper.API_URL = f'http://127.0.0.1:{server.server_port}/bot{{0}}/{{1}}'
+        bot = telebot.TeleBot('123456:bench', threaded=False)
+
+        if name == 'inline':
+            run(name, bot.send_message, chats, api)
+        else:
+            dispatcher = Dispatcher(bot, workers=8)
+            run(name, dispatcher.send_message, chats, api, flush=dispatcher.flush)
+            print(f'dispatcher stats: {dispatcher.stats()}')
+        server.shutdown()
+
+    if not check_fan_out(fan_out_chats):
+        print('fan-out check failed')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
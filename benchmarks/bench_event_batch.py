@@ -0,0 +1,96 @@
+# Benchmark of EventBatch against filtering and mapping lists of event lists, with the build of the batch counted:
+# a request on a new list, like a prefetched answer, goes through batch_for filtering the list once, and only
+# requests on a list seen again, like a cached response, select their rows from the columns of a kept batch.
+# Run from the repository root: python benchmarks/bench_event_batch.py [number of events]
+import json, os, random, sys, timeit, tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import event_batch
+from event_batch import EventBatch, batch_for
+
+items = json.load(open('items.json'))
+
+
+# map_event from main.py
+def map_event(event):
+    event = list(event)
+    room_id = event[1][0] if len(event[1]) > 0 else None
+    event[1] = items["rooms"].get(str(room_id), "Not specified")
+    event[2] = [items["groups"].get(str(group_id), "") for group_id in event[2]]
+    event[3] = items["teachers"].get(str(event[3]), "")
+    return event
+
+
+# Events of all groups over several weeks, as parsed from the API
+def build_events(count):
+    rng = random.Random(1)
+    rooms, groups, teachers = ([int(k) for k in items[section]] for section in ('rooms', 'groups', 'teachers'))
+    names = ['Mathematics', 'Programming in Python', 'Databases', 'Operating systems', 'English for IT', 'Physics']
+    return [[1676476800 + i * 60, [rng.choice(rooms)], rng.sample(groups, rng.randrange(1, 6)), rng.choice(teachers),
+             rng.choice(names), 1] for i in range(count)]
+
+
+def traced_size(build):
+    tracemalloc.start()
+    value = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return value, size
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    events = build_events(count)
+    group_id = events[0][2][0]
+
+    lists, list_size = traced_size(lambda: json.loads(json.dumps(events)))
+    batch, batch_size = traced_size(lambda: EventBatch(lists))
+    print(f'{count} events: lists {list_size / count:.0f} B/event, batch {batch_size / count:.0f} B/event')
+
+    # Both paths must render the same events
+    expected = [map_event(event)[:5] for event in lists if group_id in event[2]]
+    assert batch.resolve(batch.rows_with_group(group_id), items) == expected
+
+    def list_path():
+        return [map_event(event) for event in lists if group_id in event[2]]
+
+    def batch_path():
+        return batch.resolve(batch.rows_with_group(group_id), items)
+
+    def list_window():
+        return [event for event in lists if 1676476800 + 3600 <= event[0] <= 1676476800 + 7200]
+
+    def batch_window():
+        return batch.rows_in_window(1676476800 + 3600, 1676476800 + 7200)
+
+    # A request on a new list: the same events as the list path, and no slower
+    def one_shot():
+        batch, rows = batch_for(list(lists), group_id=group_id)
+        return batch.resolve(rows, items)
+
+    assert one_shot() == expected
+    build = min(timeit.repeat(lambda: EventBatch(lists), number=1, repeat=3))
+    list_time = min(timeit.repeat(list_path, number=5, repeat=3)) / 5
+    copy_time = min(timeit.repeat(lambda: list(lists), number=5, repeat=3)) / 5
+    one_shot_time = min(timeit.repeat(one_shot, number=5, repeat=3)) / 5 - copy_time
+    batch_time = min(timeit.repeat(batch_path, number=5, repeat=3)) / 5
+    print(f'batch build: {build * 1000:.1f} ms')
+    print(f'one request on a new list: lists {list_time * 1000:.2f} ms, batch_for {one_shot_time * 1000:.2f} ms '
+          f'(a batch of all events would take {(build + batch_time) * 1000:.2f} ms)')
+    assert one_shot_time < list_time * 1.5
+
+    # Requests on a list seen again share its batch
+    batch_for(lists, group_id=group_id)
+    batch_for(lists, group_id=group_id)
+    reused = min(timeit.repeat(lambda: batch_for(lists, group_id=group_id), number=5, repeat=3)) / 5
+    print(f'request on a list seen again: batch_for {reused * 1000:.3f} ms')
+    for name, list_case, batch_case in (('group filter', list_path, batch_path), ('time window', list_window, batch_window)):
+        list_time = min(timeit.repeat(list_case, number=5, repeat=3)) / 5
+        batch_time = min(timeit.repeat(batch_case, number=5, repeat=3)) / 5
+        print(f'{name}: lists {list_time * 1000:.2f} ms, batch {batch_time * 1000:.3f} ms')
+    print(f'numpy: {"yes" if event_batch.numpy is not None else "no"}')
+
+
+if __name__ == '__main__':
+    main()
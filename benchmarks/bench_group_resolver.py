@@ -0,0 +1,88 @@
+# Accuracy and speed of the GroupResolver on a synthetic corpus of mistyped group numbers from items.json,
+# against the lookups it replaced: find_group_key for schedule questions and, for /selectgroup, the exact
+# database check of the upper-cased input followed by the substring search. Typos that spell another
+# group are left out, nothing can tell them apart.
+# Run from the repository root: python benchmarks/bench_group_resolver.py
+import json, os, random, string, sys, tempfile, timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+from group_resolver import GroupResolver, group_key
+from lookup import ItemsIndex
+
+
+def typos(rng, group):
+    positions = range(len(group))
+    alnum = [position for position in positions if group[position].isalnum()]
+    position = rng.choice(alnum)
+    character = group[position]
+    replacement = rng.choice(string.digits if character.isdigit() else string.ascii_uppercase)
+    swap = rng.choice([p for p in positions[:-1] if group[p] != group[p + 1]] or [0])
+    digits_end = len(group) - len(group.lstrip(string.digits))
+    return {
+        'lower case': group.lower(),
+        'dash or space': group.replace('-', '') if '-' in group else (group[:4] + '-' + group[4:] if digits_end == 4 else group.replace(' ', '')),
+        'substitution': group[:position] + (replacement if replacement != character else '0' if character != '0' else '1') + group[position + 1:],
+        'swapped characters': group[:swap] + group[swap + 1] + group[swap] + group[swap + 2:],
+        'missing character': group[:position] + group[position + 1:],
+        'doubled character': group[:position] + character + group[position:],
+    }
+
+
+def main():
+    items = json.load(open('items.json'))
+    index = ItemsIndex(items)
+    resolver = index.group_resolver
+    groups = list(dict.fromkeys(items['groups'].values()))
+    keys = {group_key(group) for group in groups}
+    database_file = os.path.join(tempfile.mkdtemp(), 'students.db')
+    database.replace_groups(database_file, groups)
+
+    rng = random.Random(1)
+    corpus = {}
+    for group in groups:
+        for kind, text in typos(rng, group).items():
+            spelling = kind in ('lower case', 'dash or space')
+            if text != group and (spelling or group_key(text) not in keys):
+                corpus.setdefault(kind, []).append((text, group))
+
+    print(f'{len(groups)} groups, {sum(len(cases) for cases in corpus.values())} typos; rates of finding the right group')
+    print('typo: find_group_key, /selectgroup before, resolve right / wrong, in top 5 suggestions')
+    totals = [0, 0, 0, 0, 0, 0]
+    for kind, cases in corpus.items():
+        old_schedule = sum(items['groups'].get(index.find_group_key(text) or '') == group for text, group in cases)
+        old_select = sum(database.group_exists(database_file, text.upper()) and text.upper() == group
+                         or group in database.search_groups(database_file, text.upper()) for text, group in cases)
+        resolved = [resolver.resolve(text) for text, _ in cases]
+        right = sum(result == group for result, (_, group) in zip(resolved, cases))
+        wrong = sum(result is not None and result != group for result, (_, group) in zip(resolved, cases))
+        suggested = sum(group in [suggestion for suggestion, _ in resolver.suggest(text)] for text, group in cases)
+        n = len(cases)
+        print(f'{kind} ({n}): {old_schedule / n:.0%}, {old_select / n:.0%}, {right / n:.0%} / {wrong / n:.1%}, {suggested / n:.0%}')
+        for position, value in enumerate((n, old_schedule, old_select, right, wrong, suggested)):
+            totals[position] += value
+
+        # Case, dashes and spaces never matter, and a single typo is corrected or at least suggested
+        if kind in ('lower case', 'dash or space'):
+            assert right == n, kind
+        else:
+            assert suggested / n > 0.9 and wrong / n < 0.05, kind
+    n = totals[0]
+    print(f'all ({n}): {totals[1] / n:.0%}, {totals[2] / n:.0%}, {totals[3] / n:.0%} / {totals[4] / n:.1%}, {totals[5] / n:.0%}')
+
+    build = timeit.timeit(lambda: GroupResolver(groups), number=5) / 5
+    texts = [text for cases in corpus.values() for text, _ in cases][::20]
+    cases = [
+        ('database search', lambda: [database.search_groups(database_file, text.upper()) for text in texts]),
+        ('resolve', lambda: [resolver.resolve(text) for text in texts]),
+        ('suggest', lambda: [resolver.suggest(text) for text in texts]),
+    ]
+    print(f'resolver build: {build * 1000:.1f} ms')
+    for name, run in cases:
+        seconds = min(timeit.repeat(run, number=3, repeat=3)) / 3 / len(texts)
+        print(f'{name}: {seconds * 1e6:.1f} us per query')
+
+
+if __name__ == '__main__':
+    main()
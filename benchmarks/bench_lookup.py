@@ -0,0 +1,57 @@
+# Micro-benchmark of ItemsIndex against the linear scans it replaced.
+# Run from the repository root: python benchmarks/bench_lookup.py
+import json, os, re, sys, timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lookup import ItemsIndex
+
+items = json.load(open('items.json'))
+
+
+def find_group_key_scan(group_text):
+    for key, value in items.get('groups').items():
+        if value == group_text:
+            return key
+    return None
+
+
+def find_teacher_key_scan(teacher_text):
+    for key, value in items.get('teachers').items():
+        if value == teacher_text:
+            return key
+    return None
+
+
+def group_family_scan(numeric_part, letter_part):
+    return [group for group in items.get('groups').values() if re.match(r'^\d{}.*{}$'.format(numeric_part[1:2], letter_part), group)]
+
+
+def main():
+    index = ItemsIndex(items)
+    groups = list(items['groups'].values())
+    teachers = list(items['teachers'].values())
+    families = [re.match(r'(\d+)-?(\w+)', g) for g in groups]
+    families = [(m.group(1), m.group(2)) for m in families if m]
+
+    # Both implementations must agree before their timings mean anything
+    assert all(index.find_group_key(g) == find_group_key_scan(g) for g in groups)
+    assert all(index.find_teacher_key(t) == find_teacher_key_scan(t) for t in teachers)
+    assert all(list(index.group_family(*f)) == group_family_scan(*f) for f in families)
+
+    build = timeit.timeit(lambda: ItemsIndex(items), number=5) / 5
+    print(f'index build: {build * 1000:.2f} ms')
+
+    cases = [
+        ('group key', lambda: [find_group_key_scan(g) for g in groups[::10]], lambda: [index.find_group_key(g) for g in groups[::10]]),
+        ('teacher key', lambda: [find_teacher_key_scan(t) for t in teachers[::5]], lambda: [index.find_teacher_key(t) for t in teachers[::5]]),
+        ('group family', lambda: [group_family_scan(*f) for f in families[::50]], lambda: [index.group_family(*f) for f in families[::50]]),
+    ]
+    for name, scan, indexed in cases:
+        scan_time = min(timeit.repeat(scan, number=3, repeat=3)) / 3
+        indexed_time = min(timeit.repeat(indexed, number=3, repeat=3)) / 3
+        print(f'{name}: scan {scan_time * 1000:.3f} ms, index {indexed_time * 1000:.3f} ms, {scan_time / indexed_time:.0f}x')
+
+
+if __name__ == '__main__':
+    main()
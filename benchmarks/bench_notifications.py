@@ -0,0 +1,87 @@
+# Planning of notifications when the prefetched events are too old to be used: the notifier then asks a local
+# fake schedule service for the events of every subscribed group. One group gets an invalid response and one
+# an error status, and the other groups must still get their reminders and digests. Exits non-zero on failure.
+# Run from the repository root: python benchmarks/bench_notifications.py [subscribed groups]
+import json, os, sys, tempfile, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('TSI_BOT_KEY', '123456:bench')
+
+import database, event_store, main
+from lookup import ItemsIndex
+from schedule_cache import ScheduleCache
+from tsi_client import TsiClient
+
+invalid_group = None
+failing_group = None
+
+
+class FakeTsi(BaseHTTPRequestHandler):
+    def do_GET(self):
+        params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+        from_time = int(params['from'])
+        groups = [int(g) for g in params.get('groups', '').strip("'").split(',') if g]
+        if failing_group in groups:
+            self.send_response(500)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if invalid_group in groups:
+            body = b'(not json'
+        else:
+            # Two classes per group in the coming hours, the second one shared by all groups of the request
+            values = [[from_time + 3600 * (2 + slot), [206], groups[:1] if slot == 0 else groups, 15596, f'Subject {slot}'] for slot in range(2)]
+            body = ('(' + json.dumps({'d': json.dumps({'events': {'values': values}})}) + ')').encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def main_benchmark(count=50):
+    global invalid_group, failing_group
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeTsi)
+    Thread(target=server.serve_forever, daemon=True).start()
+    main.items = json.load(open('items.json'))
+    main.items_index = ItemsIndex(main.items)
+    main.DATABASE_FILE = os.path.join(tempfile.mkdtemp(), 'students.db')
+    main.tsi_client = TsiClient(f'http://127.0.0.1:{server.server_port}/', retries=0, max_concurrency=main.tsi_concurrency)
+    main.schedule_cache = ScheduleCache(main.fetch_events, ttl=0)
+
+    groups = [(key, group) for key, group in main.items['groups'].items() if main.items_index.find_group_key(group) == key][:count]
+    for chat_id, (_, group) in enumerate(groups, 1):
+        database.set_student_group(main.DATABASE_FILE, chat_id, group)
+        database.set_subscription(main.DATABASE_FILE, chat_id, 8, 15)
+    invalid_group, failing_group = int(groups[0][0]), int(groups[1][0])
+
+    # A prefetch older than prefetch_max_age, so the notifier has to ask the service
+    now = time.time()
+    event_store.store_events(main.DATABASE_FILE, [], int(now) - 86400, int(now) + 14 * 86400)
+    event_store._connection(main.DATABASE_FILE).execute('UPDATE events_coverage SET fetched_at = ?', (int(now) - main.prefetch_max_age - 1,))
+    assert event_store.query_events(main.DATABASE_FILE, [], [], int(now), int(now) + 3600, main.prefetch_max_age) is None
+
+    started = time.perf_counter()
+    planned = main.notifier.plan(now)
+    seconds = time.perf_counter() - started
+    reminders = {}
+    for entry in main.notifier.timers.heap:
+        key = entry[3][0]
+        if key[0] == 'reminder':
+            reminders[key[1]] = reminders.get(key[1], 0) + 1
+
+    print(f'{len(groups)} groups planned in {seconds * 1000:.0f} ms: {planned} notifications, reminders for {len(reminders)} groups')
+    failed = [group_id for group_id in (invalid_group, failing_group) if group_id in reminders]
+    assert not failed, f'groups without events got reminders: {failed}'
+    missing = [int(key) for key, _ in groups[2:] if reminders.get(int(key)) != 2]
+    assert not missing, f'groups without their two reminders: {missing}'
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main_benchmark(*[int(argument) for argument in sys.argv[1:]])
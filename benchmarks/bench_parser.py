@@ -0,0 +1,64 @@
+# Benchmark of the events parsers against the original decode, slice, replace and double json.loads: parse_events_response
+# streaming the events into tuples and decoding the rest of the response, and iter_events yielding them one by one.
+# Run from the repository root: python benchmarks/bench_parser.py [number of events]
+import json, os, random, sys, time, tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tsi_client import iter_events, parse_events_response
+
+
+# The original parsing code from check_schedule
+def parse_original(content):
+    string_data = content.decode('utf-8')[1:-1].replace(')(', '')
+    a = json.loads(string_data)
+    return json.loads(a.get('d'))
+
+
+# A response shaped like GetLocalizedEvents for a wide date range
+def build_payload(count):
+    rng = random.Random(1)
+    names = ['Mathematics', 'Programming in Python', 'Databases', 'Operating systems', 'English for IT', 'Physics']
+    values = [[1676476800 + i * 900, [rng.randrange(200, 400)], rng.sample(range(1, 1500), rng.randrange(1, 6)),
+               rng.randrange(15000, 41000), rng.choice(names), 1] for i in range(count)]
+    inner = json.dumps({'events': {'values': values}, 'Message': None})
+    return ('(' + json.dumps({'d': inner}) + ')').encode('utf-8')
+
+
+# Time without tracing, since tracemalloc slows allocation heavy code down a lot, then trace the peak memory
+def measure(name, parse, content):
+    durations = []
+    for _ in range(3):
+        started = time.perf_counter()
+        parse(content)
+        durations.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    parse(content)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{name}: {min(durations) * 1000:.0f} ms, peak {peak / 2 ** 20:.1f} MiB')
+
+
+def consume(content):
+    for _ in iter_events(content):
+        pass
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    content = build_payload(count)
+    print(f'payload: {count} events, {len(content) / 2 ** 20:.1f} MiB')
+
+    # The new parsers must return the same events, as tuples
+    expected = parse_original(content)['events']['values']
+    assert [list(map(lambda v: list(v) if type(v) is tuple else v, e)) for e in parse_events_response(content)['events']['values']] == expected
+    assert sum(1 for _ in iter_events(content)) == len(expected)
+
+    measure('original', parse_original, content)
+    measure('parse_events_response', parse_events_response, content)
+    measure('iter_events', consume, content)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# Benchmark of render_schedule against the original rendering loop of check_schedule on 1000 event schedules,
+# checking first that both produce the same messages (golden comparison, in UTC like the original loop).
+# Run from the repository root: python benchmarks/bench_renderer.py [number of events]
+import os, random, sys, timeit
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from renderer import local_strings, render_schedule
+
+
+# The original loop, returning the messages it sent
+def original_render(mapped_events, group_text):
+    sent = []
+    schedule_text = ''
+    last_date = None
+    for event in mapped_events:
+        dt_object = datetime.utcfromtimestamp(event[0]).replace(tzinfo=timezone.utc)
+        local_datetime = dt_object.astimezone(ZoneInfo('Etc/GMT+0'))
+        date_string = dt_object.strftime("%d.%m.%Y")
+        time_string = local_datetime.strftime("%H:%M")
+        room = event[1] if event[1] else 'Not specified'
+        groups = ", ".join(event[2]) if len(event[2]) > 0 else 'Not specified'
+        teacher = event[3].strip()
+        name = event[4].strip()
+
+        if not last_date == date_string:
+            last_date = date_string
+            schedule_text += f'{date_string}\n\n'
+
+        if len(str(schedule_text + f'{name} with {teacher}\nRoom: {room}\nGroups: {groups}\nTime: {time_string}\n\n')) > 4096:
+            sent.append(schedule_text)
+            schedule_text = ''
+
+        schedule_text += f'{name} with {teacher}\nRoom: {room}\nGroups: {groups}\nTime: {time_string}\n\n'
+    if not schedule_text:
+        schedule_text = f'No events found for group {group_text}.'
+    sent.append(schedule_text)
+    return sent
+
+
+def make_events(count, rng):
+    start = 1676448000
+    times = sorted(start + rng.randrange(120) * 86400 // 8 + rng.choice((0, 5400, 11700)) for _ in range(count))
+    return [[t, rng.choice(['', 'Room 101', 'Aula 2', 'Lab 7']), rng.sample(['4201BDA', '4202BDA', '4203BDA', 'Şğö-1'], rng.randrange(4)),
+             rng.choice([' Anna Bērziņa ', 'John Smith', '']), rng.choice(['Mathematics', ' Programming ', 'Physics ' * rng.randrange(1, 40)])]
+            for t in times]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    rng = random.Random(1)
+
+    # Golden comparison on many schedules, including empty ones and ones split into several messages
+    for size in [0, 1, 5, 50, count] + [rng.randrange(1, 400) for _ in range(50)]:
+        events = make_events(size, rng)
+        assert render_schedule(events, '4201BDA', tz=timezone.utc) == original_render(events, '4201BDA'), size
+
+    events = make_events(count, rng)
+    repeat = 20
+    original = min(timeit.repeat(lambda: original_render(events, '4201BDA'), number=repeat, repeat=3)) / repeat
+    local_strings.cache_clear()
+    renderer = min(timeit.repeat(lambda: render_schedule(events, '4201BDA'), number=repeat, repeat=3)) / repeat
+    print(f'{count} events, {len(render_schedule(events, "4201BDA"))} messages: original {original * 1000:.2f} ms, render_schedule {renderer * 1000:.2f} ms')
+    for format in ('compact', 'table'):
+        duration = min(timeit.repeat(lambda: render_schedule(events, '4201BDA', format), number=repeat, repeat=3)) / repeat
+        print(f'{format}: {duration * 1000:.2f} ms, {len(render_schedule(events, "4201BDA", format))} messages')
+
+
+if __name__ == '__main__':
+    main()
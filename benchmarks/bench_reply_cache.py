@@ -0,0 +1,100 @@
+# Time of a "schedule today" question answered from prefetched events without the reply cache, with
+# expired replies reused by their digest, and with fresh replies, plus a check that a prefetch changing
+# the day's events drops the cached reply. Two weeks of synthetic events for every group of items.json.
+# Run from the repository root: python benchmarks/bench_reply_cache.py
+import json, os, random, sys, tempfile, time, timeit
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('TSI_BOT_KEY', '123456:bench')
+
+import telebot
+import main
+from database import StudentGroupCache
+from event_store import store_events
+from lookup import ItemsIndex
+from renderer import riga
+from reply_cache import ReplyCache
+from teacher_matcher import TeacherMatcher
+
+group = '4201BDA'
+
+
+class RecordingOutbox:
+    def __init__(self):
+        self.messages = []
+
+    def send_message(self, chat_id, text, bulk=False, **kwargs):
+        self.messages.append(text)
+
+    def submit(self, chat_id, function, *args, **kwargs):
+        pass
+
+
+def make_events(rng, group_ids, room_ids, from_time, days):
+    events = []
+    for day in range(days):
+        for slot in range(5):
+            begin = from_time + day * 86400 + 9 * 3600 + slot * 6300
+            for group_id in rng.sample(group_ids, len(group_ids) // 3):
+                events.append([begin, [rng.choice(room_ids)], [group_id], 15596, f'Subject {rng.randrange(40)}'])
+    return events
+
+
+def ask(today):
+    message = telebot.types.Message.de_json({'message_id': 1, 'date': 0, 'text': f'schedule {group} today',
+                                             'chat': {'id': 1, 'type': 'private'}, 'from': {'id': 1, 'is_bot': False, 'first_name': 'Student'}})
+    main.outbox = RecordingOutbox()
+    main.check_schedule(message, {'date-time': today.isoformat(), 'group-text': group})
+    return main.outbox.messages
+
+
+def main_benchmark():
+    main.items = json.load(open('items.json'))
+    main.items_index = ItemsIndex(main.items)
+    main.teacher_matcher = TeacherMatcher(main.items['teachers'], main.match_score)
+    main.DATABASE_FILE = os.path.join(tempfile.mkdtemp(), 'students.db')
+    main.student_groups = StudentGroupCache(main.DATABASE_FILE)
+
+    rng = random.Random(1)
+    group_ids = [int(key) for key in main.items['groups']]
+    room_ids = [int(key) for key in main.items['rooms']]
+    start = datetime.now(riga).replace(hour=0, minute=0, second=0, microsecond=0)
+    from_time, to_time = int(start.timestamp()), int((start + timedelta(days=14)).timestamp()) - 1
+    events = make_events(rng, group_ids, room_ids, from_time, 14)
+    # The asked group has lessons every day
+    group_id = int(main.items_index.find_group_key(group))
+    events += [[from_time + day * 86400 + 12 * 3600, [room_ids[0]], [group_id], 15596, 'Lecture'] for day in range(14)]
+    store_events(main.DATABASE_FILE, events, from_time, to_time)
+    main.load_room_index()
+    print(f'{len(events)} prefetched events for {len(group_ids)} groups')
+
+    today = start.replace(hour=12)
+    results = []
+    for name, cache in (('no cache', ReplyCache(ttl=0, max_entries=0)), ('expired, same digest', ReplyCache(ttl=0)), ('fresh', ReplyCache())):
+        main.reply_cache = cache
+        reply = ask(today)
+        results.append(reply)
+        seconds = timeit.timeit(lambda: ask(today), number=200) / 200
+        print(f'{name}: {seconds * 1e6:.0f} us per question, {len(reply) - 1} messages')
+    assert results[0] == results[1] == results[2], 'cached replies differ'
+
+    # A new prefetch moves one lesson of the day: the cached reply must be dropped, the other days' ones kept
+    main.reply_cache = ReplyCache()
+    ask(today)
+    ask(today + timedelta(days=1))
+    for event in events:
+        if event[2] == [group_id] and from_time <= event[0] < from_time + 86400:
+            event[0] += 3600
+            break
+    time.sleep(1.1)
+    store_events(main.DATABASE_FILE, events, from_time, to_time)
+    started = time.perf_counter()
+    main.load_room_index()
+    print(f'revalidation after the prefetch: {(time.perf_counter() - started) * 1000:.1f} ms (with the room index), stats {main.reply_cache.stats()}')
+    assert main.reply_cache.stats()['entries'] == 1
+    assert ask(today) != results[0], 'stale reply'
+
+
+if __name__ == '__main__':
+    main_benchmark()
@@ -0,0 +1,81 @@
+# Micro-benchmark of the RoomIndex against scanning the prefetched events for every question.
+# Two weeks of synthetic events over the rooms of items.json, as a prefetch would store them.
+# Run from the repository root: python benchmarks/bench_rooms.py
+import json, os, random, sys, time, timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rooms import RoomIndex
+
+items = json.load(open('items.json'))
+room_ids = [int(key) for key in items['rooms']]
+lesson = 90 * 60
+day = 86400
+start = 1707688800  # Monday 12.02.2024 00:00 in Riga
+
+
+def make_events(rng, from_time, days):
+    events = []
+    for day_number in range(days):
+        if day_number % 7 >= 5:
+            continue
+        for slot in range(7):
+            begin = from_time + day_number * day + 8 * 3600 + slot * 6300
+            for room_id in rng.sample(room_ids, int(len(room_ids) * 0.6)):
+                events.append([begin, [room_id], [1], 1, 'Lecture'])
+    return events
+
+
+def free_rooms_scan(events, from_time, to_time):
+    busy = {room_id for event in events if event[0] < to_time and event[0] + lesson > from_time for room_id in event[1]}
+    return [room_id for room_id in room_ids if room_id not in busy]
+
+
+def next_free_scan(events, room_id, from_time, length=lesson):
+    intervals = sorted((event[0], event[0] + lesson) for event in events if room_id in event[1])
+    time = from_time
+    for begin, end in intervals:
+        if end <= time:
+            continue
+        if begin >= time + length:
+            return time, begin
+        time = max(time, end)
+    return time, None
+
+
+def main():
+    rng = random.Random(1)
+    events = make_events(rng, start, 14)
+    index = RoomIndex(lesson)
+    build = timeit.timeit(lambda: RoomIndex(lesson).update(events, start, start + 14 * day - 1), number=3) / 3
+    index.update(events, start, start + 14 * day - 1)
+    print(f'{len(events)} events in {len(room_ids)} rooms, index build: {build * 1000:.1f} ms')
+
+    # Both implementations must agree before their timings mean anything
+    queries = [(start + rng.randrange(14 * day - 4 * 3600), rng.randrange(1, 4) * 1800) for _ in range(200)]
+    assert all(index.free_rooms(room_ids, t, t + length) == free_rooms_scan(events, t, t + length) for t, length in queries)
+    assert all(index.next_free(r, t) == next_free_scan(events, r, t) for r, (t, _) in zip(rng.choices(room_ids, k=200), queries))
+
+    t, length = queries[0]
+    room_id = room_ids[0]
+    cases = [
+        ('free rooms', lambda: free_rooms_scan(events, t, t + length), lambda: index.free_rooms(room_ids, t, t + length)),
+        ('next free slot', lambda: next_free_scan(events, room_id, t), lambda: index.next_free(room_id, t)),
+    ]
+    for name, scan, indexed in cases:
+        scan_time = timeit.timeit(scan, number=20) / 20
+        indexed_time = timeit.timeit(indexed, number=2000) / 2000
+        print(f'{name}: scan {scan_time * 1e6:.0f} us, index {indexed_time * 1e6:.1f} us ({scan_time / indexed_time:.0f}x)')
+
+    # The next prefetch: the first day is gone, one day was rescheduled and a new day was added
+    changed = make_events(random.Random(2), start + day, 1) + [event for event in events if start + 2 * day <= event[0]]
+    changed += make_events(random.Random(3), start + 14 * day, 1)
+    started = time.perf_counter()
+    updated = index.update(changed, start + day, start + 15 * day - 1)
+    update = time.perf_counter() - started
+    unchanged = timeit.timeit(lambda: index.update(changed, start + day, start + 15 * day - 1), number=3) / 3
+    print(f'incremental update: {updated} rooms rebuilt in {update * 1000:.1f} ms, same events again {unchanged * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+# Time to first reply of a fresh process: the original startup (parse items.json, build the lookup structures and
+# refresh the items from the API before answering) against loading the binary snapshot and refreshing in the background.
+# The API is a local stub answering GetItems after a configurable latency.
+# Run from the repository root: python benchmarks/bench_startup.py [API latency in seconds]
+import json, os, subprocess, sys, tempfile, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+latency = 0.5
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    body = b''
+
+    def do_GET(self):
+        time.sleep(latency)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        try:
+            self.wfile.write(self.body)
+        except ConnectionError:
+            # The snapshot flow exits after its first reply, before the background refresh is answered
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+# The first message answered by the bot: a group and a teacher lookup
+def first_reply(items, items_index, teacher_matcher):
+    group = next(iter(items['groups'].values()))
+    teacher = next(iter(items['teachers'].values()))
+    assert items_index.find_group_key(group) is not None
+    assert teacher in teacher_matcher.match_tokens(teacher.split()[:1])
+
+
+# Runs in the child process, everything from the imports on counts towards the startup time
+def child(flow, directory, url):
+    from lookup import ItemsIndex
+    from teacher_matcher import TeacherMatcher
+    from tsi_client import TsiClient
+    import snapshot
+
+    items_file = os.path.join(directory, 'items.json')
+    if flow == 'current':
+        items = json.load(open(items_file))
+        items_index = ItemsIndex(items)
+        teacher_matcher = TeacherMatcher(items['teachers'])
+        new_items = TsiClient(url).get_items()
+        if new_items != items:
+            items = new_items
+            items_index = ItemsIndex(items)
+            teacher_matcher = TeacherMatcher(items['teachers'])
+    else:
+        items, items_index, teacher_matcher = snapshot.load_snapshot(os.path.join(directory, 'items.snapshot'), items_file)
+        Thread(target=TsiClient(url).get_items, daemon=True).start()
+    first_reply(items, items_index, teacher_matcher)
+
+
+def run(flow, directory, url, count=5):
+    durations = []
+    for _ in range(count):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, os.path.abspath(__file__), '--child', flow, directory, url], check=True, cwd=root)
+        durations.append(time.perf_counter() - started)
+    durations.sort()
+    print(f'{flow}: median time to first reply {durations[count // 2] * 1000:.0f} ms, best {durations[0] * 1000:.0f} ms')
+
+
+def main():
+    global latency
+    if len(sys.argv) > 1:
+        latency = float(sys.argv[1])
+
+    from lookup import ItemsIndex
+    from teacher_matcher import TeacherMatcher
+    import snapshot
+
+    items = json.load(open(os.path.join(root, 'items.json')))
+    StubHandler.body = ('(' + json.dumps({'d': json.dumps(items)}) + ')').encode()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/'
+
+    directory = tempfile.mkdtemp()
+    items_file = os.path.join(directory, 'items.json')
+    json.dump(items, open(items_file, 'w'), indent=4, ensure_ascii=False)
+    started = time.perf_counter()
+    snapshot.write_snapshot(os.path.join(directory, 'items.snapshot'), items_file, items, ItemsIndex(items), TeacherMatcher(items['teachers']))
+    print(f'API latency {latency * 1000:.0f} ms, snapshot written in {(time.perf_counter() - started) * 1000:.0f} ms')
+
+    run('current', directory, url)
+    run('snapshot', directory, url)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        child(*sys.argv[2:5])
+    else:
+        main()
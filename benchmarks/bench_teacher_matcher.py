@@ -0,0 +1,103 @@
+# Equivalence check and benchmark of TeacherMatcher against the original per-token match_teacher.
+# Run from the repository root: python benchmarks/bench_teacher_matcher.py
+import json, os, random, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fuzzywuzzy import fuzz, process
+from unidecode import unidecode
+from teacher_matcher import TeacherMatcher
+
+match_score = 70
+items = json.load(open('items.json'))
+unidecode_teachers = [unidecode(t.lower()) for t in items.get('teachers').values()]
+
+
+# The original implementation from main.py, without its debug output
+def match_teacher(search_string):
+    teacher_names = list(items.get('teachers').values())
+
+    fuzzy_matches = process.extract(search_string, teacher_names, limit=20)
+    unidecode_matches = process.extract(search_string, unidecode_teachers, limit=20)
+
+    partial_matches = []
+
+    if len(fuzzy_matches) > 1:
+        fuzzy_matches = [result[0] for result in fuzzy_matches if result[1] == fuzzy_matches[0][1]]
+        for m in fuzzy_matches:
+            score_1 = fuzz.ratio(m.split()[0], search_string)
+            score_2 = fuzz.ratio(m.split()[1], search_string)
+            if score_1 > match_score or score_2 > match_score:
+                partial_matches.append(m)
+
+    if len(unidecode_matches) > 1:
+        unidecode_matches = [result[0] for result in unidecode_matches if result[1] == unidecode_matches[0][1]]
+        for m in unidecode_matches:
+            teacher_name = teacher_names[unidecode_teachers.index(m)]
+            score_1 = fuzz.ratio(m.split()[0], search_string)
+            score_2 = fuzz.ratio(m.split()[1], search_string)
+            if (score_1 > match_score or score_2 > match_score) and teacher_name not in partial_matches:
+                partial_matches.append(teacher_name)
+
+    if len(partial_matches) > 1:
+        return partial_matches
+    elif len(partial_matches) == 1:
+        return partial_matches[0]
+    else:
+        return None
+
+
+# Tokens as users type them: plain words, exact name parts, ascii and lowercase variants and typos
+def build_corpus(rng):
+    words = 'what is my schedule for today tomorrow next week monday lecture with group room please show the exam'.split()
+    parts = [part for name in items['teachers'].values() for part in name.split()[:2]]
+    corpus = list(words)
+    for part in rng.sample(parts, 150):
+        corpus.append(part)
+        corpus.append(unidecode(part).lower())
+        position = rng.randrange(len(part))
+        corpus.append(part[:position] + part[position + 1:])
+        corpus.append(part[:position] + rng.choice('aeiostr') + part[position + 1:])
+    return corpus
+
+
+def main():
+    rng = random.Random(4201)
+    corpus = build_corpus(rng)
+
+    started = time.perf_counter()
+    matcher = TeacherMatcher(items['teachers'], match_score)
+    print(f'matcher build: {(time.perf_counter() - started) * 1000:.1f} ms')
+
+    mismatches = 0
+    for token in corpus:
+        expected = match_teacher(token)
+        actual = matcher.match(token)
+        if (list(actual) if type(actual) is tuple else actual) != expected:
+            mismatches += 1
+            print(f'mismatch for {token!r}: {expected!r} != {actual!r}')
+    print(f'{len(corpus)} tokens checked, {mismatches} mismatches')
+
+    # Messages mix plain words with names, and the same tokens repeat across messages
+    messages = [' '.join(rng.sample(corpus, 8)) for _ in range(200)]
+
+    started = time.perf_counter()
+    for text in messages:
+        for token in text.split():
+            match_teacher(token)
+    original = time.perf_counter() - started
+
+    cold = TeacherMatcher(items['teachers'], match_score)
+    started = time.perf_counter()
+    for text in messages:
+        cold.match_tokens(text.split())
+    matcher_time = time.perf_counter() - started
+
+    print(f'{len(messages)} messages: original {original * 1000:.0f} ms, matcher {matcher_time * 1000:.0f} ms, {original / matcher_time:.1f}x')
+    print(f'memo: {cold.match.cache_info()}')
+
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
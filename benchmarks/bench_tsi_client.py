@@ -0,0 +1,170 @@
+# Exercise TsiClient against a local stub of the schedule service that injects latency and failures, then check
+# its retries, backoff, timeouts, circuit breaker and stale responses against the stub in fixed modes.
+# Exits non-zero when a check fails.
+# Run from the repository root: python benchmarks/bench_tsi_client.py
+import json, os, random, sys, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+from tsi_client import CircuitBreaker, TsiClient, UpstreamError
+
+# Share of requests answered with a 500, requests that stall past the read timeout, and normal latency
+failure_rate = 0.2
+stall_rate = 0.05
+latency = 0.02
+stall = 2.0
+down = False
+# Fixed behaviour of the stub for the checks: None (random failures), 'ok', 'fail' (500) or 'stall'
+mode = None
+requests_seen = 0
+requests_lock = Lock()
+
+rng = random.Random(1)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        global requests_seen
+        with requests_lock:
+            requests_seen += 1
+        if mode is not None:
+            if mode == 'fail':
+                self.reply(500, b'error')
+                return
+            time.sleep(stall if mode == 'stall' else 0)
+            roll = 1.0
+        else:
+            roll = rng.random()
+        if down or roll < failure_rate:
+            self.reply(500, b'error')
+            return
+        time.sleep(stall if roll < failure_rate + stall_rate else latency)
+        inner = json.dumps({'events': {'values': [[1676476800, [206], [769], 15596, 'Math']]}})
+        self.reply(200, ('(' + json.dumps({'d': inner}) + ')').encode())
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def run(name, call, count=100):
+    failures = 0
+    durations = []
+    for _ in range(count):
+        started = time.perf_counter()
+        try:
+            call()
+        except Exception:
+            failures += 1
+        durations.append(time.perf_counter() - started)
+    durations.sort()
+    print(f'{name}: {failures}/{count} failed, p50 {durations[count // 2] * 1000:.0f} ms, '
+          f'p99 {durations[int(count * 0.99) - 1] * 1000:.0f} ms, total {sum(durations):.1f} s')
+
+
+def main():
+    global down
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_port}/'
+
+    def bare():
+        response = requests.get(base_url + 'GetLocalizedEvents', timeout=5)
+        if response.status_code != 200:
+            raise UpstreamError(response.status_code)
+
+    client = TsiClient(base_url, timeout=(0.5, 0.5), retries=2, backoff=0.05, breaker=CircuitBreaker(5, 1))
+    run('bare requests.get', bare)
+    run('TsiClient', lambda: client.get_events(1676476800, 1676484900))
+
+    # With the service down the breaker opens and the last good response is served without waiting on upstream
+    down = True
+    run('TsiClient, upstream down', lambda: client.get_events(1676476800, 1676484900))
+    print(f'circuit open: {client.breaker.is_open}')
+
+    failures = check_behaviour(base_url)
+    server.shutdown()
+    if failures:
+        print(f'{failures} checks failed')
+        sys.exit(1)
+
+
+# Time a call in seconds, with the number of requests the stub got meanwhile and the result or the exception raised
+def measure(call):
+    before = requests_seen
+    started = time.perf_counter()
+    try:
+        result = call()
+    except Exception as e:
+        result = e
+    return time.perf_counter() - started, requests_seen - before, result
+
+
+def check_behaviour(base_url):
+    global mode, down
+    down = False
+    failures = 0
+
+    def check(name, condition, detail=''):
+        nonlocal failures
+        print(f'{"ok  " if condition else "FAIL"} {name}' + (f' ({detail})' if detail else ''))
+        failures += not condition
+
+    def events(client, from_time=1676476800):
+        return client.get_events(from_time, from_time + 8100)
+
+    # Failed calls are retried `retries` times, with exponential backoff: 0.1 then 0.2 s, each with +-50% jitter
+    mode = 'fail'
+    client = TsiClient(base_url, timeout=(0.5, 0.5), retries=2, backoff=0.1, breaker=CircuitBreaker(100, 60))
+    seconds, count, result = measure(lambda: events(client))
+    check('failed call raises UpstreamError', isinstance(result, UpstreamError), repr(result))
+    check('failed call is sent 1 + retries times', count == 3, f'{count} requests')
+    check('retries back off exponentially', 0.15 <= seconds < 0.45 + 0.2, f'{seconds:.2f} s')
+
+    # A stalled response is abandoned after the read timeout, not after the stall
+    mode = 'stall'
+    client = TsiClient(base_url, timeout=(0.5, 0.3), retries=0, breaker=CircuitBreaker(100, 60))
+    seconds, count, result = measure(lambda: events(client))
+    check('stalled call times out', isinstance(result, UpstreamError) and seconds < stall / 2, f'{seconds:.2f} s, {result!r}')
+
+    # After failure_threshold failed calls the circuit opens and calls fail without a request,
+    # or get the last good response of the same call
+    mode = 'ok'
+    client = TsiClient(base_url, timeout=(0.5, 0.5), retries=0, breaker=CircuitBreaker(2, 0.5))
+    good = events(client)
+    mode = 'fail'
+    measure(lambda: events(client, 1))
+    check('circuit stays closed below the threshold', not client.breaker.is_open)
+    measure(lambda: events(client, 2))
+    check('circuit opens at the threshold', client.breaker.is_open)
+    seconds, count, result = measure(lambda: events(client, 3))
+    check('open circuit fails without a request', isinstance(result, UpstreamError) and count == 0, f'{count} requests, {result!r}')
+    seconds, count, result = measure(lambda: events(client))
+    check('open circuit serves the stale response', result == good and count == 0, f'{count} requests')
+
+    # After reset_timeout one trial call goes through: a failure opens the circuit again, a success closes it
+    time.sleep(0.6)
+    seconds, count, result = measure(lambda: events(client, 4))
+    check('half open circuit lets one trial call through', count == 1, f'{count} requests')
+    check('failed trial call opens the circuit again', client.breaker.is_open and measure(lambda: events(client, 5))[1] == 0)
+    time.sleep(0.6)
+    mode = 'ok'
+    seconds, count, result = measure(lambda: events(client, 6))
+    check('successful trial call closes the circuit', count == 1 and not isinstance(result, Exception) and not client.breaker.is_open,
+          f'{count} requests, {result!r}')
+    mode = None
+    return failures
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+# Throughput of the sharded webhook mode with 1, 2 and 4 worker processes.
+# webhook.py runs as a subprocess against a fake Bot API and a fake schedule service answering without
+# latency, and updates are posted to it by many concurrent clients. The messages are schedule questions
+# the local intent classifier answers for distinct groups and days, so handling them is CPU bound and
+# throughput should grow with the workers up to the number of cores. The metrics endpoint of the coordinator
+# must count the messages handled by all workers. Exits non-zero on failure.
+# Run from the repository root: python benchmarks/bench_webhook.py [number of chats] [worker counts...]
+import json, os, re, shutil, signal, socket, subprocess, sys, tempfile, time
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler
+from random import Random
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from load_test import FakeTelegram, serve
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+token = '123456:bench'
+days = ['today', 'tomorrow', 'on monday', 'on tuesday', 'on wednesday', 'on thursday', 'on friday']
+client_threads = 32
+# The fake Bot API has no limits, so replies are sent as fast as they are handled rather than at Telegram's 30 per second
+send_rate = 100000
+# Events in every schedule response, spread over the requested day
+events_per_response = 12
+
+
+# Fake schedule service: the items never change, prefetching fails, events requests are answered right away
+class FakeTsi(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        groups = [int(g) for g in params.get('groups', '').strip("'").split(',') if g]
+        if url.path.endswith('/GetItems'):
+            self.answer(304, b'')
+        elif not groups:
+            self.answer(503, b'')
+        else:
+            start = int(params.get('from', 0))
+            values = [[start + 1800 * (i + 16), [206], groups[:3], 15596, f'Subject {i}'] for i in range(events_per_response)]
+            self.answer(200, ('(' + json.dumps({'d': json.dumps({'events': {'values': values}})}) + ')').encode())
+
+    def answer(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def post_update(port, update_id, chat_id, text):
+    body = json.dumps({'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': int(time.time()), 'text': text,
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Student'}}}).encode()
+    while True:
+        connection = HTTPConnection('127.0.0.1', port, timeout=30)
+        try:
+            connection.request('POST', f'/{token}', body, {'Content-Type': 'application/json'})
+            status = connection.getresponse().status
+        except OSError:
+            status = None
+        finally:
+            connection.close()
+        if status == 200:
+            return
+        # Refused while the queues are full, or not listening yet: deliver again like Telegram does
+        time.sleep(0.05)
+
+
+def wait_for_replies(telegram, chat_ids, timeout):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        with telegram.lock:
+            if all(chat_id in telegram.sent for chat_id in chat_ids):
+                return True
+        time.sleep(0.01)
+    return False
+
+
+# Count of handled messages in the metrics the coordinator exports, once it reached at least expected
+def handled_messages(port, expected, timeout=30):
+    deadline = time.perf_counter() + timeout
+    count = None
+    while time.perf_counter() < deadline:
+        connection = HTTPConnection('127.0.0.1', port, timeout=10)
+        try:
+            connection.request('GET', '/metrics')
+            text = connection.getresponse().read().decode()
+        except OSError:
+            text = ''
+        finally:
+            connection.close()
+        match = re.search(r'^tsi_bot_stage_seconds_count\{stage="handle_message"\} (\d+)$', text, re.M)
+        count = int(match.group(1)) if match else None
+        if count is not None and count >= expected:
+            break
+        time.sleep(0.5)
+    return count
+
+
+def run(workers, messages, tsi_port):
+    telegram = FakeTelegram()
+    telegram_server = serve(telegram.handler())
+    directory = tempfile.mkdtemp()
+    shutil.copy(os.path.join(root, 'items.json'), directory)
+    port, metrics_port = free_port(), free_port()
+    env = dict(os.environ, TSI_BOT_METRICS_PORT=str(metrics_port), TSI_BOT_KEY=token, TSI_BOT_WORKERS=str(workers), TSI_WEBHOOK_HOST='127.0.0.1', TSI_WEBHOOK_PORT=str(port),
+               TSI_BOT_API_URL=f'http://127.0.0.1:{telegram_server.server_port}/bot{{0}}/{{1}}', TSI_SCHEDULE_URL=f'http://127.0.0.1:{tsi_port}/',
+               TSI_BOT_DATABASE=os.path.join(directory, 'students.db'), TSI_BOT_LOG_LEVEL='WARNING', TSI_BOT_SEND_RATE=str(send_rate))
+    process = subprocess.Popen([sys.executable, os.path.join(root, 'webhook.py')], cwd=directory, env=env)
+
+    try:
+        with open(os.path.join(root, 'items.json')) as file:
+            groups = sorted({group for group in json.load(file)['groups'].values() if re.fullmatch(r'\d{4}[A-Z]+', group)})
+        rng = Random(workers)
+
+        # Warm up every worker: chats 1..workers land on distinct shards
+        warm_up = list(range(1, workers + 1))
+        for chat_id in warm_up:
+            post_update(port, chat_id, chat_id, f'schedule {groups[0]} today')
+        if not wait_for_replies(telegram, warm_up, 120):
+            print(f'{workers} workers: no reply to the warm up messages')
+            return None, False
+
+        chat_ids = list(range(1000, 1000 + messages))
+        started = time.perf_counter()
+        with ThreadPoolExecutor(client_threads) as executor:
+            for update_id, chat_id in enumerate(chat_ids, 1000):
+                executor.submit(post_update, port, update_id, chat_id, f'schedule {rng.choice(groups)} {rng.choice(days)}')
+        posted = time.perf_counter() - started
+        answered = wait_for_replies(telegram, chat_ids, 300)
+        duration = time.perf_counter() - started
+
+        latencies = sorted(telegram.sent[chat_id][0] - started for chat_id in chat_ids if chat_id in telegram.sent)
+        print(f'{workers} workers: {len(latencies)}/{messages} answered in {duration:.2f} s, {len(latencies) / duration:.0f} msg/s '
+              f'(posted in {posted:.2f} s){"" if answered else ", timed out"}')
+        counted = handled_messages(metrics_port, messages + workers)
+        print(f'{workers} workers: {counted} handled messages in the metrics of the coordinator')
+        if counted != messages + workers:
+            print(f'{workers} workers: expected {messages + workers} handled messages in the metrics')
+            return None, False
+        return len(latencies) / duration, answered
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(60)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        telegram_server.shutdown()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    counts = [int(count) for count in sys.argv[2:]] or [1, 2, 4]
+    tsi_server = serve(FakeTsi)
+    print(f'{os.cpu_count()} cores')
+
+    rates = {}
+    failed = False
+    for workers in counts:
+        rates[workers], passed = run(workers, messages, tsi_server.server_port)
+        failed = failed or not passed
+    if rates.get(counts[0]):
+        print('Speedup: ' + ', '.join(f'{workers} workers {rate / rates[counts[0]]:.2f}x' for workers, rate in rates.items() if rate))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
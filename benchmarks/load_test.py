@@ -0,0 +1,182 @@
+# Load test of the polling and async runtimes against fake local Telegram, Dialogflow and TSI services.
+# Run from the repository root: python benchmarks/load_test.py [polling|async] [number of chats]
+import json, os, sys, tempfile, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Condition, Lock, Thread
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('TSI_BOT_KEY', '123456:load-test')
+
+import asyncio, telebot
+import main
+from async_runtime import AsyncRuntime
+from conversations import ConversationStore
+from database import StudentGroupCache
+from lookup import ItemsIndex
+from reply_cache import ReplyCache
+from schedule_cache import ScheduleCache
+from teacher_matcher import TeacherMatcher
+from tsi_client import TsiClient
+
+# Simulated latencies of the upstream services, in seconds
+dialogflow_latency = 0.15
+tsi_latency = 0.4
+
+
+# Fake Bot API: hands out queued updates on getUpdates and records every sent message
+class FakeTelegram:
+    def __init__(self):
+        self.updates = []
+        self.sent = {}
+        self.injected = {}
+        self.condition = Condition()
+        self.lock = Lock()
+
+    def inject(self, chat_id, text):
+        with self.condition:
+            update_id = len(self.injected) + 1
+            self.injected[chat_id] = time.perf_counter()
+            self.updates.append({'update_id': update_id, 'message': {
+                'message_id': update_id, 'date': int(time.time()), 'text': text,
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Student'}}})
+            self.condition.notify_all()
+
+    def get_updates(self, offset, timeout):
+        with self.condition:
+            self.condition.wait_for(lambda: any(u['update_id'] >= offset for u in self.updates), timeout=timeout)
+            return [u for u in self.updates if u['update_id'] >= offset]
+
+    # Record when the schedule reached the chat, the date may come before it or merged into the same message
+    def record(self, chat_id, text):
+        if 'Room:' in text or 'No events found' in text:
+            with self.lock:
+                self.sent.setdefault(chat_id, []).append(time.perf_counter())
+
+    def handler(self):
+        telegram = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.handle_call()
+
+            def do_POST(self):
+                self.handle_call()
+
+            def handle_call(self):
+                url = urlparse(self.path)
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    params.update({k: v[0] for k, v in parse_qs(self.rfile.read(length).decode()).items()})
+                method = url.path.rsplit('/', 1)[-1]
+
+                if method == 'getUpdates':
+                    result = telegram.get_updates(int(params.get('offset') or 0), min(float(params.get('timeout') or 1), 1))
+                elif method == 'sendMessage':
+                    telegram.record(int(params['chat_id']), params.get('text', ''))
+                    result = {'message_id': 1, 'date': int(time.time()), 'chat': {'id': int(params['chat_id']), 'type': 'private'}, 'text': params.get('text', '')}
+                elif method == 'getMe':
+                    result = {'id': 123456, 'is_bot': True, 'first_name': 'Bot', 'username': 'load_test_bot'}
+                else:
+                    result = True
+
+                body = json.dumps({'ok': True, 'result': result}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+# Fake schedule service answering every events request after tsi_latency
+class FakeTsi(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        time.sleep(tsi_latency)
+        params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+        groups = [int(g) for g in params.get('groups', '').strip("'").split(',') if g]
+        start = int(params.get('from', 0))
+        values = [[start + 3600 * (i + 8), [206], groups[:3], 15596, 'Mathematics'] for i in range(6)]
+        body = ('(' + json.dumps({'d': json.dumps({'events': {'values': values}})}) + ')').encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+# Fake Dialogflow: every message asks for today's schedule of a group
+def fake_detect_intent(text, session_id):
+    time.sleep(dialogflow_latency)
+    return {'queryResult': {'intent': {'displayName': 'CheckSchedule'}, 'fulfillmentText': '',
+                            'parameters': {'date-time': time.strftime('%Y-%m-%dT12:00:00+02:00'), 'group-text': '4201BDA'}}}
+
+
+def serve(handler):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main_load_test(mode, chats):
+    telegram = FakeTelegram()
+    telegram_server = serve(telegram.handler())
+    tsi_server = serve(FakeTsi)
+    telebot.apihelper.API_URL = f'http://127.0.0.1:{telegram_server.server_port}/bot{{0}}/{{1}}'
+
+    main.items = json.load(open('items.json'))
+    main.items_index = ItemsIndex(main.items)
+    main.teacher_matcher = TeacherMatcher(main.items['teachers'], main.match_score)
+    main.DATABASE_FILE = os.path.join(tempfile.mkdtemp(), 'students.db')
+    main.student_groups = StudentGroupCache(main.DATABASE_FILE)
+    main.conversations = main.bot.next_step_backend = ConversationStore(main.DATABASE_FILE, main.conversation_ttl, steps=main.conversations.steps)
+    main.tsi_client = TsiClient(f'http://127.0.0.1:{tsi_server.server_port}/', retries=0, max_concurrency=main.tsi_concurrency)
+    # Every request goes upstream, as with distinct groups and dates
+    main.schedule_cache = ScheduleCache(main.fetch_events, ttl=0)
+    main.reply_cache = ReplyCache(ttl=0)
+    main.detect_intent = fake_detect_intent
+
+    if mode == 'async':
+        runtime = AsyncRuntime(main.bot, workers=main.handler_workers, poll_timeout=1)
+        runner = Thread(target=lambda: asyncio.run(runtime.run()), daemon=True)
+        stop = runtime.stop
+    else:
+        runner = Thread(target=lambda: main.bot.polling(non_stop=True, timeout=1, long_polling_timeout=1), daemon=True)
+        stop = main.bot.stop_polling
+    runner.start()
+    time.sleep(0.5)
+
+    started = time.perf_counter()
+    for chat_id in range(1, chats + 1):
+        # A message the local intent classifier defers to Dialogflow
+        telegram.inject(chat_id, 'what do I have with Abramova today')
+
+    deadline = started + 600
+    while time.perf_counter() < deadline:
+        with telegram.lock:
+            if len(telegram.sent) >= chats:
+                break
+        time.sleep(0.05)
+    duration = time.perf_counter() - started
+    stop()
+
+    latencies = sorted(telegram.sent[c][0] - telegram.injected[c] for c in telegram.sent)
+    if not latencies:
+        print(f'{mode}: no replies')
+        return
+    print(f'{mode}: {len(latencies)}/{chats} chats answered in {duration:.1f} s, {len(latencies) / duration:.1f} msg/s, '
+          f'p50 {latencies[len(latencies) // 2] * 1000:.0f} ms, p99 {latencies[max(int(len(latencies) * 0.99) - 1, 0)] * 1000:.0f} ms')
+
+
+if __name__ == '__main__':
+    main_load_test(sys.argv[1] if len(sys.argv) > 1 else 'async', int(sys.argv[2]) if len(sys.argv) > 2 else 200)
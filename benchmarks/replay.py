@@ -0,0 +1,271 @@
+# Replay a corpus of recorded messages through the bot's message pipeline, offline.
+# Every corpus line holds one incoming message with what the services answered to it, and the replies the bot sent:
+#   {"chat_id": 1, "text": "...", "now": "2024-02-12T09:00:00+02:00", "group": "4201BDA" or null,
+#    "dialogflow": queryResult or null, "tsi": raw GetLocalizedEvents response or null, "expected": [[method, chat_id, text, markup]]}
+# Updates go through bot.process_new_updates, so next step handlers work as in production. Dialogflow, the
+# schedule service and the Bot API are replaced by fakes answering from the corpus, and the local intent
+# classifier uses the recorded time. The replies are compared with the expected ones, then the corpus is replayed
+# again for per stage timings, throughput and memory.
+# Run from the repository root:
+#   python benchmarks/replay.py [corpus]               check the replies and report timings
+#   python benchmarks/replay.py --record [corpus]      store the current replies as the expected ones
+#   python benchmarks/replay.py --generate N [corpus]  write a synthetic corpus of N messages from items.json, then record it
+import json, os, random, re, resource, sys, tempfile, time, tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('TSI_BOT_KEY', '123456:replay')
+
+import telebot
+import main
+from conversations import ConversationStore
+from database import StudentGroupCache, replace_groups
+from intents import LocalIntentClassifier
+from lookup import ItemsIndex
+from metrics import registry
+from renderer import riga
+from reply_cache import ReplyCache
+from schedule_cache import ScheduleCache
+from teacher_matcher import TeacherMatcher
+from tsi_client import TsiClient
+
+default_corpus = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'replay_corpus.jsonl')
+
+
+# Captures the Bot API calls the handlers queue, instead of the dispatcher
+class RecordingOutbox:
+    def __init__(self):
+        self.calls = []
+
+    def send_message(self, chat_id, text, bulk=False, reply_markup=None, **kwargs):
+        self.calls.append(['sendMessage', chat_id, text, reply_markup.to_json() if reply_markup else None])
+
+    def submit(self, chat_id, function, *args, **kwargs):
+        self.calls.append([function.__name__, chat_id, None, None])
+
+    def stats(self):
+        return {'calls': len(self.calls)}
+
+
+class FakeResponse:
+    def __init__(self, content):
+        self.status_code = 200 if content is not None else 500
+        self.content = content.encode() if content is not None else b''
+        self.headers = {}
+
+
+# Session answering every schedule service request with the response recorded for the current message
+class FakeSession:
+    def __init__(self):
+        self.content = None
+        self.requests = 0
+
+    def get(self, url, params=None, headers=None, timeout=None):
+        self.requests += 1
+        return FakeResponse(self.content)
+
+    def mount(self, *args):
+        pass
+
+
+# The local classifier, deciding as if it were the time the message was recorded at
+class ReplayClassifier(LocalIntentClassifier):
+    now = None
+
+    def classify(self, text, now=None):
+        return super().classify(text, now or self.now)
+
+
+class Replay:
+    def __init__(self):
+        self.outbox = RecordingOutbox()
+        self.session = FakeSession()
+        self.record = None
+
+        main.bot.threaded = False
+        main.items = json.load(open('items.json'))
+        main.items_index = ItemsIndex(main.items)
+        main.teacher_matcher = TeacherMatcher(main.items['teachers'], main.match_score)
+        main.DATABASE_FILE = os.path.join(tempfile.mkdtemp(), 'students.db')
+        replace_groups(main.DATABASE_FILE, main.items['groups'].values())
+        main.student_groups = StudentGroupCache(main.DATABASE_FILE)
+        main.conversations = main.bot.next_step_backend = ConversationStore(main.DATABASE_FILE, main.conversation_ttl, steps=main.conversations.steps)
+        main.outbox = self.outbox
+        main.tsi_client = TsiClient('http://tsi.invalid/', retries=0)
+        main.tsi_client.session = self.session
+        main.detect_intent = self.detect_intent
+        main.intent_classifier = ReplayClassifier(lambda text: main.find_group_key(text) is not None)
+        self.update_id = 0
+
+    def detect_intent(self, text, session_id):
+        if not self.record.get('dialogflow'):
+            raise RuntimeError(f'No Dialogflow result recorded for {text!r}')
+        return {'queryResult': self.record['dialogflow']}
+
+    def update(self, record):
+        self.update_id += 1
+        return telebot.types.Update.de_json({'update_id': self.update_id, 'message': {
+            'message_id': self.update_id, 'date': 0, 'text': record['text'],
+            'chat': {'id': record['chat_id'], 'type': 'private'},
+            'from': {'id': record['chat_id'], 'is_bot': False, 'first_name': 'Student'}}})
+
+    # Handle one recorded message and return the calls the bot made
+    def play(self, record):
+        self.record = record
+        self.session.content = record.get('tsi')
+        main.intent_classifier.now = datetime.fromisoformat(record['now']).astimezone(riga)
+        # Every message asks the service again, as with distinct groups and dates
+        main.schedule_cache = ScheduleCache(main.fetch_events, ttl=0)
+        main.reply_cache = ReplyCache(ttl=0)
+        if record.get('group'):
+            main.student_groups.set(record['chat_id'], record['group'])
+
+        self.outbox.calls = []
+        main.bot.process_new_updates([self.update(record)])
+        return self.outbox.calls
+
+
+def load(corpus):
+    with open(corpus, encoding='utf-8') as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def save(corpus, records):
+    with open(corpus, 'w', encoding='utf-8') as file:
+        for record in records:
+            file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+def check(records):
+    replay = Replay()
+    mismatches = 0
+    for number, record in enumerate(records, 1):
+        calls = replay.play(record)
+        if calls != record.get('expected'):
+            mismatches += 1
+            if mismatches <= 5:
+                print(f'Mismatch on line {number} ({record["text"]!r}):\n  expected {record.get("expected")}\n  got      {calls}')
+    print(f'{len(records) - mismatches}/{len(records)} messages answered as recorded')
+    return mismatches == 0
+
+
+def measure(records, rounds=5):
+    replay = Replay()
+    for record in records:
+        replay.play(record)
+
+    registry.reset()
+    durations = []
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for record in records:
+            message_started = time.perf_counter()
+            replay.play(record)
+            durations.append(time.perf_counter() - message_started)
+    elapsed = time.perf_counter() - started
+
+    durations.sort()
+    print(f'{len(durations)} messages in {elapsed:.2f} s, {len(durations) / elapsed:.0f} msg/s, '
+          f'p50 {durations[len(durations) // 2] * 1000:.2f} ms, p99 {durations[int(len(durations) * 0.99)] * 1000:.2f} ms')
+    print('Stage: count, mean ms')
+    for stage, values in sorted(registry.snapshot()['stages'].items()):
+        print(f'  {stage}: {values["count"]}, {values["mean"] * 1000:.3f}')
+
+    tracemalloc.start()
+    for record in records:
+        replay.play(record)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'Memory: peak {peak / 1024:.0f} KiB allocated during one round, max RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB')
+
+
+def events_response(rng, group_ids, items, start):
+    rooms = [int(key) for key in items['rooms']]
+    teachers = [int(key) for key in items['teachers']]
+    values = []
+    for day in range(rng.randrange(1, 6)):
+        for slot in rng.sample(range(8), rng.randrange(0, 5)):
+            groups = rng.sample(group_ids, min(len(group_ids), rng.randrange(1, 3)))
+            values.append([start + day * 86400 + 3600 * (8 + slot * 2) - 7200, [rng.choice(rooms)] if rng.random() > 0.1 else [],
+                           groups, rng.choice(teachers), rng.choice(['Mathematics', 'Programming', 'Physics', 'Databases', 'English'])])
+    values.sort(key=lambda event: event[0])
+    return '(' + json.dumps({'d': json.dumps({'events': {'values': values}})}) + ')'
+
+
+# Synthetic corpus: schedule questions answered locally and by Dialogflow, group selection flows,
+# unknown groups and small talk, for groups and teachers taken from items.json
+def generate(count, seed=1):
+    rng = random.Random(seed)
+    items = json.load(open('items.json'))
+    index = ItemsIndex(items)
+    groups = [group for group in items['groups'].values() if group[:1].isdecimal()]
+    teachers = list(items['teachers'].values())
+    base = datetime.fromisoformat('2024-02-12T08:30:00+02:00')
+    records = []
+    chat_id = 1000
+    while len(records) < count:
+        chat_id += 1
+        now = base + timedelta(days=rng.randrange(60), minutes=rng.randrange(600))
+        group = rng.choice(groups)
+        group_key = index.find_group_key(group)
+        match = re.match(r'(\d+)-?(\w+)', group)
+        family = [int(index.find_group_key(g)) for g in index.group_family(*match.groups())] if match else [int(group_key)]
+        day_start = int(now.replace(hour=0, minute=0, second=0).timestamp())
+        record = {'chat_id': chat_id, 'now': now.isoformat(), 'group': group, 'dialogflow': None, 'tsi': None}
+        kind = rng.random()
+
+        if kind < 0.3:
+            record['text'] = rng.choice(['schedule today', 'schedule tomorrow', 'timetable', 'what is my schedule for monday',
+                                         f'schedule {group}', 'lessons next week'])
+            record['tsi'] = events_response(rng, family, items, day_start)
+        elif kind < 0.6:
+            teacher = rng.choice(teachers)
+            record['text'] = f'what do I have with {teacher.split()[0]} {rng.choice(["today", "on friday", "this week"])}'
+            record['dialogflow'] = {'intent': {'displayName': 'CheckSchedule'}, 'fulfillmentText': '', 'intentDetectionConfidence': 0.9,
+                                    'parameters': {'date-time': now.replace(hour=12, minute=0).isoformat(), 'group-text': ''}}
+            record['tsi'] = events_response(rng, family, items, day_start)
+        elif kind < 0.7:
+            record['group'] = None if rng.random() < 0.5 else group
+            records.append(dict(record, text='/selectgroup'))
+            record = dict(record, group=None, text=rng.choice([group, group.lower(), group[:4], 'cancel', 'zz']))
+        elif kind < 0.8:
+            record['text'] = 'schedule 9999XYZ'
+            record['dialogflow'] = {'intent': {'displayName': 'CheckSchedule'}, 'fulfillmentText': '', 'intentDetectionConfidence': 0.8,
+                                    'parameters': {'date-time': now.isoformat(), 'group-text': '9999XYZ'}}
+        elif kind < 0.9:
+            start = now.replace(hour=0, minute=0, second=0)
+            record['text'] = 'what do I have from monday to wednesday'
+            record['dialogflow'] = {'intent': {'displayName': 'CheckSchedule'}, 'fulfillmentText': '', 'intentDetectionConfidence': 0.9,
+                                    'parameters': {'date-period': {'startDate': start.isoformat(), 'endDate': (start + timedelta(days=2, hours=23)).isoformat()},
+                                                   'group-text': group}}
+            record['tsi'] = events_response(rng, family, items, day_start)
+        else:
+            record['text'] = rng.choice(['hello', 'thanks!', 'who are you?'])
+            record['dialogflow'] = {'intent': {'displayName': 'Default Welcome Intent'}, 'parameters': {}, 'intentDetectionConfidence': 1.0,
+                                    'fulfillmentText': 'Hi! How can I help you?'}
+        records.append(record)
+    return records[:count]
+
+
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
+    if arguments[:1] == ['--generate']:
+        corpus = arguments[2] if len(arguments) > 2 else default_corpus
+        records = generate(int(arguments[1]))
+        arguments = ['--record', corpus]
+        save(corpus, records)
+
+    if arguments[:1] == ['--record']:
+        corpus = arguments[1] if len(arguments) > 1 else default_corpus
+        records = load(corpus)
+        replay = Replay()
+        for record in records:
+            record['expected'] = replay.play(record)
+        save(corpus, records)
+        print(f'Recorded the replies to {len(records)} messages in {corpus}')
+    else:
+        corpus = arguments[0] if arguments else default_corpus
+        records = load(corpus)
+        ok = check(records)
+        measure(records)
+        sys.exit(0 if ok else 1)
@@ -0,0 +1,92 @@
+import json, threading, time
+from collections import OrderedDict
+from telebot import Handler
+from telebot.handler_backends import HandlerBackend
+import database
+
+
+# Next step handlers of telebot kept in the conversations table, so that a chat
+# asked for its group still gets its answer handled after a restart or by another
+# process. Functions cannot be stored, so each step is stored by the name of a
+# function registered with add_steps, with its extra arguments as JSON.
+# A chat waits for one step at a time and the step expires after ttl seconds.
+# Recently seen chats are kept in a bounded in-memory front, including chats
+# without a pending step, so most messages are answered without a query. The
+# front is only coherent while every chat is handled by a single process, as
+# with the webhook mode's sharding by chat.
+class ConversationStore(HandlerBackend):
+    _missing = object()
+
+    def __init__(self, database_file, ttl=3600, max_entries=100000, steps=None):
+        super().__init__()
+        self.database_file = database_file
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.steps = dict(steps or {})
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    # Allow the functions to be registered as next steps
+    def add_steps(self, *functions):
+        for function in functions:
+            self.steps[function.__name__] = function
+
+    def _put(self, chat_id, entry):
+        self.entries[chat_id] = entry
+        self.entries.move_to_end(chat_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def register_handler(self, chat_id, handler):
+        name = handler.callback.__name__
+        if self.steps.get(name) is not handler.callback:
+            raise ValueError(f'{name} is not a registered conversation step')
+        arguments = json.dumps([handler.args, handler.kwargs]) if handler.args or handler.kwargs else None
+        expires = int(time.time()) + self.ttl
+        database.set_conversation(self.database_file, chat_id, name, arguments, expires)
+        with self.lock:
+            self._put(chat_id, (name, arguments, expires))
+
+    def clear_handlers(self, chat_id):
+        database.delete_conversation(self.database_file, chat_id)
+        with self.lock:
+            self._put(chat_id, None)
+
+    # Called by telebot for every message: take the pending step of the chat, if any
+    def get_handlers(self, chat_id):
+        with self.lock:
+            entry = self.entries.get(chat_id, self._missing)
+            if entry is self._missing:
+                self.misses += 1
+            else:
+                self.hits += 1
+            self._put(chat_id, None)
+
+        if entry is self._missing:
+            entry = database.pop_conversation(self.database_file, chat_id)
+        elif entry is not None:
+            database.delete_conversation(self.database_file, chat_id)
+        if entry is None:
+            return None
+
+        name, arguments, expires = entry
+        step = self.steps.get(name)
+        if expires <= time.time() or step is None:
+            with self.lock:
+                self.expired += 1
+            return None
+        args, kwargs = json.loads(arguments) if arguments else ((), {})
+        return [Handler(step, *args, **kwargs)]
+
+    # Delete the steps that expired without an answer, the front forgets them by itself
+    def purge(self):
+        return database.delete_expired_conversations(self.database_file, int(time.time()))
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'expired': self.expired,
+                    'hit_rate': self.hits / total if total else 0.0}
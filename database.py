@@ -0,0 +1,273 @@
+import sqlite3, threading
+from collections import OrderedDict
+
+# Version of the schema created by migrate, stored in PRAGMA user_version
+SCHEMA_VERSION = 4
+
+_local = threading.local()
+_migrated = set()
+_migrate_lock = threading.Lock()
+
+
+# Return this thread's connection to the database, opening it on first use.
+# Connections stay open for the lifetime of the thread and use WAL journaling,
+# so readers in handler threads do not block on the background writers.
+def get_connection(database_file):
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+
+    conn = connections.get(database_file)
+    if conn is None:
+        conn = sqlite3.connect(database_file, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        connections[database_file] = conn
+        with _migrate_lock:
+            if database_file not in _migrated:
+                migrate(conn)
+                _migrated.add(database_file)
+    return conn
+
+
+def _table_exists(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (name,)).fetchone() is not None
+
+
+# Bring the schema up to SCHEMA_VERSION.
+# Version 1 makes chat_id the primary key of students, keeping the last row of
+# duplicated chats, makes group_number the primary key of groups and adds a
+# trigram full text index for group substring search.
+# Version 2 adds the notification subscriptions of students.
+# Version 3 adds the pending conversation step of each chat.
+# Version 4 numbers the group changes of students, to find the most recent ones.
+def migrate(conn):
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+        return
+
+    # Run the whole migration in one explicit transaction, since DDL statements do not open one implicitly
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            conn.rollback()
+            return
+
+        if version < 1:
+            conn.execute("CREATE TABLE students_new (chat_id INTEGER PRIMARY KEY, group_number TEXT)")
+            if _table_exists(conn, 'students'):
+                conn.execute("INSERT OR REPLACE INTO students_new (chat_id, group_number) SELECT chat_id, group_number FROM students ORDER BY rowid")
+                conn.execute("DROP TABLE students")
+            conn.execute("ALTER TABLE students_new RENAME TO students")
+            conn.execute("CREATE INDEX students_group_number ON students (group_number)")
+
+            conn.execute("CREATE TABLE groups_new (group_number TEXT PRIMARY KEY) WITHOUT ROWID")
+            if _table_exists(conn, 'groups'):
+                conn.execute("INSERT OR IGNORE INTO groups_new (group_number) SELECT group_number FROM groups WHERE group_number IS NOT NULL")
+                conn.execute("DROP TABLE groups")
+            conn.execute("ALTER TABLE groups_new RENAME TO groups")
+
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS groups_fts USING fts5(group_number, tokenize='trigram')")
+            conn.execute("DELETE FROM groups_fts")
+            conn.execute("INSERT INTO groups_fts (group_number) SELECT group_number FROM groups")
+
+        if version < 2:
+            # Hour of the daily digest in Riga time and minutes of the reminder before each class, NULL when disabled
+            conn.execute("CREATE TABLE subscriptions (chat_id INTEGER PRIMARY KEY, digest_hour INTEGER, reminder_minutes INTEGER)")
+
+        if version < 3:
+            # Name of the function handling the chat's next message, its extra arguments as JSON and the expiry time
+            conn.execute("CREATE TABLE conversations (chat_id INTEGER PRIMARY KEY, step TEXT NOT NULL, arguments TEXT, expires INTEGER NOT NULL)")
+            conn.execute("CREATE INDEX conversations_expires ON conversations (expires)")
+
+        if version < 4:
+            # Sequence number of the last change of the student's group, 0 for changes made before this version
+            conn.execute("ALTER TABLE students ADD COLUMN updated INTEGER NOT NULL DEFAULT 0")
+            conn.execute("CREATE INDEX students_updated ON students (updated)")
+
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def get_student_group(database_file, chat_id):
+    row = get_connection(database_file).execute("SELECT group_number FROM students WHERE chat_id = ?", (chat_id,)).fetchone()
+    return row[0] if row else None
+
+
+# Store the group of a student, inserting or updating their row in one statement with the next sequence number
+def set_student_group(database_file, chat_id, group):
+    conn = get_connection(database_file)
+    with conn:
+        conn.execute("INSERT INTO students (chat_id, group_number, updated) VALUES (?, ?, (SELECT COALESCE(MAX(updated), 0) + 1 FROM students)) "
+                     "ON CONFLICT (chat_id) DO UPDATE SET group_number = excluded.group_number, updated = excluded.updated", (chat_id, group))
+
+
+def group_exists(database_file, group):
+    return get_connection(database_file).execute("SELECT 1 FROM groups WHERE group_number = ?", (group,)).fetchone() is not None
+
+
+# Return the groups containing the search term, ignoring case.
+# Terms of three or more characters use the trigram index, shorter ones fall back to LIKE.
+def search_groups(database_file, term):
+    conn = get_connection(database_file)
+    if len(term) >= 3:
+        rows = conn.execute("SELECT group_number FROM groups_fts WHERE group_number MATCH ? ORDER BY group_number",
+                            ('"' + term.replace('"', '""') + '"',))
+    else:
+        rows = conn.execute("SELECT group_number FROM groups WHERE group_number LIKE ? ORDER BY group_number",
+                            ('%' + term + '%',))
+    return [row[0] for row in rows]
+
+
+# Replace all groups in a single transaction. The search index is dropped and filled again from the
+# groups table in one statement, which is cheaper than deleting and inserting its rows one by one.
+def replace_groups(database_file, groups):
+    conn = get_connection(database_file)
+    groups = [(group,) for group in dict.fromkeys(groups)]
+    with conn:
+        conn.execute("DELETE FROM groups")
+        conn.executemany("INSERT INTO groups (group_number) VALUES (?)", groups)
+        conn.execute("DROP TABLE groups_fts")
+        conn.execute("CREATE VIRTUAL TABLE groups_fts USING fts5(group_number, tokenize='trigram')")
+        conn.execute("INSERT INTO groups_fts (group_number) SELECT group_number FROM groups")
+
+
+# Bounded in-memory cache of chat_id -> group in front of the students table.
+# Reads are answered from memory after the first lookup, including for chats
+# without a group, writes go to the database and the cache together, and the
+# least recently used chats are evicted once max_entries is reached. Every set
+# bumps a generation, so a database read that raced with a write is not cached.
+class StudentGroupCache:
+    _missing = object()
+
+    def __init__(self, database_file, max_entries=100000):
+        self.database_file = database_file
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+
+    def _put(self, chat_id, group):
+        self.entries[chat_id] = group
+        self.entries.move_to_end(chat_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, chat_id):
+        with self.lock:
+            group = self.entries.get(chat_id, self._missing)
+            if group is not self._missing:
+                self.entries.move_to_end(chat_id)
+                self.hits += 1
+                return group
+            self.misses += 1
+            generation = self.generation
+
+        group = get_student_group(self.database_file, chat_id)
+        with self.lock:
+            if self.generation == generation and chat_id not in self.entries:
+                self._put(chat_id, group)
+        return group
+
+    def set(self, chat_id, group):
+        set_student_group(self.database_file, chat_id, group)
+        with self.lock:
+            self.generation += 1
+            self._put(chat_id, group)
+
+    # Load up to max_entries students, whose group was set most recently first, so the first requests after a
+    # restart hit the cache. With shard = (index, count) only the chats with chat_id % count == index are loaded,
+    # the ones a webhook worker serves.
+    def warm(self, shard=None):
+        where, params = '', ()
+        if shard is not None:
+            # SQLite keeps the sign of the dividend, Python's % is never negative like chat IDs of groups
+            where, params = 'WHERE (chat_id % ? + ?) % ? = ? ', (shard[1], shard[1], shard[1], shard[0])
+        rows = get_connection(self.database_file).execute(
+            f"SELECT chat_id, group_number FROM students {where}ORDER BY updated DESC, chat_id DESC LIMIT ?",
+            params + (self.max_entries,)).fetchall()
+        with self.lock:
+            for chat_id, group in reversed(rows):
+                if chat_id not in self.entries:
+                    self._put(chat_id, group)
+        return len(rows)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / total if total else 0.0}
+
+
+def count_groups(database_file):
+    return get_connection(database_file).execute("SELECT COUNT(*) FROM groups").fetchone()[0]
+
+
+# Apply added and removed group names in a single transaction
+def update_groups(database_file, added, removed):
+    conn = get_connection(database_file)
+    with conn:
+        conn.executemany("DELETE FROM groups WHERE group_number = ?", [(group,) for group in removed])
+        conn.executemany("DELETE FROM groups_fts WHERE group_number = ?", [(group,) for group in removed])
+        conn.executemany("INSERT OR IGNORE INTO groups (group_number) VALUES (?)", [(group,) for group in added])
+        conn.executemany("INSERT INTO groups_fts (group_number) VALUES (?)", [(group,) for group in added])
+
+
+def set_subscription(database_file, chat_id, digest_hour, reminder_minutes):
+    conn = get_connection(database_file)
+    with conn:
+        conn.execute("INSERT INTO subscriptions (chat_id, digest_hour, reminder_minutes) VALUES (?, ?, ?) "
+                     "ON CONFLICT (chat_id) DO UPDATE SET digest_hour = excluded.digest_hour, reminder_minutes = excluded.reminder_minutes",
+                     (chat_id, digest_hour, reminder_minutes))
+
+
+def remove_subscription(database_file, chat_id):
+    conn = get_connection(database_file)
+    with conn:
+        return conn.execute("DELETE FROM subscriptions WHERE chat_id = ?", (chat_id,)).rowcount > 0
+
+
+# Return the subscribers of every group in one query: {group_number: [(chat_id, digest_hour, reminder_minutes)]}
+def subscribers_by_group(database_file):
+    subscribers = {}
+    rows = get_connection(database_file).execute(
+        "SELECT s.group_number, n.chat_id, n.digest_hour, n.reminder_minutes FROM subscriptions n "
+        "JOIN students s ON s.chat_id = n.chat_id WHERE s.group_number IS NOT NULL")
+    for group, chat_id, digest_hour, reminder_minutes in rows:
+        subscribers.setdefault(group, []).append((chat_id, digest_hour, reminder_minutes))
+    return subscribers
+
+
+def set_conversation(database_file, chat_id, step, arguments, expires):
+    conn = get_connection(database_file)
+    with conn:
+        conn.execute("INSERT INTO conversations (chat_id, step, arguments, expires) VALUES (?, ?, ?, ?) "
+                     "ON CONFLICT (chat_id) DO UPDATE SET step = excluded.step, arguments = excluded.arguments, expires = excluded.expires",
+                     (chat_id, step, arguments, expires))
+
+
+# Remove the pending step of a chat and return it as (step, arguments, expires), or None
+def pop_conversation(database_file, chat_id):
+    conn = get_connection(database_file)
+    with conn:
+        row = conn.execute("SELECT step, arguments, expires FROM conversations WHERE chat_id = ?", (chat_id,)).fetchone()
+        if row is not None:
+            conn.execute("DELETE FROM conversations WHERE chat_id = ?", (chat_id,))
+    return row
+
+
+def delete_conversation(database_file, chat_id):
+    conn = get_connection(database_file)
+    with conn:
+        conn.execute("DELETE FROM conversations WHERE chat_id = ?", (chat_id,))
+
+
+def delete_expired_conversations(database_file, now):
+    conn = get_connection(database_file)
+    with conn:
+        return conn.execute("DELETE FROM conversations WHERE expires <= ?", (now,)).rowcount
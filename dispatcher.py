@@ -0,0 +1,253 @@
+import heapq, itertools, logging, time
+from collections import OrderedDict, deque
+from threading import Condition, Thread
+from metrics import registry as metrics
+from renderer import MAX_MESSAGE_LENGTH
+
+log = logging.getLogger(__name__)
+
+
+# Token bucket refilled at rate tokens per second, holding at most capacity tokens
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Seconds until a token is available
+    def delay(self, now):
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class _Outgoing:
+    __slots__ = ('function', 'args', 'kwargs', 'bulk', 'attempts')
+
+    # function is None for text messages, whose only argument is the text
+    def __init__(self, function, args, kwargs, bulk):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.bulk = bulk
+        self.attempts = 0
+
+
+class _Chat:
+    __slots__ = ('queue', 'bucket', 'paused_until', 'busy', 'scheduled')
+
+    def __init__(self, bucket):
+        self.queue = deque()
+        self.bucket = bucket
+        self.paused_until = 0.0
+        self.busy = False
+        self.scheduled = False
+
+
+# Queue of outgoing Bot API calls served by a few worker threads, so handlers
+# enqueue their replies and return right away.
+# Calls to one chat are made in order, one at a time. Each chat has its own
+# token bucket (about one message per second with a short burst) and all chats
+# share a global one (about 30 per second). A 429 answer pauses the chat for
+# the retry_after Telegram asks for and the call is retried. Consecutive plain
+# text messages queued for the same chat are merged into one message while
+# they fit in 4096 characters. Bulk messages such as notifications are only
+# sent when no interactive reply is ready.
+class Dispatcher:
+    def __init__(self, bot, workers=4, global_rate=30, chat_rate=1.0, chat_burst=3, max_retries=5, max_chats=10000):
+        self.bot = bot
+        self.workers = workers
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self.condition = Condition()
+        self.chats = {}
+        # Chats with nothing queued or in flight, oldest first: the only ones that can be forgotten
+        self.idle = OrderedDict()
+        # Chats with queued calls by the time their bucket allows the next one, interactive and bulk
+        self.ready = ([], [])
+        self.counter = itertools.count()
+        self.threads = []
+        self.in_flight = 0
+        self.queued = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.retried = 0
+        self.failed = 0
+
+    def start(self):
+        with self.condition:
+            while len(self.threads) < self.workers:
+                thread = Thread(target=self._run, name=f'dispatcher-{len(self.threads)}', daemon=True)
+                self.threads.append(thread)
+                thread.start()
+
+    # Share Telegram's global limit with other processes sending for the same bot
+    def set_global_rate(self, rate):
+        with self.condition:
+            self.global_bucket = TokenBucket(rate, rate)
+
+    # Queue a text message, keyword arguments are passed on to bot.send_message
+    def send_message(self, chat_id, text, bulk=False, **kwargs):
+        self._put(chat_id, _Outgoing(None, (text,), kwargs, bulk))
+
+    # Queue any other Bot API call concerning the chat, in order with its messages
+    def submit(self, chat_id, function, *args, **kwargs):
+        self._put(chat_id, _Outgoing(function, args, kwargs, False))
+
+    def _put(self, chat_id, outgoing):
+        with self.condition:
+            chat = self.chats.get(chat_id)
+            if chat is None:
+                chat = self.chats[chat_id] = _Chat(TokenBucket(self.chat_rate, self.chat_burst))
+            self.idle.pop(chat_id, None)
+            chat.queue.append(outgoing)
+            self.queued += 1
+            now = time.monotonic()
+            self._schedule(chat_id, chat, now)
+            if len(self.chats) > self.max_chats:
+                self._prune(now)
+        # Start lazily so that importing the bot does not start threads
+        if not self.threads:
+            self.start()
+
+    # Forget the chats idle for longest once their bucket is full again, they would start over the same way.
+    # Chats with queued calls are never looked at, and the first chat that must be kept stops the pruning,
+    # since the chats idle for a shorter time are not ready either, so a put costs the chats it forgets.
+    def _prune(self, now):
+        while len(self.chats) > self.max_chats and self.idle:
+            chat_id = next(iter(self.idle))
+            chat = self.chats[chat_id]
+            if chat.paused_until > now:
+                return
+            chat.bucket._refill(now)
+            if chat.bucket.tokens < chat.bucket.capacity:
+                return
+            del self.idle[chat_id]
+            del self.chats[chat_id]
+
+    def _schedule(self, chat_id, chat, now):
+        if chat.busy or chat.scheduled or not chat.queue:
+            return
+        due = max(now + chat.bucket.delay(now), chat.paused_until)
+        heapq.heappush(self.ready[1 if chat.queue[0].bulk else 0], (due, next(self.counter), chat_id))
+        chat.scheduled = True
+        self.condition.notify()
+
+    # Take the next chat whose calls may be made now, waiting as long as needed
+    def _next(self):
+        while True:
+            now = time.monotonic()
+            wait = None
+            for heap in self.ready:
+                if not heap:
+                    continue
+                if heap[0][0] > now:
+                    wait = min(wait, heap[0][0] - now) if wait is not None else heap[0][0] - now
+                    continue
+                global_delay = self.global_bucket.delay(now)
+                if global_delay > 0:
+                    wait = min(wait, global_delay) if wait is not None else global_delay
+                    break
+                _, _, chat_id = heapq.heappop(heap)
+                chat = self.chats[chat_id]
+                chat.scheduled = False
+                chat.busy = True
+                self.global_bucket.take(now)
+                chat.bucket.take(now)
+                return chat_id, chat, self._coalesce(chat)
+            self.condition.wait(wait)
+
+    # Pop the next call of the chat, merged with the plain text messages queued right after it
+    def _coalesce(self, chat):
+        outgoing = chat.queue.popleft()
+        self.queued -= 1
+        if outgoing.function is not None or outgoing.kwargs:
+            return outgoing
+        while chat.queue:
+            following = chat.queue[0]
+            if following.function is not None or following.kwargs or following.bulk != outgoing.bulk:
+                break
+            text = outgoing.args[0].rstrip('\n') + '\n\n' + following.args[0]
+            if len(text) > MAX_MESSAGE_LENGTH:
+                break
+            outgoing.args = (text,)
+            chat.queue.popleft()
+            self.queued -= 1
+            self.coalesced += 1
+        return outgoing
+
+    def _call(self, chat_id, outgoing):
+        if outgoing.function is None:
+            self.bot.send_message(chat_id, *outgoing.args, **outgoing.kwargs)
+        else:
+            outgoing.function(*outgoing.args, **outgoing.kwargs)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                chat_id, chat, outgoing = self._next()
+                self.in_flight += 1
+
+            retry_after = None
+            try:
+                with metrics.timer('send'):
+                    self._call(chat_id, outgoing)
+                result = 'sent'
+            except Exception as e:
+                retry_after = _retry_after(e)
+                if retry_after is not None and outgoing.attempts < self.max_retries:
+                    result = 'retried'
+                else:
+                    result = 'failed'
+                    log.error("Error sending to %s: %s", chat_id, e)
+
+            with self.condition:
+                self.in_flight -= 1
+                chat.busy = False
+                now = time.monotonic()
+                metrics.increment('messages', result)
+                if result == 'retried':
+                    outgoing.attempts += 1
+                    chat.queue.appendleft(outgoing)
+                    chat.paused_until = now + retry_after
+                    self.queued += 1
+                    self.retried += 1
+                elif result == 'sent':
+                    self.sent += 1
+                else:
+                    self.failed += 1
+
+                if chat.queue:
+                    self._schedule(chat_id, chat, now)
+                else:
+                    self.idle[chat_id] = None
+                self.condition.notify_all()
+
+    # Wait until every queued call was made, or timeout seconds passed
+    def flush(self, timeout=None):
+        with self.condition:
+            return self.condition.wait_for(lambda: self.queued == 0 and self.in_flight == 0, timeout)
+
+    def stats(self):
+        with self.condition:
+            return {'queued': self.queued, 'chats': len(self.chats), 'sent': self.sent, 'coalesced': self.coalesced,
+                    'retried': self.retried, 'failed': self.failed}
+
+
+# Seconds to wait before retrying, when the Bot API answered 429 Too Many Requests
+def _retry_after(error):
+    if getattr(error, 'error_code', None) != 429:
+        return None
+    parameters = (getattr(error, 'result_json', None) or {}).get('parameters') or {}
+    return parameters.get('retry_after', 1)
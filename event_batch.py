@@ -0,0 +1,132 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from threading import Lock
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Stand-in for missing room and teacher IDs in the typed columns
+MISSING_ID = -1
+
+
+# Columnar batch of schedule events.
+# Start times, first room IDs and teacher IDs are stored in typed arrays, and
+# the group IDs of all events in one flat array with per-event offsets
+# (CSR layout), so filtering touches only integers. IDs are resolved to names
+# only for the rows that are actually rendered.
+class EventBatch:
+    __slots__ = ('starts', 'rooms', 'teachers', 'group_offsets', 'group_ids', 'names', 'sorted', '_group_rows')
+
+    def __init__(self, events):
+        self.starts = array('q')
+        self.rooms = array('q')
+        self.teachers = array('q')
+        self.group_offsets = array('q', [0])
+        self.group_ids = array('q')
+        self.names = []
+        self._group_rows = None
+
+        names = {}
+        for event in events:
+            self.starts.append(event[0])
+            self.rooms.append(event[1][0] if len(event[1]) > 0 and event[1][0] is not None else MISSING_ID)
+            self.teachers.append(event[3] if event[3] is not None else MISSING_ID)
+            self.group_ids.extend(event[2])
+            self.group_offsets.append(len(self.group_ids))
+            # Lecture names repeat a lot, so share one string per distinct name
+            self.names.append(names.setdefault(event[4], event[4]))
+
+        self.sorted = all(self.starts[i] <= self.starts[i + 1] for i in range(len(self.starts) - 1))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def groups_of(self, row):
+        return self.group_ids[self.group_offsets[row]:self.group_offsets[row + 1]]
+
+    # Rows of the events the group takes part in, in event order
+    def rows_with_group(self, group_id):
+        if numpy is not None and len(self.group_ids):
+            positions = numpy.flatnonzero(numpy.frombuffer(self.group_ids, dtype=numpy.int64) == group_id)
+            rows = numpy.searchsorted(numpy.frombuffer(self.group_offsets, dtype=numpy.int64), positions, side='right') - 1
+            return numpy.unique(rows).tolist()
+
+        # Without numpy, invert the membership once and answer every group from it
+        if self._group_rows is None:
+            group_rows = {}
+            offsets, group_ids = self.group_offsets, self.group_ids
+            for row in range(len(self.starts)):
+                for position in range(offsets[row], offsets[row + 1]):
+                    rows = group_rows.setdefault(group_ids[position], [])
+                    if not rows or rows[-1] != row:
+                        rows.append(row)
+            self._group_rows = group_rows
+        return self._group_rows.get(group_id, [])
+
+    # Rows of the events starting between from_time and to_time inclusive
+    def rows_in_window(self, from_time, to_time, rows=None):
+        if rows is None:
+            if self.sorted:
+                return range(bisect_left(self.starts, from_time), bisect_right(self.starts, to_time))
+            rows = range(len(self.starts))
+        return [row for row in rows if from_time <= self.starts[row] <= to_time]
+
+    # Resolve the given rows like map_event: [start, room, groups, teacher, name]
+    def resolve(self, rows, items):
+        rooms, groups, teachers = items.get('rooms', {}), items.get('groups', {}), items.get('teachers', {})
+        resolved = []
+        for row in rows:
+            room, teacher = self.rooms[row], self.teachers[row]
+            resolved.append([
+                self.starts[row],
+                rooms.get(str(room), 'Not specified') if room != MISSING_ID else 'Not specified',
+                [groups.get(str(group_id), '') for group_id in self.groups_of(row)],
+                teachers.get(str(teacher), '') if teacher != MISSING_ID else '',
+                self.names[row],
+            ])
+        return resolved
+
+
+_batches = OrderedDict()
+_batches_lock = Lock()
+
+
+# Return a batch and the rows of the events of the group, or of the teacher, in a list of events.
+# Prefetched answers and windows of cached responses are new lists built for one request, and building
+# the columns of all their events costs more than filtering the list once. So a list seen for the first
+# time is filtered like a list and only the selected events are put in a batch. Cached responses hand
+# out the same list to every request: a list seen again gets a batch of all its events, kept for the
+# next requests, which then select their rows from the columns.
+def batch_for(events, group_id=None, teacher_id=None, max_batches=64):
+    with _batches_lock:
+        cached = _batches.get(id(events))
+        seen = cached is not None and cached[0] is events
+        if seen:
+            _batches.move_to_end(id(events))
+        else:
+            _batches[id(events)] = (events, None)
+            while len(_batches) > max_batches:
+                _batches.popitem(last=False)
+    batch = cached[1] if seen else None
+
+    if not seen:
+        if group_id is not None:
+            events = [event for event in events if group_id in event[2]]
+        elif teacher_id is not None:
+            events = [event for event in events if event[3] == teacher_id]
+        batch = EventBatch(events)
+        return batch, range(len(batch))
+
+    if batch is None:
+        batch = EventBatch(events)
+        with _batches_lock:
+            if id(events) in _batches:
+                _batches[id(events)] = (events, batch)
+    if group_id is not None:
+        return batch, batch.rows_with_group(group_id)
+    if teacher_id is not None:
+        return batch, [row for row in range(len(batch)) if batch.teachers[row] == teacher_id]
+    return batch, range(len(batch))
@@ -0,0 +1,80 @@
+import json, time
+import database
+
+# Database files whose events tables were already created by this process
+_created = set()
+
+
+# Return the connection to the database, creating the tables holding prefetched events if they do not exist yet
+def _connection(database_file):
+    conn = database.get_connection(database_file)
+    if database_file not in _created:
+        create_tables(conn)
+        _created.add(database_file)
+    return conn
+
+
+def create_tables(conn):
+    conn.executescript('''
+        CREATE TABLE IF NOT EXISTS events
+            (id INTEGER PRIMARY KEY, start_time INTEGER, teacher_id INTEGER, data TEXT);
+        CREATE INDEX IF NOT EXISTS events_start_time ON events (start_time);
+        CREATE TABLE IF NOT EXISTS event_groups
+            (group_id INTEGER, start_time INTEGER, event_id INTEGER);
+        CREATE INDEX IF NOT EXISTS event_groups_group_start ON event_groups (group_id, start_time);
+        CREATE INDEX IF NOT EXISTS event_groups_event ON event_groups (event_id);
+        CREATE TABLE IF NOT EXISTS events_coverage
+            (id INTEGER PRIMARY KEY CHECK (id = 1), from_time INTEGER, to_time INTEGER, fetched_at INTEGER);
+    ''')
+
+
+# Replace all stored events of the window with the given ones in a single transaction, returning their count
+def store_events(database_file, events, from_time, to_time):
+    count = 0
+    conn = _connection(database_file)
+    with conn:
+        conn.execute("DELETE FROM event_groups WHERE event_id IN (SELECT id FROM events WHERE start_time BETWEEN ? AND ?)", (from_time, to_time))
+        conn.execute("DELETE FROM events WHERE start_time BETWEEN ? AND ?", (from_time, to_time))
+        # Events that ended before the window are no longer needed
+        conn.execute("DELETE FROM event_groups WHERE start_time < ?", (from_time,))
+        conn.execute("DELETE FROM events WHERE start_time < ?", (from_time,))
+
+        for event in events:
+            count += 1
+            cursor = conn.execute("INSERT INTO events (start_time, teacher_id, data) VALUES (?, ?, ?)",
+                                  (event[0], event[3], json.dumps(event, ensure_ascii=False)))
+            conn.executemany("INSERT INTO event_groups (group_id, start_time, event_id) VALUES (?, ?, ?)",
+                             [(group_id, event[0], cursor.lastrowid) for group_id in event[2]])
+
+        conn.execute("INSERT OR REPLACE INTO events_coverage (id, from_time, to_time, fetched_at) VALUES (1, ?, ?, ?)",
+                     (from_time, to_time, int(time.time())))
+    return count
+
+
+# Window of the stored events and when they were fetched, as (from_time, to_time, fetched_at), or None before the first prefetch
+def coverage(database_file):
+    return _connection(database_file).execute("SELECT from_time, to_time, fetched_at FROM events_coverage").fetchone()
+
+
+# Answer an events request from the prefetched events.
+# Returns data shaped like the API response, or None when the window is not
+# covered by a prefetch younger than max_age seconds.
+def query_events(database_file, group_ids, teacher_ids, from_time, to_time, max_age):
+    conn = _connection(database_file)
+    window = coverage(database_file)
+    if not window or from_time < window[0] or to_time > window[1] or window[2] < time.time() - max_age:
+        return None
+
+    query = "SELECT data FROM events WHERE start_time BETWEEN ? AND ?"
+    params = [from_time, to_time]
+    if group_ids:
+        query = '''SELECT e.data FROM events e WHERE e.id IN
+                   (SELECT event_id FROM event_groups WHERE group_id IN ({}) AND start_time BETWEEN ? AND ?)'''.format(','.join('?' * len(group_ids)))
+        params = [int(g) for g in group_ids] + params
+    if teacher_ids:
+        query += " AND teacher_id IN ({})".format(','.join('?' * len(teacher_ids)))
+        params += [int(t) for t in teacher_ids]
+    query += " ORDER BY start_time, id"
+
+    values = [json.loads(row[0]) for row in conn.execute(query, params)]
+    return {'events': {'values': values}}
@@ -0,0 +1,45 @@
+from datetime import datetime, timedelta
+from renderer import riga
+
+
+# Split the window [from_time, to_time] into consecutive windows of at most the given number of
+# days, cut at local midnight so that no day of the schedule is split between two of them
+def plan_chunks(from_time, to_time, days, tz=riga):
+    chunks = []
+    start = from_time
+    boundary = datetime.fromtimestamp(from_time, tz).replace(hour=0, minute=0, second=0, microsecond=0)
+    while start <= to_time:
+        boundary += timedelta(days=days)
+        end = min(int(boundary.timestamp()) - 1, to_time)
+        chunks.append((start, end))
+        start = end + 1
+    return chunks
+
+
+# Keep the events of a chunk's data that belong to it: every event belongs to the chunk its start
+# falls in, so events the service also returns for a neighbouring chunk are dropped there. Events
+# before the first chunk or after the last are kept, as a single request would have returned them.
+def owned_events(data, start, end, first, last):
+    events = data.get('events')
+    if not events:
+        return data
+    values = [event for event in events['values'] if (first or event[0] >= start) and (last or event[0] <= end)]
+    values.sort(key=lambda event: event[0])
+    return {**data, 'events': {**events, 'values': values}}
+
+
+# Fetch the chunks of a long window concurrently on the executor and yield (start, end, data)
+# for each of them in order, as soon as it and the chunks before it arrived. fetch(start, end)
+# returns the response data of one chunk. Chunks not fetched yet are cancelled when the
+# caller stops early, for example after an error.
+def fetch_chunks(fetch, chunks, executor):
+    futures = [executor.submit(fetch, start, end) for start, end in chunks]
+    try:
+        for number, ((start, end), future) in enumerate(zip(chunks, futures)):
+            data = future.result()
+            if data is not None:
+                data = owned_events(data, start, end, number == 0, number == len(chunks) - 1)
+            yield start, end, data
+    finally:
+        for future in futures:
+            future.cancel()
@@ -0,0 +1,111 @@
+from unidecode import unidecode
+
+
+# Lookup key of a group name: ascii, case folded, letters and digits only, so "4201-bda" finds "4201BDA"
+def group_key(text):
+    return ''.join(character for character in unidecode(text).casefold() if character.isalnum())
+
+
+# The key with each of its characters deleted in turn
+def _deletions(key):
+    return [key[:position] + key[position + 1:] for position in range(len(key))]
+
+
+# Whether two different keys are one substitution, insertion, deletion or swap of adjacent characters apart
+def one_edit_apart(first, second):
+    shortest = min(len(first), len(second))
+    start = 0
+    while start < shortest and first[start] == second[start]:
+        start += 1
+    end = 0
+    while end < shortest - start and first[-1 - end] == second[-1 - end]:
+        end += 1
+    first_rest, second_rest = first[start:len(first) - end], second[start:len(second) - end]
+    if len(first_rest) + len(second_rest) <= 2 and max(len(first_rest), len(second_rest)) == 1:
+        return True
+    return len(first_rest) == len(second_rest) == 2 and first_rest == second_rest[::-1]
+
+
+# Edit distance counting a swap of adjacent characters as one edit (optimal string alignment),
+# or max_distance + 1 as soon as it is known to be larger than max_distance
+def edit_distance(first, second, max_distance):
+    if abs(len(first) - len(second)) > max_distance:
+        return max_distance + 1
+    previous2, previous = None, list(range(len(second) + 1))
+    for i in range(1, len(first) + 1):
+        current = [i] + [0] * len(second)
+        for j in range(1, len(second) + 1):
+            cost = first[i - 1] != second[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and first[i - 1] == second[j - 2] and first[i - 2] == second[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+# Typo tolerant resolver over the group names of items, built once per items refresh.
+# Names are looked up by their group_key, so case, accents, dashes and spaces do
+# not matter. Every key is also indexed under each of its one character
+# deletions: looking up the query key and its own deletions finds every group
+# within one substitution, insertion, deletion or swap of adjacent characters,
+# and some within two, without comparing the query with all groups. Candidates
+# are then ranked by their edit distance, checking most of them with a linear
+# one edit test and computing the full distance only when too few are that close.
+class GroupResolver:
+    def __init__(self, groups, max_distance=2):
+        self.max_distance = max_distance
+        self.groups = list(dict.fromkeys(groups))
+        self.keys = [group_key(group) for group in self.groups]
+        self.exact = {}
+        self.variants = {}
+        for position, key in enumerate(self.keys):
+            self.exact.setdefault(key, position)
+            for variant in [key] + _deletions(key):
+                positions = self.variants.setdefault(variant, [])
+                if not positions or positions[-1] != position:
+                    positions.append(position)
+
+    # The group whose key is the key of the text, or None
+    def find(self, text):
+        position = self.exact.get(group_key(text))
+        return self.groups[position] if position is not None else None
+
+    def _candidates(self, key):
+        candidates = set()
+        for variant in [key] + _deletions(key):
+            candidates.update(self.variants.get(variant, ()))
+        return candidates
+
+    # Up to limit (group, distance) pairs within max_distance edits of the text, closest first
+    def suggest(self, text, limit=5, max_distance=None):
+        key = group_key(text)
+        max_distance = self.max_distance if max_distance is None else max_distance
+        # One or two characters are too short to tell a typo from another group
+        if len(key) < 3:
+            return []
+        ranked, farther = [], []
+        for position in self._candidates(key):
+            candidate = self.keys[position]
+            if candidate == key:
+                ranked.append((0, self.groups[position]))
+            elif one_edit_apart(key, candidate):
+                ranked.append((1, self.groups[position]))
+            else:
+                farther.append(position)
+        if len(ranked) < limit and max_distance > 1:
+            for position in farther:
+                distance = edit_distance(key, self.keys[position], max_distance)
+                if distance <= max_distance:
+                    ranked.append((distance, self.groups[position]))
+        ranked.sort()
+        return [(group, distance) for distance, group in ranked[:limit]]
+
+    # The group the text names: its exact match, or the only group one edit away. None when ambiguous.
+    def resolve(self, text):
+        group = self.find(text)
+        if group is not None:
+            return group
+        close = self.suggest(text, limit=2, max_distance=1)
+        return close[0][0] if len(close) == 1 else None
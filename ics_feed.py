@@ -0,0 +1,161 @@
+import hashlib, logging
+from collections import OrderedDict
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from urllib.parse import unquote
+from reply_cache import rows_digest
+
+log = logging.getLogger(__name__)
+
+PRODUCT_ID = '-//TSI support bot//Schedule//EN'
+
+
+def _escape(text):
+    return text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+
+# Content line folded into lines of at most 75 octets, without splitting a UTF-8 character
+def _line(text):
+    data = text.encode()
+    lines = []
+    start, limit = 0, 75
+    while len(data) - start > limit:
+        end = start + limit
+        while data[end] & 0xC0 == 0x80:
+            end -= 1
+        lines.append(data[start:end].decode())
+        # Continuation lines start with a space
+        start, limit = end, 74
+    lines.append(data[start:].decode())
+    return '\r\n '.join(lines) + '\r\n'
+
+
+def _utc(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+# VEVENTs of the given rows of an event batch, with names resolved through items.
+# UIDs are derived from the event itself and DTSTAMP is its start, so that the
+# same events always give the same text and unchanged feeds keep their ETag.
+def _render_day(batch, rows, items, lesson_length):
+    parts = []
+    for row, event in zip(rows, batch.resolve(rows, items)):
+        uid = hashlib.blake2b(repr((batch.starts[row], batch.rooms[row], batch.teachers[row],
+                                    tuple(batch.groups_of(row)), batch.names[row])).encode(), digest_size=10).hexdigest()
+        groups = ', '.join(group for group in event[2] if group) or 'Not specified'
+        description = f'Teacher: {event[3].strip()}\nGroups: {groups}' if event[3].strip() else f'Groups: {groups}'
+        parts += ['BEGIN:VEVENT\r\n', _line(f'UID:{uid}@tsi-support-bot'), _line(f'DTSTAMP:{_utc(event[0])}'),
+                  _line(f'DTSTART:{_utc(event[0])}'), _line(f'DTEND:{_utc(event[0] + lesson_length)}'),
+                  _line(f'SUMMARY:{_escape(event[4].strip())}'), _line(f'LOCATION:{_escape(event[1])}'),
+                  _line(f'DESCRIPTION:{_escape(description)}'), 'END:VEVENT\r\n']
+    return ''.join(parts)
+
+
+# iCalendar feeds of groups and teachers, rendered day by day.
+# Every feed keeps the VEVENT text of each of its days with the digest of the
+# event rows it was rendered from, so a pull renders only the days whose events
+# changed. The ETag is the digest of the day texts, which is the same in every
+# process for the same events and items. The document itself is never joined:
+# build returns a generator yielding the header, the days and the footer.
+class CalendarFeed:
+    def __init__(self, lesson_length=90 * 60, max_feeds=1024):
+        self.lesson_length = lesson_length
+        self.max_feeds = max_feeds
+        self.feeds = OrderedDict()
+        self.lock = Lock()
+        self.days_rendered = 0
+        self.days_reused = 0
+
+    # ETag and body generator of the feed of a selection, such as ('group', key), over the
+    # given (start, end) day windows, from the batch rows of its events
+    def build(self, selection, name, batch, rows, days, items):
+        with self.lock:
+            cached = self.feeds.get(selection)
+        previous = cached[1] if cached is not None and cached[0] is items else {}
+
+        texts = {}
+        rendered = 0
+        for start, end in days:
+            day_rows = batch.rows_in_window(start, end, rows)
+            digest = rows_digest(batch, day_rows)
+            entry = previous.get(start)
+            if entry is None or entry[0] != digest:
+                text = _render_day(batch, day_rows, items, self.lesson_length)
+                entry = (digest, text, hashlib.blake2b(text.encode(), digest_size=16).digest())
+                rendered += 1
+            texts[start] = entry
+
+        etag = hashlib.blake2b(name.encode(), digest_size=16)
+        for entry in texts.values():
+            etag.update(entry[2])
+        with self.lock:
+            self.feeds[selection] = (items, texts)
+            self.feeds.move_to_end(selection)
+            while len(self.feeds) > self.max_feeds:
+                self.feeds.popitem(last=False)
+            self.days_rendered += rendered
+            self.days_reused += len(texts) - rendered
+        return etag.hexdigest(), self._stream(name, [entry[1] for entry in texts.values()])
+
+    @staticmethod
+    def _stream(name, texts):
+        yield ('BEGIN:VCALENDAR\r\nVERSION:2.0\r\n' + _line(f'PRODID:{PRODUCT_ID}') + 'CALSCALE:GREGORIAN\r\n'
+               'METHOD:PUBLISH\r\n' + _line(f'X-WR-CALNAME:{_escape(name)}'))
+        for text in texts:
+            if text:
+                yield text
+        yield 'END:VCALENDAR\r\n'
+
+    def stats(self):
+        with self.lock:
+            return {'feeds': len(self.feeds), 'days_rendered': self.days_rendered, 'days_reused': self.days_reused}
+
+
+# Serve the feeds at /group/<group>.ics and /teacher/<teacher>.ics. feed(kind, name) returns the
+# ETag and body generator of the feed, or None for an unknown group or teacher, and raises when
+# the events are not available. Bodies are sent with chunked transfer encoding as they are generated.
+def start_calendar_server(port, feed, host='0.0.0.0', max_age=600):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            parts = unquote(self.path.split('?')[0]).strip('/').split('/')
+            if len(parts) != 2 or parts[0] not in ('group', 'teacher') or not parts[1].endswith('.ics'):
+                self.send_error(404)
+                return
+            try:
+                result = feed(parts[0], parts[1][:-len('.ics')])
+            except Exception as e:
+                log.error('Calendar feed failed: %s', e)
+                self.send_error(503)
+                return
+            if result is None:
+                self.send_error(404)
+                return
+
+            etag, body = result
+            etag = f'"{etag}"'
+            if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/calendar; charset=utf-8')
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', f'max-age={max_age}')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for text in body:
+                data = text.encode()
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            self.wfile.write(b'0\r\n\r\n')
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    Thread(target=server.serve_forever, name='calendar', daemon=True).start()
+    return server
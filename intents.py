@@ -0,0 +1,94 @@
+import re
+from datetime import datetime, timedelta
+from threading import Lock
+from renderer import riga
+
+select_group_phrases = {
+    ('change', 'group'), ('change', 'my', 'group'), ('select', 'group'), ('select', 'my', 'group'),
+    ('set', 'group'), ('set', 'my', 'group'), ('selectgroup',), ('change', 'the', 'group'), ('new', 'group'),
+}
+schedule_words = {'schedule', 'timetable', 'lessons', 'lectures', 'classes', 'lesson', 'lecture', 'class', 'pairs'}
+filler_words = {'what', 'whats', "what's", 'is', 'are', 'my', 'the', 'for', 'on', 'of', 'me', 'show', 'give', 'please',
+                'do', 'i', 'have', 'get', 'check', 'group', 'at', 'in', 'this', 'next'}
+weekdays = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+date_words = {'today', 'tonight', 'tomorrow', 'yesterday', 'week'}
+known_words = schedule_words | filler_words | set(weekdays) | date_words
+room_words = {'room', 'rooms', 'classroom', 'classrooms', 'auditorium', 'auditoriums'}
+free_words = {'free', 'empty', 'available', 'unoccupied'}
+free_room_words = room_words | free_words | filler_words | {'now', 'which', 'any', 'right', 'there', 'currently'}
+
+_word = re.compile(r"[\w'-]+")
+
+
+# Rule based classifier for the most common messages, answering without a Dialogflow round trip.
+# It only answers when every word of the message is understood, and returns a
+# query result shaped like Dialogflow's (intent displayName and parameters
+# with date-time, date-period and group-text) or None to defer to Dialogflow.
+# Questions about free rooms right now get the FreeRooms intent, which Dialogflow does not know.
+class LocalIntentClassifier:
+    def __init__(self, is_group):
+        self.is_group = is_group
+        self.lock = Lock()
+        self.local = 0
+        self.deferred = 0
+
+    @staticmethod
+    def _result(intent, parameters):
+        return {'intent': {'displayName': intent}, 'parameters': parameters, 'intentDetectionConfidence': 1.0, 'fulfillmentText': ''}
+
+    @staticmethod
+    def _date_time(day):
+        return day.replace(hour=12, minute=0, second=0, microsecond=0).isoformat()
+
+    def _date_parameters(self, words, now):
+        today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        if 'today' in words or 'tonight' in words:
+            return {'date-time': self._date_time(now)}
+        if 'tomorrow' in words:
+            return {'date-time': self._date_time(now + timedelta(days=1))}
+        if 'yesterday' in words:
+            return {'date-time': self._date_time(now - timedelta(days=1))}
+        if 'week' in words:
+            start = today - timedelta(days=today.weekday())
+            if 'next' in words:
+                start += timedelta(days=7)
+            end = (start + timedelta(days=6)).replace(hour=23, minute=59, second=59)
+            return {'date-period': {'startDate': start.isoformat(), 'endDate': end.isoformat()}}
+        for day in weekdays:
+            if day in words:
+                days_ahead = (weekdays.index(day) - today.weekday()) % 7
+                if 'next' in words and days_ahead == 0:
+                    days_ahead = 7
+                return {'date-time': self._date_time(now + timedelta(days=days_ahead))}
+        return None
+
+    def _classify(self, text, now):
+        words = tuple(w.lower() for w in _word.findall(text.lstrip('/')))
+        if not words:
+            return None
+        if words in select_group_phrases:
+            return self._result('SelectGroup', {})
+        if room_words & set(words) and free_words & set(words) and all(w in free_room_words for w in words):
+            return self._result('FreeRooms', {'date-time': now.isoformat()})
+
+        groups = [w for w in _word.findall(text) if self.is_group(w)]
+        if not schedule_words & set(words) or any(w not in known_words and not self.is_group(w) for w in words) or len(groups) > 1:
+            return None
+
+        parameters = self._date_parameters(set(words), now) or {'date-time': self._date_time(now)}
+        parameters['group-text'] = groups[0] if groups else ''
+        return self._result('CheckSchedule', parameters)
+
+    def classify(self, text, now=None):
+        result = self._classify(text or '', now or datetime.now(riga))
+        with self.lock:
+            if result:
+                self.local += 1
+            else:
+                self.deferred += 1
+        return result
+
+    def stats(self):
+        with self.lock:
+            total = self.local + self.deferred
+            return {'local': self.local, 'dialogflow': self.deferred, 'local_fraction': self.local / total if total else 0.0}
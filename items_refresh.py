@@ -0,0 +1,45 @@
+import json, os, tempfile
+
+
+# Compare two items dictionaries section by section.
+# Returns {section: {'added': {id: name}, 'removed': {id: name}, 'renamed': {id: (old, new)}}}
+# for the sections that changed only.
+def diff_items(old, new):
+    diff = {}
+    for section in set(old) | set(new):
+        old_values, new_values = old.get(section, {}), new.get(section, {})
+        if old_values == new_values:
+            continue
+        diff[section] = {
+            'added': {key: value for key, value in new_values.items() if key not in old_values},
+            'removed': {key: value for key, value in old_values.items() if key not in new_values},
+            'renamed': {key: (old_values[key], value) for key, value in new_values.items()
+                        if key in old_values and old_values[key] != value},
+        }
+    return diff
+
+
+# Names that appear in or disappear from a section, which matters for tables keyed by name
+def name_changes(old_values, new_values):
+    old_names, new_names = set(old_values.values()), set(new_values.values())
+    return new_names - old_names, old_names - new_names
+
+
+def describe(diff):
+    return ', '.join(f"{section}: +{len(changes['added'])} -{len(changes['removed'])} ~{len(changes['renamed'])}"
+                     for section, changes in sorted(diff.items()))
+
+
+# Write the items to path atomically: a compact temporary file in the same directory replaces the old one
+def write_snapshot(path, items):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temporary = tempfile.mkstemp(dir=directory, prefix='.items-', suffix='.json')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as file:
+            json.dump(items, file, ensure_ascii=False, separators=(',', ':'))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
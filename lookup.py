@@ -0,0 +1,104 @@
+from unidecode import unidecode
+from group_resolver import GroupResolver
+
+
+# Normalize a name for case and diacritic insensitive lookups
+def normalize_name(name):
+    return ' '.join(unidecode(name).casefold().split())
+
+
+# Immutable lookup structure derived from the items dictionary.
+# A new instance is built whenever items are refreshed and swapped in with a
+# single assignment, so handler threads always see a complete index. Given the
+# previous index and the changed sections, the structures of unchanged
+# sections are shared with it instead of being rebuilt.
+class ItemsIndex:
+    __slots__ = ('items', 'group_keys', 'teacher_keys', 'normalized_group_keys', 'normalized_teacher_keys', 'group_families',
+                 'normalized_room_keys', 'group_resolver')
+
+    def __init__(self, items, previous=None, changed_sections=None):
+        self.items = items
+
+        if previous is not None and changed_sections is not None and 'groups' not in changed_sections:
+            self.group_keys = previous.group_keys
+            self.normalized_group_keys = previous.normalized_group_keys
+            self.group_families = previous.group_families
+            self.group_resolver = previous.group_resolver
+        else:
+            self.group_keys = self._reverse(items.get('groups', {}))
+            self.normalized_group_keys = self._reverse(items.get('groups', {}), normalize_name)
+            self.group_families = self._families(items.get('groups', {}).values())
+            self.group_resolver = GroupResolver(items.get('groups', {}).values())
+
+        if previous is not None and changed_sections is not None and 'teachers' not in changed_sections:
+            self.teacher_keys = previous.teacher_keys
+            self.normalized_teacher_keys = previous.normalized_teacher_keys
+        else:
+            self.teacher_keys = self._reverse(items.get('teachers', {}))
+            self.normalized_teacher_keys = self._reverse(items.get('teachers', {}), normalize_name)
+
+        if previous is not None and changed_sections is not None and 'rooms' not in changed_sections:
+            self.normalized_room_keys = previous.normalized_room_keys
+        else:
+            self.normalized_room_keys = self._reverse(items.get('rooms', {}), normalize_name)
+
+    def __setattr__(self, name, value):
+        if hasattr(self, name):
+            raise AttributeError('ItemsIndex is immutable')
+        object.__setattr__(self, name, value)
+
+    # Map values back to their keys, keeping the first key for duplicated values like the linear scan did
+    @staticmethod
+    def _reverse(mapping, transform=None):
+        reverse = {}
+        for key, value in mapping.items():
+            reverse.setdefault(transform(value) if transform else value, key)
+        return reverse
+
+    # Index groups by (second digit, suffix) so that the group family filter
+    # re.match(r'^\d{}.*{}$'.format(numeric_part[1:2], letter_part), group)
+    # becomes a single dictionary lookup
+    @staticmethod
+    def _families(groups):
+        families = {}
+        for group in groups:
+            if not group or not group[0].isdecimal():
+                continue
+            for position in range(1, len(group)):
+                families.setdefault(('', group[position:]), []).append(group)
+            if len(group) > 1:
+                for position in range(2, len(group)):
+                    families.setdefault((group[1], group[position:]), []).append(group)
+        return {key: tuple(value) for key, value in families.items()}
+
+    def find_group_key(self, group_text):
+        key = self.group_keys.get(group_text)
+        if key is None and group_text:
+            key = self.normalized_group_keys.get(normalize_name(group_text))
+        return key
+
+    # Like find_group_key, but also ignoring dashes and spaces and correcting a typo when only one group is that close
+    def resolve_group_key(self, group_text):
+        key = self.find_group_key(group_text)
+        if key is None and group_text:
+            group = self.group_resolver.resolve(group_text)
+            key = self.group_keys.get(group) if group is not None else None
+        return key
+
+    def find_teacher_key(self, teacher_text):
+        key = self.teacher_keys.get(teacher_text)
+        if key is None and teacher_text:
+            key = self.normalized_teacher_keys.get(normalize_name(teacher_text))
+        return key
+
+    def find_room_key(self, room_text):
+        return self.normalized_room_keys.get(normalize_name(room_text)) if room_text else None
+
+    # Return the canonical group name for a possibly differently cased or accented input
+    def canonical_group(self, group_text):
+        key = self.find_group_key(group_text)
+        return self.items['groups'][key] if key is not None else None
+
+    # Return all groups of the same family, in the same order as items['groups']
+    def group_family(self, numeric_part, letter_part):
+        return self.group_families.get((numeric_part[1:2], letter_part), ())
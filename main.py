@@ -1,53 +1,179 @@
-import os, json, requests, time, re, telebot, sqlite3, pytz
+import os, io, json, time, re, itertools, asyncio, logging, telebot
 from google.cloud import dialogflow_v2beta1 as dialogflow
 from google.cloud.dialogflow_v2beta1.types.session import QueryResult
 from google.protobuf.json_format import MessageToDict
 from google.api_core.exceptions import InvalidArgument
 from telebot import types
-from datetime import datetime
-from threading import Thread
-from fuzzywuzzy import fuzz, process
-from unidecode import unidecode
+from datetime import datetime, timedelta
+from urllib.parse import quote
+from threading import Thread, BoundedSemaphore, Lock
+from concurrent.futures import ThreadPoolExecutor
 from apscheduler.schedulers.blocking import BlockingScheduler
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from tsi_client import TsiClient, UpstreamError, iter_events
+from lookup import ItemsIndex
+from items_refresh import diff_items, describe, name_changes, write_snapshot
+from teacher_matcher import TeacherMatcher
+from schedule_cache import ScheduleCache
+import database, event_store, snapshot
+from async_runtime import AsyncRuntime
+from intents import LocalIntentClassifier
+from event_batch import EventBatch, batch_for
+from notifications import Notifier
+from dispatcher import Dispatcher
+from conversations import ConversationStore
+from renderer import ScheduleStream, local_strings, riga
+from fetch_planner import plan_chunks, fetch_chunks
+from rooms import RoomIndex
+from ics_feed import CalendarFeed, start_calendar_server
+from reply_cache import ReplyCache, rows_digest
+from metrics import registry as metrics, setup_logging, start_metrics_server
 
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = 'private_key.json'
 
 DIALOGFLOW_PROJECT_ID = 'tsisupportbot-ksyr'
 DIALOGFLOW_LANGUAGE_CODE = 'en'
-SESSION_ID = 'me'
+
+log = logging.getLogger('tsi_bot')
 
 # Set up your SQLite database
-DATABASE_FILE = "students.db"
+DATABASE_FILE = os.getenv('TSI_BOT_DATABASE', "students.db")
+
+# Items as received from the API, and the binary snapshot of them with their lookup structures
+ITEMS_FILE = 'items.json'
+ITEMS_SNAPSHOT_FILE = 'items.snapshot'
+
+# Cache of the students' groups in front of the students table
+student_groups_cache_size = 200000
+student_groups = database.StudentGroupCache(DATABASE_FILE, student_groups_cache_size)
+
+# Pending next steps of conversations such as the group selection, kept in the database so they survive restarts.
+# A step expires when the student does not answer within conversation_ttl seconds, expired ones are purged hourly.
+conversation_ttl = 3600
+conversation_cache_size = 100000
+conversation_purge_minutes = 60
+conversations = ConversationStore(DATABASE_FILE, conversation_ttl, conversation_cache_size)
 
 # Set up your bot's API token
 TOKEN = os.getenv('TSI_BOT_KEY')
 
-# Create an instance of the bot
-bot = telebot.TeleBot(TOKEN)
+# Create an instance of the bot, optionally talking to a local Bot API server, e.g. http://localhost:8081/bot{0}/{1}
+if os.getenv('TSI_BOT_API_URL'):
+    telebot.apihelper.API_URL = os.getenv('TSI_BOT_API_URL')
+bot = telebot.TeleBot(TOKEN, next_step_backend=conversations)
+
+# Replies are queued here and sent by the dispatcher's workers within Telegram's rate limits.
+# Messages per second of the bot as a whole, 30 unless Telegram granted more (paid broadcasts)
+send_rate = float(os.getenv('TSI_BOT_SEND_RATE', '30'))
+outbox = Dispatcher(bot, global_rate=send_rate)
 
 # API URLs
-items_url = 'https://services.tsi.lv/schedule/api/service.asmx/GetItems?'
+schedule_service_url = os.getenv('TSI_SCHEDULE_URL', 'https://services.tsi.lv/schedule/api/service.asmx/')
 contacts_url = 'http://services-api.tsi.lv:3000/contacts'
-schedule_url = 'https://services.tsi.lv/schedule/api/service.asmx/GetLocalizedEvents?'
+
+# Upper bounds of concurrent calls to each upstream service
+tsi_concurrency = 8
+dialogflow_concurrency = 8
+
+# Shared client for the schedule service: pooled connections, (connect, read) timeouts and retries
+tsi_client = TsiClient(schedule_service_url, timeout=(3.05, 15), retries=2, max_concurrency=tsi_concurrency)
+dialogflow_limiter = BoundedSemaphore(dialogflow_concurrency)
+
+# Chat IDs allowed to use /stats, comma separated
+ADMIN_CHAT_IDS = {int(chat_id) for chat_id in os.getenv('TSI_BOT_ADMINS', '').split(',') if chat_id.strip()}
+
+# Log level, JSON lines or plain text logs, and the port of the Prometheus metrics endpoint (disabled when unset)
+LOG_LEVEL = os.getenv('TSI_BOT_LOG_LEVEL', 'INFO')
+LOG_JSON = os.getenv('TSI_BOT_LOG_JSON', '1') == '1'
+METRICS_PORT = os.getenv('TSI_BOT_METRICS_PORT')
+
+# Port of the iCalendar feed endpoint (disabled when unset) and the public URL it is reachable at, shown by /calendar
+CALENDAR_PORT = os.getenv('TSI_BOT_CALENDAR_PORT')
+CALENDAR_URL = os.getenv('TSI_BOT_CALENDAR_URL')
+
+# Runtime used to receive updates: "polling" (telebot's polling loop) or "async" (AsyncRuntime).
+# The sharded webhook mode has its own entry point, webhook.py
+BOT_RUNTIME = os.getenv('TSI_BOT_RUNTIME', 'polling')
+handler_workers = 16
+
+# Webhook mode: public URL registered with Telegram (not registered when unset), address to listen on,
+# secret token Telegram sends back in every request, and the number of worker processes (one per core by default)
+WEBHOOK_URL = os.getenv('TSI_WEBHOOK_URL')
+WEBHOOK_HOST = os.getenv('TSI_WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('TSI_WEBHOOK_PORT', '8443'))
+WEBHOOK_SECRET = os.getenv('TSI_WEBHOOK_SECRET')
+webhook_workers = int(os.getenv('TSI_BOT_WORKERS', '0')) or os.cpu_count() or 1
+# Updates waiting for each worker before the front end answers 503 and Telegram retries later
+webhook_queue_size = 1024
+# Seconds between checks of the items snapshot and the prefetched events by the workers
+items_reload_seconds = 30
+# Seconds between the metrics reports of the workers to the coordinator exporting them
+metrics_report_seconds = 5
+# Process the numbers of /stats come from, set in webhook workers whose /stats covers only their own updates
+stats_scope = None
 
 # Define a global variable to store the values dictionary
 items = {}
 
-# ascii teachers names
-unidecode_teachers = []
+# ETag and content hash of the last items response, to skip unchanged responses
+items_version = (None, None)
+
+# Modification time of the items snapshot the items were loaded from, so other processes' refreshes are noticed
+items_snapshot_mtime = None
+
+# Reverse lookup indexes over items, replaced as a whole on every items refresh
+items_index = ItemsIndex({})
 
 # Define the list of possible keys for the start and end dates
 start_date_keys = ['startTime', 'startDate', 'startDateTime']
 end_date_keys = ['endTime', 'endDate', 'endDateTime']
 
+# Format of schedule replies: "full", "compact" or "table"
+schedule_format = os.getenv('TSI_SCHEDULE_FORMAT', 'full')
+
 # Define fuzzy match score
 match_score = 70
 
+# Schedule cache settings
+schedule_cache_ttl = 600
+schedule_cache_size = 256
+
+# Rendered replies to questions about one day of a group's schedule
+reply_cache_ttl = schedule_cache_ttl
+reply_cache_size = 4096
+reply_cache = ReplyCache(reply_cache_ttl, reply_cache_size)
+
+# Prefetch the events of all groups for this many days ahead, one request per chunk
+prefetch_days = 14
+prefetch_chunk_days = 7
+# Prefetched events older than this many seconds are not used to answer requests
+prefetch_max_age = 2 * 24 * 60 * 60
+
+# Periods longer than this many days are fetched in chunks of days, on a pool of fetch_chunk_workers threads
+fetch_chunk_days = 7
+fetch_chunk_workers = 4
+fetch_executor = ThreadPoolExecutor(max_workers=fetch_chunk_workers, thread_name_prefix='fetch')
+
+# Length of a lesson, events only carry their start time
+lesson_minutes = 90
+
+# Calendar feeds cover this many days from today
+calendar_days = prefetch_days
+calendar_feed = CalendarFeed(lesson_minutes * 60)
+
+# Notification defaults of /subscribe, and how often subscriptions and events are planned again
+default_reminder_minutes = 15
+default_digest_hour = 8
+notification_plan_minutes = 15
+
+# Teacher name matcher, rebuilt together with the lookup indexes
+teacher_matcher = TeacherMatcher({}, match_score)
+
 
 # Handle the "/start" command
 @bot.message_handler(commands=['start'])
 def start_message(message):
-    bot.send_message(message.chat.id, '''Hi there! I'm your personal university assistant. I'm here to help you stay on top of your academic life.
+    outbox.send_message(message.chat.id, '''Hi there! I'm your personal university assistant. I'm here to help you stay on top of your academic life.
 
 To get started, select your group number by using /selectgroup command or just by asking me to change it and I'll keep you updated on your schedule and important deadlines. If you ever need to change your group or check your schedule, just let me know.
 
@@ -56,139 +182,123 @@ Don't hesitate to ask me anything related to your studies. I'm here to help you
 
 # Define a function to fill the items dictionary with the latest values from the API
 def fill_items_dict():
-    global items
+    global items, items_index, teacher_matcher, items_version
 
     try:
-        # Make a request to the values API and store the response as a dictionary
-        response = requests.get(items_url)
-        string_data = response.content.decode('utf-8')[1:-1].replace(')(', '')
-        content = json.loads(string_data)
-        data = content.get('d')
-        new_items = json.loads(data)
-        if new_items:
-            if not new_items == items:
-                items = new_items
-                json.dump(new_items, open('items.json', 'w'), indent=4, ensure_ascii=False)
-                print('Successfully saved items')
-                fill_groups_table()
+        # Make a conditional request to the values API, unchanged responses are not even decoded
+        etag, digest = items_version
+        new_items, etag, digest = tsi_client.get_items_if_changed(etag, digest)
+        if new_items is None:
+            items_version = (etag, digest)
+            log.debug('No new items')
+        elif new_items:
+            diff = diff_items(items, new_items)
+            if diff:
+                log.info('Items changed: %s', describe(diff))
+                fill_groups_table(items.get('groups', {}), new_items.get('groups', {}))
+
+                # Rebuild only the derived structures of the changed sections, then swap everything in
+                new_index = ItemsIndex(new_items, items_index, diff)
+                new_matcher = TeacherMatcher(new_items.get('teachers', {}), match_score, previous=teacher_matcher) if 'teachers' in diff else teacher_matcher
+                items_index, teacher_matcher, items = new_index, new_matcher, new_items
+                reply_cache.clear()
+
+                write_snapshot(ITEMS_FILE, new_items)
+                snapshot.write_snapshot(ITEMS_SNAPSHOT_FILE, ITEMS_FILE, new_items, new_index, new_matcher)
+                log.info('Successfully saved items')
             else:
-                print('No new items')
+                log.debug('No new items')
+            items_version = (etag, digest)
         else:
-            print('Received empty Items')
+            log.warning('Received empty Items')
     except Exception as e:
         # Handle any exceptions that might be raised during the execution of the function
-        print(f"Error: {e}")
-
-
-# Function to fill available_groups table with group numbers from an API
-def fill_groups_table():
-    if items.get('groups'):
-        # If the request is successful, parse the response JSON to extract group numbers
-        groups = items['groups'].values()
+        log.error('Items refresh failed: %s', e)
 
-        # Create a new connection and cursor object
-        conn = sqlite3.connect(DATABASE_FILE)
-        c = conn.cursor()
 
-        # Clear any existing data from the available_groups table
-        c.execute("DELETE FROM groups")
+# Function to update the groups table with the group numbers that were added or removed from items
+def fill_groups_table(old_groups, new_groups):
+    if new_groups:
+        added, removed = name_changes(old_groups, new_groups)
 
-        # Insert the new groups into the available_groups table
-        for group in groups:
-            c.execute("INSERT INTO groups (group_number) VALUES (?)", (group,))
-
-        # Commit the changes to the database
-        conn.commit()
-        print("Groups table updated successfully.")
+        # Apply only the changes in a single transaction, unless the table is out of sync with the old items
+        if database.count_groups(DATABASE_FILE) != len(set(old_groups.values())):
+            database.replace_groups(DATABASE_FILE, new_groups.values())
+        elif added or removed:
+            database.update_groups(DATABASE_FILE, added, removed)
+        log.info("Groups table updated successfully.")
     else:
         # If the request fails, log an error message
-        print("Failed to retrieve groups from items.")
+        log.error("Failed to retrieve groups from items.")
 
 
 def timed_update():
-    print(datetime.now().strftime('%d.%m.%Y - %H:%M:%S'))
-
-
-def background_tasks():
-    scheduler = BlockingScheduler()
-    scheduler.add_job(timed_update, trigger="interval", minutes=1)
-    scheduler.add_job(fill_items_dict, trigger="interval", hours=1)
-    scheduler.start()
+    log.debug(datetime.now().strftime('%d.%m.%Y - %H:%M:%S'))
 
 
-    def map_event(event):
-        # Replace the room ID with its corresponding value
-        room_id = event[1][0] if len(event[1]) > 0 else None
-        room_value = items["rooms"].get(str(room_id), "Not specified")
-        event[1] = room_value
-
-        # Replace the group IDs with their corresponding values
-        group_ids = event[2]
-        group_values = [items["groups"].get(str(group_id), "") for group_id in group_ids]
-        event[2] = group_values
+# Prefetch the events of all groups for the coming days into the events table
+def prefetch_events():
+    try:
+        # Days start at midnight in Riga, like the windows of the questions answered from the prefetch
+        start = datetime.now(riga).replace(hour=0, minute=0, second=0, microsecond=0)
+        from_time = int(start.timestamp())
+        to_time = int((start + timedelta(days=prefetch_days)).timestamp()) - 1
+
+        # Download every chunk first, then decode the events one by one straight into the database
+        contents = [tsi_client.get_events_content(chunk_start, chunk_end)
+                    for chunk_start, chunk_end in plan_chunks(from_time, to_time, prefetch_chunk_days)]
+        events = itertools.chain.from_iterable(iter_events(content) for content in contents)
+
+        count = event_store.store_events(DATABASE_FILE, events, from_time, to_time)
+        log.info('Prefetched %d events', count)
+    except Exception as e:
+        log.error('Prefetching events failed: %s', e)
+    load_room_index()
 
-        # Replace the teacher ID with its corresponding value
-        teacher_id = event[3]
-        teacher_value = items["teachers"].get(str(teacher_id), "")
-        event[3] = teacher_value
 
-        return event
+def add_background_jobs(scheduler):
+    scheduler.add_job(timed_update, trigger="interval", minutes=1)
+    scheduler.add_job(fill_items_dict, trigger="interval", hours=1, next_run_time=datetime.now())
+    scheduler.add_job(prefetch_events, trigger="cron", hour=3, next_run_time=datetime.now())
+    # One job plans the notifications of all subscribers, they are then timed by the notifier itself
+    scheduler.add_job(notifier.plan, trigger="interval", minutes=notification_plan_minutes, next_run_time=datetime.now())
+    scheduler.add_job(purge_conversations, trigger="interval", minutes=conversation_purge_minutes)
+    return scheduler
 
 
-def check_items():
-    # Set the API endpoint URL
-    # url = "https://services.tsi.lv/schedule/api/service.asmx/GetLocalizedEvents?from=1674649373&to=1677327773&teachers=&rooms=&groups=&lang=%27en%27"
-    url = "https://services.tsi.lv/schedule/api/service.asmx/GetLocalizedEvents?from=1676476800&to=1676484900&teachers=&rooms=&groups=&lang=%27en%27"
+# Delete the conversation steps nobody answered
+def purge_conversations():
+    try:
+        log.info('Purged %d expired conversations', conversations.purge())
+    except Exception as e:
+        log.error('Purging conversations failed: %s', e)
 
-    # Set any required query parameters for the API request
-    params = {
-        "parameter1": "value1",
-        "parameter2": "value2"
-    }
 
-    # Send an HTTP GET request to the API endpoint with the query parameters
-    response = requests.get(url, params=params)
-    string_data = response.content.decode('utf-8')[1:-1].replace(')(', '')
-    a = json.loads(string_data)
-    data = json.loads(a.get('d'))
-    print(data)
-    print(json.dumps(data, indent=4, ensure_ascii=False))
+def background_tasks():
+    add_background_jobs(BlockingScheduler()).start()
 
-    events = data['events']['values']
-    mapped_events = [map_event(event) for event in events]
 
-    message = ''
-    last_date = None
-    for event in mapped_events:
-        dt_object = datetime.fromtimestamp(event[0])
-        date_string = dt_object.strftime("%d.%m.%Y")
-        time_string = dt_object.strftime("%H:%M")
-        room = event[1][0] if len(event[1]) > 0 else 'TBA'
-        groups = ", ".join(event[2]) if len(event[2]) > 0 else 'Not specified'
-        teacher = event[3]
-        name = event[4]
+# Resolve the room, group and teacher IDs of an event to their names.
+# Returns a new list since events may be shared through the schedule cache.
+def map_event(event):
+    event = list(event)
 
-        if not last_date == date_string:
-            last_date = date_string
-            message += f'{date_string}\n\n'
+    # Replace the room ID with its corresponding value
+    room_id = event[1][0] if len(event[1]) > 0 else None
+    event[1] = items["rooms"].get(str(room_id), "Not specified")
 
-        message += f'{name} with {teacher}\nRoom: {room}\nGroups: {groups}\nTime: {time_string}\n\n'
+    # Replace the group IDs with their corresponding values
+    event[2] = [items["groups"].get(str(group_id), "") for group_id in event[2]]
 
-    if not message:
-        # If there are no events for the given group, return a message indicating this
-        message = 'No events found for this group.'
+    # Replace the teacher ID with its corresponding value
+    event[3] = items["teachers"].get(str(event[3]), "")
 
-    print(message)
+    return event
 
 
 def get_student_group(chat_id):
-    conn = sqlite3.connect(DATABASE_FILE)
-    c = conn.cursor()
-
     # Check if the user has already selected a group
-    c.execute("SELECT * FROM students WHERE chat_id = ?", (chat_id,))
-    rows = c.fetchall()
-    return rows[0][1] if rows else None
+    return student_groups.get(chat_id)
 
 
 # Handle the "/selectgroup" command
@@ -200,72 +310,58 @@ def select_group(message):
         # If the user has already selected a group, include it in the message and give them an option to cancel the command
         keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
         keyboard.add(types.KeyboardButton("Cancel"))
-        bot.send_message(chat_id=message.chat.id, text=f"Your current group is {group}.\nPlease enter your new group number:", reply_markup=keyboard)
+        outbox.send_message(chat_id=message.chat.id, text=f"Your current group is {group}.\nPlease enter your new group number:", reply_markup=keyboard)
         bot.register_next_step_handler(message, set_group)
     else:
         # If the user has not yet selected a group, ask them to provide their group number
         keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
         keyboard.add(types.KeyboardButton("Cancel"))
-        bot.send_message(chat_id=message.chat.id, text="Please enter your group number:", reply_markup=keyboard)
+        outbox.send_message(chat_id=message.chat.id, text="Please enter your group number:", reply_markup=keyboard)
         bot.register_next_step_handler(message, set_group)
 
 
 # Handler to receive the user's group number and store it in the database
 def set_group(message):
-    # Retrieve the group number from the user's message
-    group = message.text.upper()
+    # Retrieve the group number from the user's message, in the spelling of items when only case, dashes or spaces differ
+    group = items_index.group_resolver.find(message.text) or message.text.upper()
 
     if group == "CANCEL":
         # If the user chooses to cancel the command, clear the keyboard and end the conversation
         hide_keyboard = types.ReplyKeyboardRemove()
-        bot.send_message(chat_id=message.chat.id, text="Canceled", reply_markup=hide_keyboard)
+        outbox.send_message(chat_id=message.chat.id, text="Canceled", reply_markup=hide_keyboard)
         return
 
-    # Create a new connection and cursor object
-    conn = sqlite3.connect(DATABASE_FILE)
-    c = conn.cursor()
-
     # Query the database for groups that match the user's input
-    c.execute("SELECT * FROM groups WHERE group_number = ?", (group,))
-    rows = c.fetchall()
-
-    if len(rows) == 0:
-        # If the entered group number is not valid, send a message with available groups that match the user's input
-        c.execute("SELECT DISTINCT group_number FROM groups WHERE group_number LIKE ?", ('%' + group + '%',))
-        rows = c.fetchall()
+    if not database.group_exists(DATABASE_FILE, group):
+        # If the entered group number is not valid, send a message with the closest groups, or the groups containing the user's input
+        rows = [suggestion for suggestion, _ in items_index.group_resolver.suggest(message.text)] or database.search_groups(DATABASE_FILE, group)
         if len(rows) > 0:
             # If there are available groups that match the user's input, send a message with keyboard keys containing the available groups
             keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
             for row in rows:
-                keyboard.add(types.KeyboardButton(row[0]))
+                keyboard.add(types.KeyboardButton(row))
 
             keyboard.add(types.KeyboardButton("Cancel"))
-            bot.send_message(chat_id=message.chat.id, text="Sorry, the entered group number is not valid. Please select your group from the following options:", reply_markup=keyboard)
+            outbox.send_message(chat_id=message.chat.id, text="Sorry, the entered group number is not valid. Please select your group from the following options:", reply_markup=keyboard)
             # Set up a handler to receive the user's selection
             bot.register_next_step_handler(message, set_group_keyboard)
         else:
             # If there are no available groups that match the user's input, ask the user to try again
-            bot.send_message(chat_id=message.chat.id, text="Sorry, no groups were found that match your input. Please try again.")
+            outbox.send_message(chat_id=message.chat.id, text="Sorry, no groups were found that match your input. Please try again.")
             select_group(message)
     else:
-        # Check if the user has already selected a group
-        c.execute("SELECT * FROM students WHERE chat_id = ?", (message.chat.id,))
-        rows = c.fetchall()
+        # Check if the user has already selected a group, then insert or update their group in the database
+        had_group = get_student_group(message.chat.id) is not None
+        student_groups.set(message.chat.id, group)
 
-        if len(rows) > 0:
-            # If the user has already selected a group, update their group value in the database
-            c.execute("UPDATE students SET group_number = ? WHERE chat_id = ?", (group, message.chat.id))
-            conn.commit()
+        if had_group:
             # Send a confirmation message to the user
             hide_keyboard = types.ReplyKeyboardRemove()
-            bot.send_message(chat_id=message.chat.id, text=f"Your group {group} has been updated successfully!", reply_markup=hide_keyboard)
+            outbox.send_message(chat_id=message.chat.id, text=f"Your group {group} has been updated successfully!", reply_markup=hide_keyboard)
         else:
-            # If the user has not yet selected a group, insert a new row with their chat ID and group number
-            c.execute("INSERT INTO students (chat_id, group_number) VALUES (?, ?)", (message.chat.id, group))
-            conn.commit()
             # Send a confirmation message to the user
             hide_keyboard = types.ReplyKeyboardRemove()
-            bot.send_message(chat_id=message.chat.id, text=f"Your group {group} has been set successfully!", reply_markup=hide_keyboard)
+            outbox.send_message(chat_id=message.chat.id, text=f"Your group {group} has been set successfully!", reply_markup=hide_keyboard)
 
 
 # Handler to receive the user's selection from the keyboard and call the set_group function
@@ -278,36 +374,33 @@ def search_groups(message):
     # Retrieve the user's search term
     search_term = message.text.lower()
 
-    # Create a new connection and cursor object
-    conn = sqlite3.connect(DATABASE_FILE)
-    c = conn.cursor()
-
     # Query the database for groups matching the search term
-    c.execute("SELECT DISTINCT group_number FROM students WHERE group_number LIKE ?", ('%' + search_term + '%',))
-    rows = c.fetchall()
+    rows = database.search_groups(DATABASE_FILE, search_term)
 
     if len(rows) == 0:
         # If no matching groups were found, ask the user to try again
-        bot.send_message(chat_id=message.chat.id, text="No groups matching your search were found. Please try again.")
+        outbox.send_message(chat_id=message.chat.id, text="No groups matching your search were found. Please try again.")
         select_group(message)
 
     elif len(rows) == 1:
         # If only one matching group was found, store it in the database and send a confirmation message to the user
-        group = rows[0][0]
-        c.execute("INSERT INTO students (chat_id, group_number) VALUES (?, ?)", (message.chat.id, group))
-        conn.commit()
-        bot.send_message(chat_id=message.chat.id, text="Your group has been saved. Thank you!")
+        group = rows[0]
+        student_groups.set(message.chat.id, group)
+        outbox.send_message(chat_id=message.chat.id, text="Your group has been saved. Thank you!")
 
     else:
         # If multiple matching groups were found, send a list of options to the user
-        options = [row[0] for row in rows]
-        options_str = "\n".join(options)
-        bot.send_message(chat_id=message.chat.id, text="Multiple groups were found. Please select your group from the list:\n\n" + options_str)
+        options_str = "\n".join(rows)
+        outbox.send_message(chat_id=message.chat.id, text="Multiple groups were found. Please select your group from the list:\n\n" + options_str)
 
         # Set up a handler to receive the user's selection
         bot.register_next_step_handler(message, set_group)
 
 
+# Functions a conversation may wait in, stored by name
+conversations.add_steps(set_group, set_group_keyboard)
+
+
 # Define a function to extract the start date from a dictionary of parameters
 def extract_start_date(parameters):
     for key in start_date_keys:
@@ -327,67 +420,257 @@ def extract_end_date(parameters):
 
 
 def find_group_key(group_text):
-    for key, value in items.get('groups').items():
-        if value == group_text:
-            return key
-
-    return None
+    return items_index.find_group_key(group_text)
 
 
 def find_teacher_key(teacher_text):
-    for key, value in items.get('teachers').items():
-        if value == teacher_text:
-            return key
-
-    return None
+    return items_index.find_teacher_key(teacher_text)
 
 
 # Define a function to fuzzy match a search string to a teacher name
 def match_teacher(search_string):
+    if not teacher_matcher.teacher_names:
+        log.error('Error no teachers')
+        return None
 
-    # print(search_string)
+    matches = teacher_matcher.match(search_string)
+    return list(matches) if type(matches) is tuple else matches
 
-    teacher_names = items.get('teachers')
-    if teacher_names:
-        teacher_names = [t for t in list(teacher_names.values())]
-    else:
-        print('Error no teachers')
+
+# Request events for the given group and teacher IDs from the API, returning the decoded data or None on failure
+def fetch_events(group_ids, teacher_ids, from_time, to_time):
+    groups = f'\'{",".join(str(group_id) for group_id in group_ids)}\'' if group_ids else ''
+    teachers = f'\'{",".join(str(teacher_id) for teacher_id in teacher_ids)}\'' if teacher_ids else ''
+    log.debug('Events request: groups=%s teachers=%s from=%s to=%s', groups, teachers, from_time, to_time)
+
+    try:
+        return tsi_client.get_events(from_time, to_time, groups=groups, teachers=teachers)
+    except UpstreamError as e:
+        log.error('Events request failed: %s', e)
         return None
 
-    # Check if there are multiple matches with the same score
-    fuzzy_matches = process.extract(search_string, teacher_names, limit=20)
-    unidecode_matches = process.extract(search_string, unidecode_teachers, limit=20)
-
-    partial_matches = []
-
-    if len(fuzzy_matches) > 1:
-        # print(fuzzy_matches)
-        fuzzy_matches = [result[0] for result in fuzzy_matches if result[1] == fuzzy_matches[0][1]]
-        # print(fuzzy_matches)
-        for m in fuzzy_matches:
-            score_1 = fuzz.ratio(m.split()[0], search_string)
-            score_2 = fuzz.ratio(m.split()[1], search_string)
-            if score_1 > match_score or score_2 > match_score:
-                print(m, search_string, score_1 if score_1 > score_2 else score_2)
-                partial_matches.append(m)
-
-    if len(unidecode_matches) > 1:
-        unidecode_matches = [result[0] for result in unidecode_matches if result[1] == unidecode_matches[0][1]]
-
-        for m in unidecode_matches:
-            teacher_name = teacher_names[unidecode_teachers.index(m)]
-            score_1 = fuzz.ratio(m.split()[0], search_string)
-            score_2 = fuzz.ratio(m.split()[1], search_string)
-            if (score_1 > match_score or score_2 > match_score) and teacher_name not in partial_matches:
-                print(teacher_name, search_string, score_1 if score_1 > score_2 else score_2)
-                partial_matches.append(teacher_name)
-
-    if len(partial_matches) > 1:
-        return partial_matches
-    elif len(partial_matches) == 1:
-        return partial_matches[0]
+
+# Cache of schedule API responses shared by all handlers
+schedule_cache = ScheduleCache(fetch_events, schedule_cache_ttl, schedule_cache_size)
+
+
+# Events of the subscribed groups for the notifier, from the prefetched events or else one request per group,
+# so that a group whose events cannot be loaded only misses its own notifications
+def notification_events(group_ids, from_time, to_time):
+    data = event_store.query_events(DATABASE_FILE, group_ids, [], from_time, to_time, prefetch_max_age)
+    if data is not None:
+        return data['events']['values']
+
+    # Events shared by several groups come back in the response of each of them
+    events = {}
+    loaded = 0
+    for group_id in group_ids:
+        try:
+            data = schedule_cache.get([str(group_id)], [], from_time, to_time)
+            if data is None or not data.get('events'):
+                raise UpstreamError(data.get('Message') if data else 'No events response')
+            for event in data['events']['values']:
+                events.setdefault((event[0], tuple(event[1]), tuple(event[2]), event[3], event[4]), event)
+            loaded += 1
+        except Exception as e:
+            log.error('Loading the events of group %s for notifications failed: %s', group_id, e)
+    return list(events.values()) if loaded else None
+
+
+# Notifications of subscribed students, sent through the dispatcher
+notifier = Notifier(outbox, lambda: database.subscribers_by_group(DATABASE_FILE), notification_events, find_group_key, map_event)
+
+
+# Handle the "/subscribe [minutes] [digest hour]" command
+@bot.message_handler(commands=['subscribe'])
+def subscribe(message):
+    if not get_student_group(message.chat.id):
+        outbox.send_message(message.chat.id, 'Please select your group with /selectgroup first.')
+        return
+
+    arguments = message.text.split()[1:]
+    try:
+        reminder_minutes = int(arguments[0]) if len(arguments) > 0 else default_reminder_minutes
+        digest_hour = int(arguments[1]) if len(arguments) > 1 else default_digest_hour
+    except ValueError:
+        outbox.send_message(message.chat.id, 'Usage: /subscribe [minutes before each class] [hour of the daily digest]')
+        return
+    if not 0 <= reminder_minutes <= 24 * 60 or not 0 <= digest_hour <= 23:
+        outbox.send_message(message.chat.id, 'Usage: /subscribe [minutes before each class] [hour of the daily digest]')
+        return
+
+    database.set_subscription(DATABASE_FILE, message.chat.id, digest_hour, reminder_minutes or None)
+    text = f"You will get your schedule every day at {digest_hour:02d}:00"
+    if reminder_minutes:
+        text += f" and a reminder {reminder_minutes} minutes before each class"
+    outbox.send_message(message.chat.id, text + '. Use /unsubscribe to stop.')
+
+
+# Handle the "/unsubscribe" command
+@bot.message_handler(commands=['unsubscribe'])
+def unsubscribe(message):
+    if database.remove_subscription(DATABASE_FILE, message.chat.id):
+        outbox.send_message(message.chat.id, "You won't get schedule notifications anymore.")
     else:
-        return None
+        outbox.send_message(message.chat.id, "You are not subscribed to schedule notifications.")
+
+
+# Occupancy of every room, built from the prefetched events of all groups
+room_index = RoomIndex(lesson_minutes * 60)
+
+
+# Update the room index when a prefetch was stored since it was last built, possibly by another process,
+# and drop the cached replies whose events the prefetch changed
+def load_room_index():
+    try:
+        window = event_store.coverage(DATABASE_FILE)
+        if window is None or window[2] == room_index.version:
+            return
+        data = event_store.query_events(DATABASE_FILE, [], [], window[0], window[1], prefetch_max_age)
+        if data is not None:
+            changed = room_index.update(data['events']['values'], window[0], window[1], version=window[2])
+            log.info('Room index updated, %d rooms changed', changed)
+            batch = EventBatch(data['events']['values'])
+            dropped = reply_cache.revalidate(lambda group_id, from_time, to_time: rows_digest(
+                batch, batch.rows_in_window(from_time, to_time, batch.rows_with_group(group_id)))
+                if window[0] <= from_time and to_time <= window[1] else None)
+            log.info('Reply cache revalidated, %d replies dropped', dropped)
+    except Exception as e:
+        log.error('Loading the room index failed: %s', e)
+
+
+_clock_time = re.compile(r'\b([01]?\d|2[0-3])[:.]([0-5]\d)\b')
+
+
+# Timestamps of the HH:MM times in the text, on the day of now
+def parse_clock_times(text, now):
+    return [int(now.replace(hour=int(hour), minute=int(minute), second=0, microsecond=0).timestamp())
+            for hour, minute in _clock_time.findall(text)]
+
+
+# Time of day of a timestamp in Riga time, with the date when it is not the day of now
+def format_local_time(timestamp, now):
+    date_string, time_string = local_strings(timestamp)
+    return time_string if date_string == now.strftime('%d.%m.%Y') else f'{time_string} on {date_string}'
+
+
+def send_free_rooms(chat_id, now, from_time=None, to_time=None):
+    from_time = from_time or int(now.timestamp())
+    to_time = to_time or from_time + lesson_minutes * 60
+    if to_time <= from_time:
+        outbox.send_message(chat_id, 'Usage: /freerooms [from HH:MM] [to HH:MM]')
+        return
+    if not room_index.covers(from_time, to_time):
+        outbox.send_message(chat_id, 'Room occupancy is not known for that time yet.')
+        return
+
+    with metrics.timer('free_rooms'):
+        rooms = items.get('rooms', {})
+        free = room_index.free_rooms([int(key) for key in rooms], from_time, to_time)
+        names = sorted(rooms[str(room_id)] for room_id in free)
+    period = f'from {format_local_time(from_time, now)} to {format_local_time(to_time, now)}'
+    if names:
+        outbox.send_message(chat_id, f'Free rooms {period}:\n' + ', '.join(names))
+    else:
+        outbox.send_message(chat_id, f'No rooms are free {period}.')
+
+
+# Handle the "/freerooms [from HH:MM] [to HH:MM]" command, by default for one lesson from now
+@bot.message_handler(commands=['freerooms'])
+def free_rooms(message):
+    now = datetime.now(riga)
+    times = parse_clock_times(message.text, now)
+    send_free_rooms(message.chat.id, now, *times[:2])
+
+
+# Handle the "/freeroom <room>" command: when the room is free next, for at least one lesson
+@bot.message_handler(commands=['freeroom'])
+def free_room(message):
+    key = items_index.find_room_key(' '.join(message.text.split()[1:]))
+    if key is None:
+        outbox.send_message(message.chat.id, 'Usage: /freeroom <room>, for example /freeroom 101')
+        return
+
+    now = datetime.now(riga)
+    with metrics.timer('free_rooms'):
+        start, end = room_index.next_free(int(key), int(now.timestamp()))
+    if not room_index.covers(start, start):
+        outbox.send_message(message.chat.id, 'Room occupancy is not known for that time yet.')
+        return
+
+    text = f"Room {items['rooms'][key]} is free " + ('now' if start <= now.timestamp() else f'from {format_local_time(start, now)}')
+    if end is not None:
+        text += f' until {format_local_time(end, now)}'
+    outbox.send_message(message.chat.id, text + '.')
+
+
+# Resolve a group name, or a teacher ID or name, to the (kind, key, name) of its calendar, None when unknown
+def calendar_selection(kind, text):
+    index = items_index
+    if kind == 'group':
+        key = index.resolve_group_key(text)
+        return ('group', key, index.items['groups'][key]) if key else None
+    key = text if text in items.get('teachers', {}) else index.find_teacher_key(text)
+    return ('teacher', key, items['teachers'][key]) if key else None
+
+
+# ETag and body generator of the calendar of a selection for the coming calendar_days days
+def calendar_document(selection):
+    kind, key, name = selection
+    from_time = int(datetime.now(riga).replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
+    days = plan_chunks(from_time, from_time + calendar_days * 86400 - 1, 1)
+    group_ids, teacher_ids = ([key], []) if kind == 'group' else ([], [key])
+    data = fetch_window(group_ids, teacher_ids, days[0][0], days[-1][1])
+    if data is None or data.get('Message') or not data.get('events'):
+        raise UpstreamError(data.get('Message') if data else 'No events response')
+
+    if kind == 'group':
+        batch, rows = batch_for(data['events']['values'], group_id=int(key))
+    else:
+        batch, rows = batch_for(data['events']['values'], teacher_id=int(key))
+    with metrics.timer('calendar'):
+        return calendar_feed.build(selection[:2], f'{name} schedule', batch, rows, days, items)
+
+
+# Feed of the calendar endpoint
+def calendar_feed_for(kind, text):
+    selection = calendar_selection(kind, text)
+    return calendar_document(selection) if selection else None
+
+
+# Handle the "/calendar [group or teacher]" command: send the .ics file of the coming days, by default of the user's group
+@bot.message_handler(commands=['calendar'])
+def calendar(message):
+    text = ' '.join(message.text.split()[1:]) or get_student_group(message.chat.id)
+    if not text:
+        outbox.send_message(message.chat.id, 'Usage: /calendar <group or teacher>, or select your group with /selectgroup first')
+        return
+
+    selection = calendar_selection('group', text) or calendar_selection('teacher', text)
+    if selection is None:
+        teachers = teacher_matcher.match_tokens(text.split())
+        selection = calendar_selection('teacher', teachers[0]) if len(teachers) == 1 else None
+    if selection is None:
+        outbox.send_message(message.chat.id, f'''Couldn't find group or teacher {text}''')
+        return
+
+    try:
+        _, body = calendar_document(selection)
+    except Exception as e:
+        log.error('Calendar export failed: %s', e)
+        outbox.send_message(message.chat.id, 'The schedule is not available right now, please try again later.')
+        return
+
+    caption = None
+    if CALENDAR_URL:
+        caption = f"Subscribe in your calendar app to keep it up to date: {CALENDAR_URL.rstrip('/')}/{selection[0]}/{quote(str(selection[1] if selection[0] == 'teacher' else selection[2]))}.ics"
+    # Telegram needs the whole file, only the feed endpoint streams it
+    outbox.submit(message.chat.id, send_calendar_file, message.chat.id, ''.join(body).encode(), f'{selection[2]}.ics', caption)
+
+
+# Upload a calendar file, from a new stream on every attempt since the outbox may retry the call
+def send_calendar_file(chat_id, data, file_name, caption=None):
+    return bot.send_document(chat_id, types.InputFile(io.BytesIO(data), file_name), caption=caption)
 
 
 def check_schedule(message, parameters):
@@ -411,71 +694,73 @@ def check_schedule(message, parameters):
             dt_datetime = datetime.strptime(date_data, '%Y-%m-%dT%H:%M:%S%z')
 
     if dt_datetime:
-        bot.send_message(message.chat.id, f'{dt_datetime.strftime("%d.%m.%Y")}')
+        outbox.send_message(message.chat.id, f'{dt_datetime.strftime("%d.%m.%Y")}')
     elif dt_start and dt_end:
-        bot.send_message(message.chat.id, f'Start: {dt_start.strftime("%d.%m.%Y %H:%M")}\nEnd: {dt_end.strftime("%d.%m.%Y %H:%M")}')
+        outbox.send_message(message.chat.id, f'Start: {dt_start.strftime("%d.%m.%Y %H:%M")}\nEnd: {dt_end.strftime("%d.%m.%Y %H:%M")}')
     else:
-        bot.send_message(message.chat.id, f'Unrecognised time period:\n\n{parameters}')
+        outbox.send_message(message.chat.id, f'Unrecognised time period:\n\n{parameters}')
         return
 
     # Get all teachers that message contains
-    matching_teachers = []
-
-    for t in message.text.split():
-        matches = match_teacher(t)
-        if type(matches) == str:
-            matching_teachers.append(matches)
-        elif type(matches) == list:
-            matching_teachers = matching_teachers + matches
-        elif not matches:
-            pass
-        else:
-            print(f'Unrecognized type({type(matches)})')
-
-    matching_teachers = set(matching_teachers)
-
-    print('Teachers:')
-    for t in matching_teachers:
-        print(t)
+    with metrics.timer('teacher_match'):
+        matching_teachers = set(teacher_matcher.match_tokens(message.text.split()))
+    log.debug('Teachers: %s', matching_teachers)
 
     if parameters.get('group-text'):
         group_text = parameters.get('group-text')
     else:
         group_text = get_student_group(message.chat.id)
 
-    group_number = find_group_key(group_text)
+    # Take one reference so the whole request uses the same index even if items are refreshed meanwhile
+    index = items_index
+    resolve_started = time.perf_counter()
+    # Typos only one group is close to are corrected, otherwise the closest groups are suggested
+    group_number = index.resolve_group_key(group_text)
 
     if not group_text:
-        bot.send_message(message.chat.id, 'Please specify at least one group')
+        outbox.send_message(message.chat.id, 'Please specify at least one group')
         return
     elif not group_number:
-        bot.send_message(message.chat.id, f'''Couldn't find group {group_text}''')
-        bot.delete_message(message.chat.id, message.id)
+        suggestions = [group for group, _ in index.group_resolver.suggest(group_text)]
+        did_you_mean = f'. Did you mean {", ".join(suggestions)}?' if suggestions else ''
+        outbox.send_message(message.chat.id, f'''Couldn't find group {group_text}{did_you_mean}''')
+        outbox.submit(message.chat.id, bot.delete_message, message.chat.id, message.id)
         return
 
+    # One day of a group's schedule is answered from the rendered replies while its events are unchanged
+    reply_key = None
+    if dt_datetime and not matching_teachers:
+        reply_key = (int(group_number), dt_datetime.date().isoformat(), schedule_format)
+        chunks = reply_cache.get(reply_key)
+        metrics.increment('reply_cache', 'hit' if chunks is not None else 'miss')
+        if chunks is not None:
+            for chunk in chunks:
+                outbox.send_message(message.chat.id, chunk)
+            return
+
+    group_text = index.items['groups'][group_number]
+    matching_groups = []
+
     # Use a regular expression to split the group into a numeric part and a letter part
     match = re.match(r'(\d+)-?(\w+)', group_text)
     if match:
         numeric_part = match.group(1)
         letter_part = match.group(2)
 
-        # Use the numeric and letter parts to filter the list of groups
-        matching_groups = [group for group in items.get('groups').values() if re.match(r'^\d{}.*{}$'.format(numeric_part[1:2], letter_part), group)]
+        # Use the numeric and letter parts to look up the family of groups
+        matching_groups = index.group_family(numeric_part, letter_part)
 
         # Print the resulting list of matching groups
         # for group in matching_groups:
         #     print(group)
 
     else:
-        print('Invalid group number')
+        log.warning('Invalid group number %s', group_text)
 
 
-    # Set any required query parameters for the API request
-    params = {
-        'groups': f'\'{",".join([find_group_key(x) for x in matching_groups])}\'' if matching_groups else '',
-        'teachers': f'\'{",".join([find_teacher_key(x) for x in matching_teachers])}\'' if matching_teachers else '',
-        'lang': '\'en\''
-    }
+    group_ids = list(dict.fromkeys(index.find_group_key(x) for x in matching_groups))
+    teacher_ids = [index.find_teacher_key(x) for x in matching_teachers]
+    metrics.observe('group_resolve', time.perf_counter() - resolve_started)
 
     from_time, to_time = 0, 0
 
@@ -486,129 +771,265 @@ def check_schedule(message, parameters):
         from_time = int(dt_start.timestamp())
         to_time = int(dt_end.timestamp())
 
-    params['from'] = from_time
-    params['to'] = to_time
+    # Long periods are fetched in chunks of days in parallel, and each chunk is sent as soon as it and the ones before it arrived
+    stream = ScheduleStream(group_text, schedule_format)
+    current_items = items
+    sent = []
+    for data in fetch_schedule(group_ids, teacher_ids, from_time, to_time):
+        if data is None or not data.get('events'):
+            if data is not None and data.get('Message'):
+                outbox.send_message(message.chat.id, data.get('Message'))
+            else:
+                outbox.send_message(message.chat.id, 'An error occurred. Please kindly send this to the developer.')
+            return
+
+        # Filter the events to only those with the desired group number
+        batch, rows = batch_for(data['events']['values'], group_id=int(group_number))
+        if reply_key:
+            # An expired reply rendered from the same events is sent again as it is
+            digest = rows_digest(batch, rows)
+            chunks = reply_cache.reuse(reply_key, digest)
+            if chunks is not None:
+                for chunk in chunks:
+                    outbox.send_message(message.chat.id, chunk)
+                return
+
+        # Resolve just the events of the group
+        mapped_events = batch.resolve(rows, current_items)
+        log.debug('%d events for group %s', len(mapped_events), group_text)
+
+        # Send the schedule back to the user, split into messages Telegram accepts
+        with metrics.timer('render'):
+            chunks = stream.add(mapped_events)
+        for chunk in chunks:
+            outbox.send_message(message.chat.id, chunk)
+        sent += chunks
+
+    for chunk in stream.finish():
+        outbox.send_message(message.chat.id, chunk)
+        sent.append(chunk)
+
+    # Replies rendered with items that were replaced meanwhile are not kept
+    if reply_key and current_items is items:
+        reply_cache.put(reply_key, digest, sent, from_time, to_time)
+
+
+# Answer from the prefetched events, falling back to the schedule cache which only asks the API on a miss
+def fetch_window(group_ids, teacher_ids, from_time, to_time):
+    with metrics.timer('fetch'):
+        data = event_store.query_events(DATABASE_FILE, group_ids, teacher_ids, from_time, to_time, prefetch_max_age)
+        metrics.increment('schedule_source', 'prefetched' if data is not None else 'cache_or_api')
+        if data is None:
+            data = schedule_cache.get(group_ids, teacher_ids, from_time, to_time)
+    return data
+
+
+# Yield the response data of the window, in chunks of fetch_chunk_days days fetched concurrently when it is longer
+def fetch_schedule(group_ids, teacher_ids, from_time, to_time):
+    chunks = plan_chunks(from_time, to_time, fetch_chunk_days)
+    if len(chunks) == 1:
+        yield fetch_window(group_ids, teacher_ids, from_time, to_time)
+        return
+    metrics.increment('chunked_fetches', amount=len(chunks))
+    for _, _, data in fetch_chunks(lambda start, end: fetch_window(group_ids, teacher_ids, start, end), chunks, fetch_executor):
+        yield data
 
-    print(json.dumps(params, indent=4))
 
-    url = "https://services.tsi.lv/schedule/api/service.asmx/GetLocalizedEvents?&rooms="
 
-    # Send an HTTP GET request to the API endpoint with the query parameters
-    response = requests.get(url, params=params)
-    if response.status_code == 200:
-        string_data = response.content.decode('utf-8')[1:-1].replace(')(', '')
-        a = json.loads(string_data)
-        data = json.loads(a.get('d'))
-        print(data)
-        # print(json.dumps(data, indent=4, ensure_ascii=False))
+def check_lecturer_contact(message):
+    # Retrieve the lecturer name parameter from the user's message
+    lecturer_name = message.text.split(" ")[1]
 
-        if data.get('events'):
+    # Call your function to retrieve the contact information for the specified lecturer
+    contact_info = get_lecturer_contact(lecturer_name)
 
-            events = data['events']['values']
+    # Send the contact information back to the user
+    outbox.submit(message.chat.id, bot.reply_to, message, contact_info)
 
-            # Filter the list of events to only those with the desired group number
-            filtered_events = [event for event in events if int(group_number) in event[2]]
 
-            mapped_events = [map_event(event) for event in filtered_events]
-            print(len(mapped_events))
+# Dialogflow client shared by all handlers, created on first use
+dialogflow_client = None
+dialogflow_client_lock = Lock()
 
-            schedule_text = ''
-            last_date = None
-            for event in mapped_events:
-                dt_object = datetime.utcfromtimestamp(event[0]).replace(tzinfo=pytz.UTC)
-                # Convert the UTC datetime object to Europe/Riga timezone
-                local_datetime = dt_object.astimezone(pytz.timezone('Etc/GMT+0'))
-                date_string = dt_object.strftime("%d.%m.%Y")
-                time_string = local_datetime.strftime("%H:%M")
-                room = event[1] if event[1] else 'Not specified'
-                groups = ", ".join(event[2]) if len(event[2]) > 0 else 'Not specified'
-                teacher = event[3].strip()
-                name = event[4].strip()
 
-                if not last_date == date_string:
-                    last_date = date_string
-                    schedule_text += f'{date_string}\n\n'
+def get_dialogflow_client():
+    global dialogflow_client
+    with dialogflow_client_lock:
+        if dialogflow_client is None:
+            dialogflow_client = dialogflow.SessionsClient()
+        return dialogflow_client
 
-                if len(str(schedule_text + f'{name} with {teacher}\nRoom: {room}\nGroups: {groups}\nTime: {time_string}\n\n')) > 4096:
-                    bot.send_message(message.chat.id, schedule_text)
-                    schedule_text = ''
 
-                schedule_text += f'{name} with {teacher}\nRoom: {room}\nGroups: {groups}\nTime: {time_string}\n\n'
-            if not schedule_text:
-                # If there are no events for the given group, return a message indicating this
-                schedule_text = f'No events found for group {group_text}.'
+# Send the text to Dialogflow in the session of the chat and return the response as a dictionary
+def detect_intent(text, session_id):
+    session_client = get_dialogflow_client()
+    session = session_client.session_path(DIALOGFLOW_PROJECT_ID, str(session_id))
+    text_input = dialogflow.types.TextInput(text=text, language_code=DIALOGFLOW_LANGUAGE_CODE)
+    query_input = dialogflow.types.QueryInput(text=text_input)
+    try:
+        with dialogflow_limiter:
+            response = session_client.detect_intent(session=session, query_input=query_input)
+    except InvalidArgument:
+        raise
 
-            # Send the schedule back to the user
-            bot.send_message(message.chat.id, schedule_text)
+    return MessageToDict(response._pb)
 
-        elif data.get('Message'):
-            bot.send_message(message.chat.id, data.get('Message'))
-        else:
-            bot.send_message(message.chat.id, 'An error occurred. Please kindly send this to the developer.')
-    else:
-        print(response.content)
-        print(response.status_code)
-        bot.send_message(message.chat.id, 'An error occurred. Please kindly send this to the developer.')
 
+# Local classifier for common messages, which skip Dialogflow
+intent_classifier = LocalIntentClassifier(lambda text: find_group_key(text) is not None)
 
 
-def check_lecturer_contact(message):
-    # Retrieve the lecturer name parameter from the user's message
-    lecturer_name = message.text.split(" ")[1]
+# Format the metrics and cache counters for the /stats command
+def format_stats():
+    snapshot = metrics.snapshot()
+    lines = [f"Uptime: {snapshot['uptime'] / 3600:.1f} h", '', 'Stage: count, mean, p50, p95, p99 (ms)']
+    for stage, values in sorted(snapshot['stages'].items()):
+        lines.append(f"{stage}: {values['count']}, {values['mean'] * 1000:.0f}, {values['p50'] * 1000:.0f}, "
+                     f"{values['p95'] * 1000:.0f}, {values['p99'] * 1000:.0f}")
+    if stats_scope:
+        lines[:0] = [f'Numbers of {stats_scope} only, the metrics endpoint adds up all workers', '']
+    counters = snapshot['counters']
+    requests_total = sum(counters.get('upstream_requests', {}).values())
+    errors_total = sum(counters.get('upstream_errors', {}).values())
+    lines += ['', f"Upstream errors: {errors_total}/{requests_total}" + (f" ({errors_total / requests_total:.1%})" if requests_total else '')]
+    for name, values in sorted(counters.items()):
+        lines.append(f"{name}: " + ', '.join(f'{label or "total"} {value}' for label, value in sorted(values.items())))
+    lines.append('')
+    for name, values in bot_stats().items():
+        lines.append(f"{name}: " + ', '.join(f'{key} {value:.2f}' if type(value) is float else f'{key} {value}' for key, value in values.items()))
+    return '\n'.join(lines)
 
-    # Call your function to retrieve the contact information for the specified lecturer
-    contact_info = get_lecturer_contact(lecturer_name)
 
-    # Send the contact information back to the user
-    bot.reply_to(message, contact_info)
+# Handle the "/stats" command, for admins only
+@bot.message_handler(commands=['stats'], func=lambda message: message.chat.id in ADMIN_CHAT_IDS)
+def stats(message):
+    outbox.send_message(message.chat.id, format_stats())
 
 
 # Handle plain text messages
 @bot.message_handler(func=lambda message: True)
 def handle_message(message):
-    text_to_be_analyzed = message.text
+    with metrics.timer('handle_message'):
+        answer_message(message)
 
-    session_client = dialogflow.SessionsClient()
-    session = session_client.session_path(DIALOGFLOW_PROJECT_ID, SESSION_ID)
-    text_input = dialogflow.types.TextInput(text=text_to_be_analyzed, language_code=DIALOGFLOW_LANGUAGE_CODE)
-    query_input = dialogflow.types.QueryInput(text=text_input)
-    try:
-        response = session_client.detect_intent(session=session, query_input=query_input)
-    except InvalidArgument:
-        raise
 
-    query_result_dict = MessageToDict(response._pb)
+def answer_message(message):
+    text_to_be_analyzed = message.text
+
+    # Answer common messages locally and only ask Dialogflow about the rest
+    with metrics.timer('local_intent'):
+        query_result = intent_classifier.classify(text_to_be_analyzed)
+    if query_result:
+        query_result_dict = {'queryResult': query_result}
+    else:
+        with metrics.timer('dialogflow'):
+            query_result_dict = detect_intent(text_to_be_analyzed, message.chat.id)
     intent = query_result_dict.get('queryResult').get('intent').get('displayName')
-    # print(json.dumps(query_result_dict.get('queryResult'), indent=4))
+    metrics.increment('intents', intent)
+    metrics.increment('intent_source', 'local' if query_result else 'dialogflow')
 
-    print("Detected intent:", intent)
-    print("Detected parameters:\n", json.dumps(dict(query_result_dict.get('queryResult').get('parameters')), indent=4))
-    print("Detected intent confidence:", query_result_dict.get('queryResult').get('intent_detectionConfidence'))
-    print("Fulfillment text:", query_result_dict.get('queryResult').get('fulfillmentText'))
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug('Detected intent', extra={'fields': {
+            'chat_id': message.chat.id, 'intent': intent,
+            'parameters': dict(query_result_dict.get('queryResult').get('parameters')),
+            'confidence': query_result_dict.get('queryResult').get('intentDetectionConfidence'),
+            'fulfillment_text': query_result_dict.get('queryResult').get('fulfillmentText')}})
 
     match intent:
         case 'SelectGroup':
             select_group(message)
         case 'CheckSchedule':
             check_schedule(message, query_result_dict.get('queryResult').get('parameters'))
+        case 'FreeRooms':
+            send_free_rooms(message.chat.id, datetime.now(riga))
         case _:
             hide_keyboard = types.ReplyKeyboardRemove()
-            bot.send_message(message.chat.id, query_result_dict.get('queryResult').get('fulfillmentText'), reply_markup=hide_keyboard)
+            outbox.send_message(message.chat.id, query_result_dict.get('queryResult').get('fulfillmentText'), reply_markup=hide_keyboard)
+
+
+# Collect the counters of the caches and the local intent classifier
+def bot_stats():
+    return {
+        'schedule_cache': schedule_cache.stats(),
+        'replies': reply_cache.stats(),
+        'student_groups': student_groups.stats(),
+        'conversations': conversations.stats(),
+        'rooms': room_index.stats(),
+        'calendars': calendar_feed.stats(),
+        'intents': intent_classifier.stats(),
+        'notifications': notifier.stats(),
+        'outbox': outbox.stats(),
+    }
 
 
-def init():
-    global items, unidecode_teachers
-    background_thread = Thread(target=background_tasks)
-    background_thread.start()
-    if os.path.isfile('items.json'):
-        items = json.load(open('items.json'))
-    fill_items_dict()
-    unidecode_teachers = [unidecode(t.lower()) for t in items.get('teachers').values()]
+# Load the items and their lookup structures from the snapshot, or from items.json when the snapshot is missing or stale
+def load_items():
+    global items, items_index, teacher_matcher, items_snapshot_mtime
+    items_snapshot_mtime = _snapshot_mtime()
+    try:
+        loaded = snapshot.load_snapshot(ITEMS_SNAPSHOT_FILE, ITEMS_FILE)
+    except Exception as e:
+        log.error("Error loading items snapshot: %s", e)
+        loaded = None
+
+    if loaded is not None:
+        items, items_index, teacher_matcher = loaded
+    elif os.path.isfile(ITEMS_FILE):
+        items = json.load(open(ITEMS_FILE))
+        items_index = ItemsIndex(items)
+        teacher_matcher = TeacherMatcher(items.get('teachers', {}), match_score)
+        try:
+            snapshot.write_snapshot(ITEMS_SNAPSHOT_FILE, ITEMS_FILE, items, items_index, teacher_matcher)
+            items_snapshot_mtime = _snapshot_mtime()
+        except Exception as e:
+            log.error("Error saving items snapshot: %s", e)
+
+
+def _snapshot_mtime():
+    try:
+        return os.stat(ITEMS_SNAPSHOT_FILE).st_mtime_ns
+    except OSError:
+        return None
+
+
+# Load the items again when another process refreshed the snapshot, for the webhook workers.
+# Cached responses are dropped with them since they were resolved against the old items.
+def reload_items_if_changed():
+    if _snapshot_mtime() in (None, items_snapshot_mtime):
+        return False
+    load_items()
+    schedule_cache.clear()
+    reply_cache.clear()
+    log.info('Reloaded items from the snapshot')
+    return True
+
+
+# Load local state and start answering right away, the items are refreshed from the API by the background jobs
+def init(start_background_tasks=True):
+    setup_logging(LOG_LEVEL, LOG_JSON)
+    if METRICS_PORT:
+        start_metrics_server(int(METRICS_PORT))
+    if CALENDAR_PORT:
+        start_calendar_server(int(CALENDAR_PORT), calendar_feed_for)
+    load_items()
+    load_room_index()
+    log.info('Loaded %d student groups', student_groups.warm())
+    notifier.start()
+    if start_background_tasks:
+        background_thread = Thread(target=background_tasks)
+        background_thread.start()
 
 
 # # Run the bot
-init()
-bot.polling(non_stop=True)
+if __name__ == '__main__':
+    if BOT_RUNTIME == 'async':
+        init(start_background_tasks=False)
+        asyncio.run(AsyncRuntime(bot, workers=handler_workers).run(add_background_jobs(AsyncIOScheduler())))
+    else:
+        init()
+        bot.polling(non_stop=True)
+    # Send the replies that are still queued before exiting
+    outbox.flush(timeout=30)
 
 
 
@@ -0,0 +1,212 @@
+import json, logging, time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+# Upper bounds of the latency histogram buckets, in seconds
+buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+# Latency histogram with fixed buckets, so observing is a bisect and two additions
+class Histogram:
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    # Upper bound of the bucket holding the given quantile, or the last bound for the overflow bucket
+    def quantile(self, fraction):
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return buckets[-1]
+
+
+# Latency histograms per stage and counters with a label, shared by all threads
+class Metrics:
+    def __init__(self):
+        self.lock = Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.started = time.time()
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    # Time the body of a with statement as one observation of the stage
+    @contextmanager
+    def timer(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def increment(self, name, label='', amount=1):
+        key = (name, label)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def counter(self, name, label=''):
+        with self.lock:
+            return self.counters.get((name, label), 0)
+
+    # Raw histograms and counters, to be added to the metrics of another process with merge
+    def state(self):
+        with self.lock:
+            return {'histograms': {stage: (list(h.counts), h.count, h.sum) for stage, h in self.histograms.items()},
+                    'counters': dict(self.counters)}
+
+    def merge(self, state):
+        with self.lock:
+            for stage, (counts, count, total) in state['histograms'].items():
+                histogram = self.histograms.get(stage)
+                if histogram is None:
+                    histogram = self.histograms[stage] = Histogram()
+                histogram.counts = [a + b for a, b in zip(histogram.counts, counts)]
+                histogram.count += count
+                histogram.sum += total
+            for key, value in state['counters'].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    # Forget all observations, for benchmarks measuring one run at a time
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+            self.started = time.time()
+
+    def snapshot(self):
+        with self.lock:
+            stages = {stage: {'count': h.count, 'mean': h.sum / h.count if h.count else 0.0,
+                              'p50': h.quantile(0.5), 'p95': h.quantile(0.95), 'p99': h.quantile(0.99)}
+                      for stage, h in self.histograms.items()}
+            counters = {}
+            for (name, label), value in self.counters.items():
+                counters.setdefault(name, {})[label] = value
+        return {'uptime': time.time() - self.started, 'stages': stages, 'counters': counters}
+
+    # Prometheus text exposition format
+    def prometheus_text(self, prefix='tsi_bot'):
+        lines = []
+        with self.lock:
+            lines.append(f'# TYPE {prefix}_stage_seconds histogram')
+            for stage, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+                lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+            names = sorted({name for name, _ in self.counters})
+            for name in names:
+                lines.append(f'# TYPE {prefix}_{name}_total counter')
+                for (counter, label), value in sorted(self.counters.items()):
+                    if counter == name:
+                        label_text = f'{{label="{_escape(label)}"}}' if label else ''
+                        lines.append(f'{prefix}_{name}_total{label_text} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Metrics of this process
+registry = Metrics()
+
+
+# Metrics of this process added up with the last state reported by other processes, like the webhook
+# workers. The state of a process that exited is kept in the totals, so counters never go back.
+class AggregatedMetrics:
+    def __init__(self, local=registry):
+        self.local = local
+        self.lock = Lock()
+        self.states = {}
+        self.retired = Metrics()
+
+    def update(self, source, state):
+        with self.lock:
+            self.states[source] = state
+
+    def retire(self, source):
+        with self.lock:
+            state = self.states.pop(source, None)
+        if state is not None:
+            self.retired.merge(state)
+
+    def combined(self):
+        combined = Metrics()
+        combined.started = self.local.started
+        combined.merge(self.local.state())
+        combined.merge(self.retired.state())
+        with self.lock:
+            states = list(self.states.values())
+        for state in states:
+            combined.merge(state)
+        return combined
+
+    def snapshot(self):
+        return self.combined().snapshot()
+
+    def prometheus_text(self, prefix='tsi_bot'):
+        return self.combined().prometheus_text(prefix)
+
+
+# Log records as one JSON object per line, with the fields passed in extra={'fields': {...}}
+class StructuredFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name, 'message': record.getMessage()}
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+# Configure the root logger once, as JSON lines or as plain text
+def setup_logging(level='INFO', structured=True):
+    handler = logging.StreamHandler()
+    handler.setFormatter(StructuredFormatter() if structured else logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+
+
+# Serve the registry in the Prometheus text format on http://host:port/metrics from a daemon thread
+def start_metrics_server(port, host='0.0.0.0', metrics=registry):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.prometheus_text().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
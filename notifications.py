@@ -0,0 +1,181 @@
+import heapq, itertools, logging, time
+from datetime import datetime, timedelta
+from threading import Condition, Lock, Thread
+from renderer import local_strings, riga
+
+log = logging.getLogger(__name__)
+
+
+# Min-heap of (due time, callback) served by one thread, which sleeps until the earliest entry is due.
+# Scheduling is O(log n) and there is no polling, however many entries are pending.
+class TimerQueue:
+    def __init__(self, name='timers'):
+        self.name = name
+        self.heap = []
+        self.counter = itertools.count()
+        self.condition = Condition()
+        self.thread = None
+        self.stopped = False
+
+    def start(self):
+        with self.condition:
+            if self.thread is None:
+                self.thread = Thread(target=self.run, name=self.name, daemon=True)
+                self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def schedule(self, due, callback, *args):
+        entry = (due, next(self.counter), callback, args)
+        with self.condition:
+            heapq.heappush(self.heap, entry)
+            # Only wake the thread when the new entry is due before the one it is waiting for
+            if self.heap[0] is entry:
+                self.condition.notify()
+
+    # Drop all pending entries
+    def clear(self):
+        with self.condition:
+            self.heap = []
+
+    def __len__(self):
+        with self.condition:
+            return len(self.heap)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopped and (not self.heap or self.heap[0][0] > time.time()):
+                    self.condition.wait(self.heap[0][0] - time.time() if self.heap else None)
+                if self.stopped:
+                    return
+                due, _, callback, args = heapq.heappop(self.heap)
+            try:
+                callback(*args)
+            except Exception as e:
+                log.exception("Timer callback failed: %s", e)
+
+
+def format_digest(day, events):
+    if not events:
+        return None
+    text = f'Your classes on {day.strftime("%d.%m.%Y")}\n\n'
+    for event in events:
+        text += f'{local_strings(event[0])[1]} {event[4].strip()} with {event[3].strip()}\nRoom: {event[1]}\n\n'
+    return text
+
+
+def format_reminder(event, minutes):
+    return f'{event[4].strip()} with {event[3].strip()} starts in {minutes} minutes, at {local_strings(event[0])[1]}\nRoom: {event[1]}'
+
+
+# Daily digests and "class starts in N minutes" reminders for subscribed students.
+# plan() reads all subscriptions and the events of the subscribed groups in one
+# go, and puts one timer per group and digest hour or reminder offset on the
+# TimerQueue, not one per student. When a timer fires, the message is rendered
+# once and queued for all students of the group as bulk messages of the
+# dispatcher, which sends them within Telegram's rate limits.
+# Planning again replaces the pending timers, and timers that already fired are
+# not fired twice.
+class Notifier:
+    def __init__(self, dispatcher, load_subscribers, load_events, find_group_key, map_event, horizon=36 * 3600):
+        self.dispatcher = dispatcher
+        self.load_subscribers = load_subscribers
+        self.load_events = load_events
+        self.find_group_key = find_group_key
+        self.map_event = map_event
+        self.horizon = horizon
+        self.timers = TimerQueue('notifications')
+        self.lock = Lock()
+        self.fired = {}
+        self.notifications = 0
+
+    def start(self):
+        self.timers.start()
+
+    def plan(self, now=None):
+        now = now or time.time()
+        end = now + self.horizon
+
+        # Group the subscribers of each group by digest hour and by reminder offset
+        digests, reminders, group_ids = {}, {}, {}
+        for group, subscribers in self.load_subscribers().items():
+            key = self.find_group_key(group)
+            if key is None:
+                continue
+            group_id = int(key)
+            group_ids[group_id] = group
+            for chat_id, digest_hour, reminder_minutes in subscribers:
+                if digest_hour is not None:
+                    digests.setdefault(group_id, {}).setdefault(digest_hour, []).append(chat_id)
+                if reminder_minutes:
+                    reminders.setdefault(group_id, {}).setdefault(reminder_minutes, []).append(chat_id)
+        if not group_ids:
+            return 0
+
+        # One events request for all subscribed groups, up to the end of the day of the last digest
+        events = self.load_events(list(group_ids), int(now), int(end) + 86400)
+        if events is None:
+            log.error('Could not load events for notifications')
+            return 0
+        events_by_group = {}
+        for event in sorted(events, key=lambda e: e[0]):
+            for group_id in event[2]:
+                if group_id in group_ids:
+                    events_by_group.setdefault(group_id, []).append(event)
+
+        with self.lock:
+            self.fired = {key: due for key, due in self.fired.items() if due > now - self.horizon}
+        self.timers.clear()
+
+        count = 0
+        today = datetime.fromtimestamp(now, riga).date()
+        for group_id in group_ids:
+            group_events = events_by_group.get(group_id, [])
+
+            for day in (today + timedelta(days=offset) for offset in range(3)):
+                day_events = [e for e in group_events if datetime.fromtimestamp(e[0], riga).date() == day]
+                for hour, chat_ids in digests.get(group_id, {}).items():
+                    due = datetime(day.year, day.month, day.day, hour, tzinfo=riga).timestamp()
+                    if now <= due < end:
+                        self.timers.schedule(due, self._fire, ('digest', group_id, day, hour), due, chat_ids,
+                                             self._digest_text, day, day_events)
+                        count += 1
+
+            for event in group_events:
+                for minutes, chat_ids in reminders.get(group_id, {}).items():
+                    due = event[0] - minutes * 60
+                    if now <= due < end:
+                        self.timers.schedule(due, self._fire, ('reminder', group_id, event[0], event[4], minutes), due,
+                                             chat_ids, self._reminder_text, event, minutes)
+                        count += 1
+        log.info('Planned %d notifications for %d groups', count, len(group_ids))
+        return count
+
+    def _digest_text(self, day, events):
+        return format_digest(day, [self.map_event(e) for e in events])
+
+    def _reminder_text(self, event, minutes):
+        return format_reminder(self.map_event(event), minutes)
+
+    # Render the message once, when it is due, and queue it for every student of the group
+    def _fire(self, key, due, chat_ids, render, *args):
+        with self.lock:
+            if key in self.fired:
+                return
+            self.fired[key] = due
+
+        text = render(*args)
+        if not text:
+            return
+        for chat_id in chat_ids:
+            self.dispatcher.send_message(chat_id, text, bulk=True)
+        with self.lock:
+            self.notifications += len(chat_ids)
+
+    def stats(self):
+        with self.lock:
+            return {'pending': len(self.timers), 'notifications': self.notifications}
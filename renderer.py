@@ -0,0 +1,117 @@
+from datetime import datetime, timezone
+from functools import lru_cache
+from itertools import groupby
+from zoneinfo import ZoneInfo
+
+# Longest text Telegram accepts in one message
+MAX_MESSAGE_LENGTH = 4096
+
+riga = ZoneInfo('Europe/Riga')
+
+
+# Date and time strings of a timestamp in the given timezone.
+# Cached since the events of a schedule share a handful of start times.
+@lru_cache(maxsize=8192)
+def local_strings(timestamp, tz=riga):
+    local = datetime.fromtimestamp(timestamp, timezone.utc).astimezone(tz)
+    return local.strftime("%d.%m.%Y"), local.strftime("%H:%M")
+
+
+# Builds messages from pieces of text, starting a new message whenever an entry
+# would take the current one past the limit. Pieces are collected in a list and
+# joined once per message.
+class ChunkBuilder:
+    def __init__(self, limit=MAX_MESSAGE_LENGTH):
+        self.limit = limit
+        self.chunks = []
+        self.parts = []
+        self.length = 0
+
+    # Append text to the current message, whatever its length
+    def append(self, text):
+        self.parts.append(text)
+        self.length += len(text)
+
+    # Append an entry, moving it to a new message if it does not fit in the current one
+    def append_entry(self, text):
+        if self.length + len(text) > self.limit and self.parts:
+            self.flush()
+        self.append(text)
+
+    def flush(self):
+        self.chunks.append(''.join(self.parts))
+        self.parts = []
+        self.length = 0
+
+    def finish(self):
+        if self.parts:
+            self.flush()
+        return self.chunks
+
+
+def _full(date_string, time_string, room, groups, teacher, name):
+    return f'{name} with {teacher}\nRoom: {room}\nGroups: {groups}\nTime: {time_string}\n\n'
+
+
+def _compact(date_string, time_string, room, groups, teacher, name):
+    return f'{time_string} {name}, {room}, {teacher}\n'
+
+
+def _table(date_string, time_string, room, groups, teacher, name):
+    return f'{time_string} | {room} | {name} | {teacher}\n'
+
+
+# Per event entry and per day header of each format. "full" is the original format of check_schedule.
+formats = {
+    'full': (_full, '{}\n\n'),
+    'compact': (_compact, '{}\n'),
+    'table': (_table, '{}\n'),
+}
+
+
+def _render(events, format, tz, limit):
+    entry, header = formats[format]
+    builder = ChunkBuilder(limit)
+    for date_string, day_events in groupby(events, key=lambda event: local_strings(event[0], tz)[0]):
+        builder.append(header.format(date_string))
+        for event in day_events:
+            time_string = local_strings(event[0], tz)[1]
+            room = event[1] if event[1] else 'Not specified'
+            groups = ", ".join(event[2]) if len(event[2]) > 0 else 'Not specified'
+            builder.append_entry(entry(date_string, time_string, room, groups, event[3].strip(), event[4].strip()))
+    return builder.finish()
+
+
+# Render events whose room, groups and teacher are resolved to names (see map_event)
+# into messages of at most MAX_MESSAGE_LENGTH characters, grouped by day.
+# The day header is added before the first entry of the day is checked
+# against the limit, exactly like the original loop did.
+def render_schedule(events, group_text, format='full', tz=riga, limit=MAX_MESSAGE_LENGTH):
+    chunks = _render(events, format, tz, limit)
+    if not chunks:
+        # If there are no events for the given group, return a message indicating this
+        chunks = [f'No events found for group {group_text}.']
+    return chunks
+
+
+# Renders a schedule arriving in consecutive batches of events, like the chunks
+# of a long period, so the first days are sent while later ones are still being
+# fetched. Each batch is rendered like render_schedule, its last message is not
+# held back for the next batch, and batches must not share a day.
+class ScheduleStream:
+    def __init__(self, group_text, format='full', tz=riga, limit=MAX_MESSAGE_LENGTH):
+        self.group_text = group_text
+        self.format = format
+        self.tz = tz
+        self.limit = limit
+        self.messages = 0
+
+    # Messages of the next batch
+    def add(self, events):
+        chunks = _render(events, self.format, self.tz, self.limit)
+        self.messages += len(chunks)
+        return chunks
+
+    # Messages still to send once all batches were added
+    def finish(self):
+        return [] if self.messages else [f'No events found for group {self.group_text}.']
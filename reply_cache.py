@@ -0,0 +1,87 @@
+import hashlib, time
+from collections import OrderedDict
+from threading import Lock
+
+
+# Digest of the given rows of an event batch, over the columns a schedule reply is rendered from
+def rows_digest(batch, rows):
+    digest = hashlib.blake2b(digest_size=16)
+    for row in rows:
+        digest.update(repr((batch.starts[row], batch.rooms[row], batch.teachers[row],
+                            tuple(batch.groups_of(row)), batch.names[row])).encode())
+    return digest.digest()
+
+
+# Cache of rendered schedule replies, the final list of messages, keyed by
+# (group ID, local date, format). Each entry keeps the digest of the event rows
+# it was rendered from and the window of its day. Entries expire after ttl
+# seconds; an expired entry whose rows come back with the same digest is reused
+# without rendering again. revalidate checks every entry against new event data
+# and only drops the ones whose rows changed. Names are resolved while
+# rendering, so the cache has to be cleared when the items change.
+class ReplyCache:
+    def __init__(self, ttl=600, max_entries=4096):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.reused = 0
+        self.misses = 0
+        self.invalidated = 0
+
+    # Messages of a fresh entry, or None
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    # Messages of the entry rendered from rows with this digest, expired or not, which is then fresh again
+    def reuse(self, key, digest):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] != digest:
+                return None
+            self.entries[key] = (time.monotonic() + self.ttl,) + entry[1:]
+            self.entries.move_to_end(key)
+            self.reused += 1
+            return entry[2]
+
+    def put(self, key, digest, chunks, from_time, to_time):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, digest, chunks, from_time, to_time)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    # Drop the entries whose rows changed. digest(group_id, from_time, to_time) returns the digest
+    # of the group's rows in the window from the new data, or None when the data does not cover it.
+    def revalidate(self, digest):
+        with self.lock:
+            entries = list(self.entries.items())
+        dropped = 0
+        for key, entry in entries:
+            if digest(key[0], entry[3], entry[4]) != entry[1]:
+                with self.lock:
+                    if self.entries.get(key) is entry:
+                        del self.entries[key]
+                        dropped += 1
+        with self.lock:
+            self.invalidated += dropped
+        return dropped
+
+    def clear(self):
+        with self.lock:
+            self.invalidated += len(self.entries)
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {'entries': len(self.entries), 'hits': self.hits, 'reused': self.reused, 'misses': self.misses,
+                    'invalidated': self.invalidated, 'hit_rate': self.hits / total if total else 0.0}
@@ -0,0 +1,106 @@
+from bisect import bisect_right
+from threading import Lock
+
+
+# Sorted, disjoint busy intervals of one room, as parallel start and end arrays,
+# built from the (start, end) intervals of its events
+class _Occupancy:
+    __slots__ = ('intervals', 'starts', 'ends')
+
+    def __init__(self, intervals):
+        self.intervals = sorted(intervals)
+        self.starts = []
+        self.ends = []
+        for start, end in self.intervals:
+            if self.ends and start <= self.ends[-1]:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    # Index of the first busy interval ending after time
+    def _after(self, time):
+        return bisect_right(self.ends, time)
+
+    def is_free(self, from_time, to_time):
+        i = self._after(from_time)
+        return i == len(self.starts) or self.starts[i] >= to_time
+
+    # First time from from_time on when the room stays free for length seconds, and when that free slot ends (None if never)
+    def next_free(self, from_time, length):
+        i = self._after(from_time)
+        time = from_time
+        while i < len(self.starts) and self.starts[i] < time + length:
+            time = max(time, self.ends[i])
+            i += 1
+        return time, self.starts[i] if i < len(self.starts) else None
+
+
+# Interval index of room occupancy built from bulk fetched events.
+# Every room keeps its busy intervals merged into sorted start and end arrays,
+# so checking a room is two bisects and listing the free rooms of a period
+# checks each room once. update replaces the events of a time window, like the
+# prefetch does in the database, and only rebuilds the rooms whose events in
+# that window changed. Rooms are swapped in whole, so readers need no lock.
+# Events only carry their start time, every event is assumed to last lesson_length seconds.
+class RoomIndex:
+    def __init__(self, lesson_length=90 * 60):
+        self.lesson_length = lesson_length
+        self.rooms = {}
+        self.from_time = None
+        self.to_time = None
+        self.version = None
+        self.lock = Lock()
+
+    def _intervals(self, events):
+        by_room = {}
+        for event in events:
+            for room_id in event[1]:
+                by_room.setdefault(room_id, set()).add((event[0], event[0] + self.lesson_length))
+        return by_room
+
+    # Replace the events starting inside [from_time, to_time] with the given ones and forget those before from_time
+    def update(self, events, from_time, to_time, version=None):
+        new = self._intervals(events)
+        with self.lock:
+            rooms = {}
+            changed = 0
+            for room_id in set(self.rooms) | set(new):
+                occupancy = self.rooms.get(room_id)
+                old = occupancy.intervals if occupancy else []
+                kept = [interval for interval in old if interval[0] > to_time]
+                window = [interval for interval in old if from_time <= interval[0] <= to_time]
+                added = new.get(room_id, set())
+                if set(window) == added and len(kept) + len(window) == len(old):
+                    rooms[room_id] = occupancy
+                    continue
+                changed += 1
+                if added or kept:
+                    rooms[room_id] = _Occupancy(list(added) + kept)
+            self.rooms = rooms
+            # The kept events after the window are still complete if the old window reached into the new one
+            if self.to_time is None or self.to_time <= to_time or self.from_time > to_time + 1:
+                self.to_time = to_time
+            self.from_time = from_time
+            self.version = version
+        return changed
+
+    # Whether the index holds every event of the period
+    def covers(self, from_time, to_time):
+        return self.from_time is not None and self.from_time <= from_time and to_time <= self.to_time
+
+    # IDs of the rooms without any event overlapping [from_time, to_time), among the given rooms
+    def free_rooms(self, room_ids, from_time, to_time):
+        rooms = self.rooms
+        return [room_id for room_id in room_ids if room_id not in rooms or rooms[room_id].is_free(from_time, to_time)]
+
+    # Start and end of the next free slot of at least length seconds of a room, the end is None when nothing follows
+    def next_free(self, room_id, from_time, length=None):
+        occupancy = self.rooms.get(room_id)
+        if occupancy is None:
+            return from_time, None
+        return occupancy.next_free(from_time, length or self.lesson_length)
+
+    def stats(self):
+        return {'rooms': len(self.rooms), 'intervals': sum(len(o.intervals) for o in self.rooms.values()),
+                'from': self.from_time, 'to': self.to_time}
@@ -0,0 +1,133 @@
+import time
+from collections import OrderedDict
+from threading import Event, Lock
+
+
+# Filter a cached response down to the events starting inside the requested window
+def filter_window(data, from_time, to_time):
+    events = data.get('events')
+    if not events:
+        return data
+    values = [event for event in events['values'] if from_time <= event[0] <= to_time]
+    return {**data, 'events': {**events, 'values': values}}
+
+
+# A pending upstream fetch that concurrent identical requests wait on
+class _InFlight:
+    __slots__ = ('done', 'data')
+
+    def __init__(self):
+        self.done = Event()
+        self.data = None
+
+
+# Cache of GetLocalizedEvents responses keyed by (groups, teachers, from, to).
+# Entries expire after ttl seconds and the least recently used entry is evicted
+# once max_entries is reached. A request whose window lies inside a cached
+# window for the same groups and teachers is answered by filtering the cached
+# events locally, and concurrent identical misses share one upstream fetch.
+# Cached events are shared between callers and must not be mutated.
+class ScheduleCache:
+    def __init__(self, fetch, ttl=600, max_entries=256):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.windows = {}
+        self.in_flight = {}
+        self.lock = Lock()
+        self.hits = 0
+        self.superset_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def _selection(groups, teachers):
+        return frozenset(groups or ()), frozenset(teachers or ())
+
+    # Find a fresh entry for the selection whose window covers the requested one
+    def _lookup(self, selection, from_time, to_time, now):
+        key = (selection, from_time, to_time)
+        entry = self.entries.get(key)
+        if entry and entry[0] > now:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+        for window in self.windows.get(selection, ()):
+            if window[0] <= from_time and to_time <= window[1]:
+                entry = self.entries[(selection,) + window]
+                if entry[0] > now:
+                    self.entries.move_to_end((selection,) + window)
+                    self.superset_hits += 1
+                    return filter_window(entry[1], from_time, to_time)
+        return None
+
+    def _store(self, key, data, now):
+        selection, window = key[0], key[1:]
+        self.entries[key] = (now + self.ttl, data)
+        self.entries.move_to_end(key)
+        self.windows.setdefault(selection, set()).add(window)
+
+        # Drop expired entries first, then the least recently used ones
+        for old_key in [k for k, entry in self.entries.items() if entry[0] <= now]:
+            self._remove(old_key)
+        while len(self.entries) > self.max_entries:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        del self.entries[key]
+        windows = self.windows[key[0]]
+        windows.discard(key[1:])
+        if not windows:
+            del self.windows[key[0]]
+
+    # Return the response for the given groups, teachers and window.
+    # fetch(groups, teachers, from_time, to_time) returns the decoded response
+    # or None on failure; failures and upstream messages are not cached.
+    def get(self, groups, teachers, from_time, to_time):
+        selection = self._selection(groups, teachers)
+        key = (selection, from_time, to_time)
+
+        with self.lock:
+            data = self._lookup(selection, from_time, to_time, time.monotonic())
+            if data is not None:
+                return data
+
+            pending = self.in_flight.get(key)
+            owner = pending is None
+            if owner:
+                self.misses += 1
+                pending = self.in_flight[key] = _InFlight()
+            else:
+                self.coalesced += 1
+
+        if not owner:
+            pending.done.wait()
+            return pending.data
+
+        try:
+            pending.data = self.fetch(groups, teachers, from_time, to_time)
+            if pending.data is not None and not pending.data.get('Message'):
+                with self.lock:
+                    self._store(key, pending.data, time.monotonic())
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            pending.done.set()
+        return pending.data
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.windows.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'superset_hits': self.superset_hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+            }
@@ -0,0 +1,60 @@
+import mmap, os, pickle, struct, tempfile
+
+# Binary snapshot of items and the structures derived from them (ItemsIndex and
+# TeacherMatcher), so a restart does not have to parse items.json and run
+# unidecode over every name again. The header records the size and mtime of
+# the items.json it was built from, and a snapshot that no longer matches it
+# is ignored.
+MAGIC = b'TSIS'
+FORMAT_VERSION = 4
+_header = struct.Struct('<4sIqq')
+
+
+def _source_stamp(source_path):
+    try:
+        stat = os.stat(source_path)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+# Write (items, items_index, teacher_matcher) to path atomically, stamped with the current state of source_path
+def write_snapshot(path, source_path, items, items_index, teacher_matcher):
+    size, mtime = _source_stamp(source_path) or (-1, -1)
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temporary = tempfile.mkstemp(dir=directory, prefix='.items-', suffix='.snapshot')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(_header.pack(MAGIC, FORMAT_VERSION, size, mtime))
+            pickle.dump((items, items_index, teacher_matcher), file, protocol=pickle.HIGHEST_PROTOCOL)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+
+# Load (items, items_index, teacher_matcher) from a memory mapped snapshot.
+# Returns None when there is no snapshot, it is from another format version, or
+# source_path changed since it was written.
+def load_snapshot(path, source_path):
+    try:
+        file = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+
+    with file:
+        if os.fstat(file.fileno()).st_size < _header.size:
+            return None
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            magic, version, size, mtime = _header.unpack_from(mapped)
+            if magic != MAGIC or version != FORMAT_VERSION:
+                return None
+            stamp = _source_stamp(source_path)
+            if stamp is not None and stamp != (size, mtime):
+                return None
+
+            # Unpickle straight from the mapped pages, without reading the file into a bytes object first
+            with memoryview(mapped) as view, view[_header.size:] as body:
+                return pickle.loads(body)
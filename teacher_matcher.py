@@ -0,0 +1,169 @@
+from collections import Counter
+from functools import lru_cache
+from fuzzywuzzy import fuzz, utils
+from unidecode import unidecode
+
+
+# Fuzzy matcher over teacher names, built once per items refresh.
+# It keeps the semantics of the original per-token match_teacher: a teacher
+# matches when it is among the best process.extract results and its surname
+# or given name scores above match_score with fuzz.ratio. Only the teachers
+# with such a name part, found through a cheap character count bound, are
+# scored with fuzz.WRatio like process.extract does. Any other teacher is
+# scored only when the bound of its WRatio score could reach the best
+# candidate's, since it would then change the best results. Results are memoized.
+class TeacherMatcher:
+    # When rebuilding after a refresh, pass the previous matcher to reuse the ascii names of unchanged teachers
+    def __init__(self, teachers, match_score=70, cache_size=4096, previous=None):
+        self.match_score = match_score
+        self.cache_size = cache_size
+        self.teacher_names = list(teachers.values())
+        known = dict(zip(previous.teacher_names, previous.unidecode_teachers)) if previous else {}
+        self.unidecode_teachers = [known.get(t) or unidecode(t.lower()) for t in self.teacher_names]
+
+        # Position of each ascii name, keeping the first one like list.index did
+        self.unidecode_positions = {}
+        for position, name in enumerate(self.unidecode_teachers):
+            self.unidecode_positions.setdefault(name, position)
+
+        # Names as process.extract compares them, for both name variants
+        self.choices = [self._choices(self.teacher_names), self._choices(self.unidecode_teachers)]
+
+        # Surnames and given names of both name variants with the positions of their names in each variant, grouped by length
+        self.part_positions = {}
+        for variant, names in enumerate((self.teacher_names, self.unidecode_teachers)):
+            for position, name in enumerate(names):
+                for part in name.split()[:2]:
+                    self.part_positions.setdefault(part, ([], []))[variant].append(position)
+        self.parts_by_length = {}
+        for part in self.part_positions:
+            self.parts_by_length.setdefault(len(part), []).append((part, Counter(part)))
+
+        self.match = lru_cache(maxsize=cache_size)(self._match)
+
+    # Pickle support for the items snapshot, the memoized match is recreated empty
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['match']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.match = lru_cache(maxsize=self.cache_size)(self._match)
+
+    # Processed name, its length, character counts and tokens. The counts are None when the score bound
+    # does not hold for the name, which has no characters or spaces other than single ones between tokens.
+    @staticmethod
+    def _choices(names):
+        choices = []
+        for name in names:
+            processed = utils.full_process(name, force_ascii=True)
+            regular = bool(processed) and ' '.join(processed.split()) == processed
+            choices.append((processed, len(processed), Counter(processed) if regular else None, set(processed.split())))
+        return choices
+
+    # Upper bound of fuzz.ratio given only the lengths of both strings
+    @staticmethod
+    def _length_bound(length_1, length_2):
+        return int(round(100 * 2 * min(length_1, length_2) / (length_1 + length_2)))
+
+    # Positions of the names of each variant with a name part scoring above match_score against the token.
+    # fuzz.ratio is 2 * matched characters / total length, and the matched
+    # characters never exceed the shared character counts, so this never
+    # skips a part the full algorithm would have matched.
+    def _candidates(self, token):
+        token_length = len(token)
+        token_counts = None
+        candidates = (set(), set())
+        for length, parts in self.parts_by_length.items():
+            if self._length_bound(token_length, length) <= self.match_score:
+                continue
+            if token_counts is None:
+                token_counts = Counter(token)
+            total = token_length + length
+            for part, counts in parts:
+                shared = sum((counts & token_counts).values())
+                if int(round(100 * 2 * shared / total)) > self.match_score and fuzz.ratio(part, token) > self.match_score:
+                    for variant, positions in enumerate(self.part_positions[part]):
+                        candidates[variant].update(positions)
+        return candidates
+
+    # Upper bound of fuzz.WRatio between a processed query of one token and a choice, or 100 when none is known.
+    # Unless the query is one of its tokens, every ratio WRatio takes compares the query with the choice
+    # or its sorted tokens, which have the same characters, so matched characters never exceed the shared
+    # ones: ratio is at most 2 * shared / total length, and partial_ratio, comparing the shorter string
+    # with a window of the longer one, at most 2 * shared / (shorter length + shared).
+    @staticmethod
+    def _score_bound(query, query_counts, choice):
+        _, length, counts, tokens = choice
+        if counts is None or query in tokens:
+            return 100
+        shared = sum(min(count, counts[character]) for character, count in query_counts.items())
+        base = utils.intr(100 * 2 * shared / (len(query) + length))
+        shorter, longer = min(len(query), length), max(len(query), length)
+        if longer / shorter < 1.5:
+            return base
+        shared = min(shared, shorter)
+        partial = utils.intr(100 * 2 * shared / (shorter + shared)) if shared else 0
+        return utils.intr(max(base, partial * (.6 if longer / shorter > 8 else .9)))
+
+    # Positions of the names with the best score, in the order of the first limit results of process.extract.
+    # Names scoring below the best candidate cannot be among them, so they are skipped when their bound shows it.
+    def _best(self, query, choices, candidates, limit=20):
+        scores = {position: fuzz.WRatio(query, choices[position][0], full_process=False) for position in candidates}
+        best = max(scores.values())
+        bounded = bool(query) and ' ' not in query
+        query_counts = Counter(query)
+        for position, choice in enumerate(choices):
+            if position not in scores and (not bounded or self._score_bound(query, query_counts, choice) >= best):
+                scores[position] = fuzz.WRatio(query, choice[0], full_process=False)
+        top = max(scores.values())
+        return [position for position in sorted(scores) if scores[position] == top][:limit]
+
+    def _match(self, search_string):
+        if not self.teacher_names:
+            return None
+        fuzzy_candidates, unidecode_candidates = self._candidates(search_string)
+        if not fuzzy_candidates and not unidecode_candidates:
+            return None
+
+        # The query as process.extract processes it
+        query = utils.full_process(utils.full_process(search_string), force_ascii=True)
+
+        partial_matches = []
+
+        # process.extract returns up to 20 results, names from the best ones match only with a part above match_score
+        if len(self.teacher_names) > 1 and fuzzy_candidates:
+            for position in self._best(query, self.choices[0], fuzzy_candidates):
+                m = self.teacher_names[position]
+                score_1 = fuzz.ratio(m.split()[0], search_string)
+                score_2 = fuzz.ratio(m.split()[1], search_string)
+                if score_1 > self.match_score or score_2 > self.match_score:
+                    partial_matches.append(m)
+
+        if len(self.teacher_names) > 1 and unidecode_candidates:
+            for position in self._best(query, self.choices[1], unidecode_candidates):
+                m = self.unidecode_teachers[position]
+                teacher_name = self.teacher_names[self.unidecode_positions[m]]
+                score_1 = fuzz.ratio(m.split()[0], search_string)
+                score_2 = fuzz.ratio(m.split()[1], search_string)
+                if (score_1 > self.match_score or score_2 > self.match_score) and teacher_name not in partial_matches:
+                    partial_matches.append(teacher_name)
+
+        if len(partial_matches) > 1:
+            return tuple(partial_matches)
+        elif len(partial_matches) == 1:
+            return partial_matches[0]
+        else:
+            return None
+
+    # Match every token of a message in one pass, scoring each distinct token once
+    def match_tokens(self, tokens):
+        matching_teachers = []
+        for token in dict.fromkeys(tokens):
+            matches = self.match(token)
+            if type(matches) is str:
+                matching_teachers.append(matches)
+            elif matches:
+                matching_teachers.extend(matches)
+        return list(dict.fromkeys(matching_teachers))
@@ -0,0 +1,280 @@
+import hashlib, json, logging, random, re, time
+from collections import OrderedDict
+from threading import BoundedSemaphore, Lock
+import requests
+from requests.adapters import HTTPAdapter
+from metrics import registry as metrics
+
+log = logging.getLogger(__name__)
+
+
+# Raised when the schedule service cannot be reached or returns an invalid response
+class UpstreamError(Exception):
+    pass
+
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+
+
+# Return the "d" field of a service response: a JSON object wrapped in parentheses whose "d" field is itself JSON encoded.
+# Only the wrapped part is decoded, straight from a memoryview of the response without copying the bytes first.
+def _inner_json(content):
+    if b')(' in content:
+        outer = json.loads(content.decode('utf-8')[1:-1].replace(')(', ''))
+    else:
+        outer, _ = _decoder.raw_decode(str(memoryview(content)[1:-1], 'utf-8'))
+    return outer.get('d')
+
+
+# Decode a service response into its data dictionary
+def parse_response(content):
+    return json.loads(_inner_json(content))
+
+
+def _skip_whitespace(text, index):
+    return _whitespace.match(text, index).end()
+
+
+# Return the index of the value of key in the JSON object starting at index, or None if it is missing.
+# Values of the other keys are skipped by decoding them on their own.
+def _find_member(text, index, key):
+    index = _skip_whitespace(text, index)
+    if text[index:index + 1] != '{':
+        return None
+    index = _skip_whitespace(text, index + 1)
+    while text[index:index + 1] == '"':
+        member, index = _decoder.raw_decode(text, index)
+        index = _skip_whitespace(text, index)
+        index = _skip_whitespace(text, index + 1)
+        if member == key:
+            return index
+        _, index = _decoder.raw_decode(text, index)
+        index = _skip_whitespace(text, index)
+        if text[index:index + 1] == ',':
+            index = _skip_whitespace(text, index + 1)
+    return None
+
+
+# Yield the elements of the JSON array starting at index one by one, returning the index after the array
+def _iter_array(text, index):
+    if text[index:index + 1] != '[':
+        return None
+    scan = _decoder.scan_once
+    index += 1
+    while True:
+        char = text[index]
+        if char == ']':
+            return index + 1
+        if char in ', \t\n\r':
+            index += 1
+            continue
+        value, index = scan(text, index)
+        yield value
+
+
+# Store an event as a tuple with its ID lists as tuples, which takes less memory than nested lists
+def _compact(event):
+    return tuple([tuple(value) if type(value) is list else value for value in event])
+
+
+# Yield the events of a GetLocalizedEvents response as compact tuples without building the whole list.
+# Raises UpstreamError for responses without events, like the error messages of the service.
+def iter_events(content):
+    text = _inner_json(content)
+    events = _find_member(text, 0, 'events')
+    if events is None:
+        message = _find_member(text, 0, 'Message')
+        raise UpstreamError(_decoder.raw_decode(text, message)[0] if message is not None else 'Response without events')
+    values = _find_member(text, events, 'values')
+    if values is None:
+        return
+    for event in _iter_array(text, values):
+        yield _compact(event)
+
+
+# Decode a GetLocalizedEvents response like parse_response, keeping its events as compact tuples.
+# The events are streamed into tuples like iter_events does, so their lists are never all alive at once,
+# then everything around them is decoded.
+def parse_events_response(content):
+    text = _inner_json(content)
+    events = _find_member(text, 0, 'events')
+    values = _find_member(text, events, 'values') if events is not None else None
+    if values is None:
+        return json.loads(text)
+
+    compact_events = []
+    array = _iter_array(text, values)
+    while True:
+        try:
+            compact_events.append(_compact(next(array)))
+        except StopIteration as stop:
+            end = stop.value
+            break
+    if end is None:
+        return json.loads(text)
+
+    data = json.loads(text[:values] + 'null' + text[end:])
+    data['events']['values'] = compact_events
+    return data
+
+
+# Circuit breaker that stops calling the service after repeated failures.
+# After reset_timeout seconds one trial call is let through, and its success closes the circuit again.
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Half open: let this call through and keep others out until it finishes
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+
+# Shared client for the TSI schedule service.
+# Connections are kept alive in a pool, every call has a timeout, failed calls
+# are retried with exponential backoff and jitter, and when the service is
+# down the last good response for the same call is served instead. At most
+# max_concurrency calls are sent at a time, the others wait for a free slot.
+class TsiClient:
+    def __init__(self, base_url='https://services.tsi.lv/schedule/api/service.asmx/', timeout=(3.05, 15), retries=2,
+                 backoff=0.5, pool_size=16, breaker=None, stale_size=512, max_concurrency=8):
+        self.base_url = base_url
+        self.limiter = BoundedSemaphore(max_concurrency)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.stale_size = stale_size
+        self.stale = OrderedDict()
+        self.stale_lock = Lock()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _remember(self, key, data):
+        with self.stale_lock:
+            self.stale[key] = data
+            self.stale.move_to_end(key)
+            while len(self.stale) > self.stale_size:
+                self.stale.popitem(last=False)
+
+    def _stale(self, key, error):
+        with self.stale_lock:
+            data = self.stale.get(key)
+        if data is None:
+            raise error
+        log.warning('Serving stale response: %s', error)
+        metrics.increment('upstream_stale')
+        return data
+
+    def _get(self, method, params, timeout, parser, headers):
+        metrics.increment('upstream_requests', method)
+        with self.limiter, metrics.timer('upstream'):
+            response = self.session.get(self.base_url + method, params=params, headers=headers, timeout=timeout or self.timeout)
+        if response.status_code == 304 and parser is None:
+            return response
+        if response.status_code != 200:
+            raise UpstreamError(f'{method} returned {response.status_code}: {response.content[:200]!r}')
+        if parser is None:
+            return response
+        try:
+            with metrics.timer('parse'):
+                return parser(response.content)
+        except (ValueError, TypeError, AttributeError) as e:
+            raise UpstreamError(f'{method} returned an invalid response: {e}') from e
+
+    # Call a service method and return its data decoded by parser, or the response itself when parser is None.
+    # Responses are remembered for serving stale data unless remember is False
+    def call(self, method, params=None, timeout=None, parser=parse_response, remember=True, headers=None):
+        params = params or {}
+        key = (method, tuple(sorted(params.items())))
+
+        if not self.breaker.allow():
+            return self._stale(key, UpstreamError(f'{method} skipped, circuit is open'))
+
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+            try:
+                data = self._get(method, params, timeout, parser, headers)
+            except (requests.RequestException, UpstreamError) as e:
+                error = e if isinstance(e, UpstreamError) else UpstreamError(f'{method} failed: {e}')
+                metrics.increment('upstream_errors', method)
+                continue
+            self.breaker.record_success()
+            if remember:
+                self._remember(key, data)
+            return data
+
+        self.breaker.record_failure()
+        if not remember:
+            raise error
+        return self._stale(key, error)
+
+    def get_items(self):
+        return self.call('GetItems')
+
+    # Conditionally fetch the items. The ETag of the previous response is sent
+    # with If-None-Match, and a response whose content hashes to the previous
+    # digest is not decoded at all. Returns (items or None if unchanged, etag, digest).
+    def get_items_if_changed(self, etag=None, digest=None):
+        response = self.call('GetItems', parser=None, remember=False, headers={'If-None-Match': etag} if etag else None)
+        if response.status_code == 304:
+            return None, etag, digest
+
+        new_etag = response.headers.get('ETag')
+        new_digest = hashlib.sha256(response.content).hexdigest()
+        if new_digest == digest:
+            return None, new_etag, digest
+        try:
+            return parse_response(response.content), new_etag, new_digest
+        except (ValueError, TypeError, AttributeError) as e:
+            raise UpstreamError(f'GetItems returned an invalid response: {e}') from e
+
+    @staticmethod
+    def _events_params(from_time, to_time, groups, teachers, rooms, lang):
+        return {
+            'from': from_time,
+            'to': to_time,
+            'groups': groups,
+            'teachers': teachers,
+            'rooms': rooms,
+            'lang': lang
+        }
+
+    def get_events(self, from_time, to_time, groups='', teachers='', rooms='', lang='\'en\''):
+        return self.call('GetLocalizedEvents', self._events_params(from_time, to_time, groups, teachers, rooms, lang),
+                         parser=parse_events_response)
+
+    # Fetch the raw events response, to be decoded lazily with iter_events
+    def get_events_content(self, from_time, to_time, groups='', teachers='', rooms='', lang='\'en\''):
+        return self.call('GetLocalizedEvents', self._events_params(from_time, to_time, groups, teachers, rooms, lang),
+                         parser=bytes, remember=False)
@@ -0,0 +1,206 @@
+import asyncio, json, logging, multiprocessing, queue, signal, telebot
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.schedulers.background import BackgroundScheduler
+import main
+from async_runtime import AsyncRuntime
+from ics_feed import start_calendar_server
+from metrics import AggregatedMetrics, registry as metrics, setup_logging, start_metrics_server
+
+log = logging.getLogger('tsi_bot.webhook')
+
+
+# Chat an update belongs to, read from the raw update so the front end never decodes it into objects
+def update_chat_id(update):
+    for field in ('message', 'edited_message', 'channel_post', 'edited_channel_post', 'callback_query'):
+        value = update.get(field)
+        if value:
+            if field == 'callback_query':
+                value = value.get('message') or {'chat': value.get('from')}
+            chat = value.get('chat')
+            if chat and 'id' in chat:
+                return chat['id']
+    return update.get('update_id', 0)
+
+
+# Request handler receiving updates on POST path. Each update goes to the queue of the worker
+# owning its chat, so one chat is always handled by the same process, in order. When that queue
+# stays full the update is refused with 503 and Telegram delivers it again later.
+def make_handler(queues, path, secret=None, put_timeout=1.0):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != path:
+                self.send_error(404)
+                return
+            if secret and self.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret:
+                self.send_error(403)
+                return
+
+            with metrics.timer('webhook'):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                try:
+                    chat_id = update_chat_id(json.loads(body))
+                except (ValueError, AttributeError) as e:
+                    log.warning('Malformed update: %s', e)
+                    self.send_error(400)
+                    return
+                try:
+                    queues[chat_id % len(queues)].put(body, timeout=put_timeout)
+                except queue.Full:
+                    metrics.increment('updates', 'refused')
+                    self.send_error(503)
+                    return
+                metrics.increment('updates', 'queued')
+
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+# Blocking receive function for AsyncRuntime.consume, None on the queue closes it
+def receive_from(updates, timeout=1.0):
+    def receive():
+        try:
+            body = updates.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if body is None:
+            raise EOFError
+        return telebot.types.Update.de_json(body.decode('utf-8'))
+
+    return receive
+
+
+# Worker process: handles the updates of its chats with the AsyncRuntime. The items come from the
+# snapshot the coordinator keeps up to date, the prefetched events from the shared database.
+# Its metrics are sent to the coordinator, which exports them added up with those of the other workers.
+def worker(index, updates, rate, reports=None, workers=1):
+    # Ctrl+C reaches the whole process group, the coordinator closes the queue once it stopped taking updates
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    setup_logging(main.LOG_LEVEL, main.LOG_JSON)
+    main.outbox.set_global_rate(rate)
+    main.stats_scope = f'worker {index + 1} of {workers}'
+    main.load_items()
+    main.load_room_index()
+    log.info('Worker %d loaded %d student groups', index, main.student_groups.warm((index, workers)))
+
+    scheduler = AsyncIOScheduler()
+    scheduler.add_job(main.reload_items_if_changed, trigger='interval', seconds=main.items_reload_seconds)
+    scheduler.add_job(main.load_room_index, trigger='interval', seconds=main.items_reload_seconds)
+    if reports is not None:
+        scheduler.add_job(report_metrics, args=(reports,), trigger='interval', seconds=main.metrics_report_seconds)
+    asyncio.run(AsyncRuntime(main.bot, workers=main.handler_workers).run(scheduler, receive_from(updates)))
+    # Send the replies that are still queued before exiting
+    main.outbox.flush(timeout=30)
+    if reports is not None:
+        report_metrics(reports)
+
+
+# Send the metrics of this worker to the coordinator, tagged with the process so a restarted worker starts anew
+def report_metrics(reports):
+    reports.put((multiprocessing.current_process().pid, metrics.state()))
+
+
+# Front end and coordinator of the worker processes. It alone runs the background jobs: the items
+# refresh writing the snapshot the workers reload, the prefetch into the shared database and the
+# notifications, so the upstream services see one process whatever the number of workers.
+class Coordinator:
+    def __init__(self, workers=main.webhook_workers, host=main.WEBHOOK_HOST, port=main.WEBHOOK_PORT,
+                 secret=main.WEBHOOK_SECRET, queue_size=main.webhook_queue_size):
+        self.context = multiprocessing.get_context('spawn')
+        self.queues = [self.context.Queue(queue_size) for _ in range(workers)]
+        self.processes = [None] * workers
+        # Metrics reported by the workers, exported added up with those of the coordinator
+        self.reports = self.context.Queue()
+        self.metrics = AggregatedMetrics(metrics)
+        # Every worker and the coordinator's notifications get an equal share of the bot's send rate
+        self.rate = main.send_rate / (workers + 1)
+        self.path = f'/{main.TOKEN}'
+        self.server = ThreadingHTTPServer((host, port), make_handler(self.queues, self.path, secret))
+        self.secret = secret
+        self.scheduler = None
+        self.stopping = False
+
+    def _start_worker(self, index):
+        process = self.context.Process(target=worker, args=(index, self.queues[index], self.rate, self.reports, len(self.processes)), name=f'worker-{index}', daemon=True)
+        process.start()
+        self.processes[index] = process
+
+    # Take the metrics the workers reported since the last call
+    def collect_metrics(self):
+        while True:
+            try:
+                pid, state = self.reports.get_nowait()
+            except queue.Empty:
+                return
+            self.metrics.update(pid, state)
+
+    # Start again the workers that died, their queued updates are still waiting for them.
+    # The last metrics of a dead worker stay in the totals.
+    def check_workers(self):
+        self.collect_metrics()
+        for index, process in enumerate(self.processes):
+            if not self.stopping and not process.is_alive():
+                log.error('Worker %d exited with %s, restarting it', index, process.exitcode)
+                self.metrics.retire(process.pid)
+                self._start_worker(index)
+
+    def start(self):
+        setup_logging(main.LOG_LEVEL, main.LOG_JSON)
+        if main.METRICS_PORT:
+            start_metrics_server(int(main.METRICS_PORT), metrics=self.metrics)
+        if main.CALENDAR_PORT:
+            start_calendar_server(int(main.CALENDAR_PORT), main.calendar_feed_for)
+        main.outbox.set_global_rate(self.rate)
+        main.load_items()
+        main.notifier.start()
+        for index in range(len(self.processes)):
+            self._start_worker(index)
+
+        self.scheduler = main.add_background_jobs(BackgroundScheduler())
+        self.scheduler.add_job(self.check_workers, trigger='interval', seconds=5)
+        self.scheduler.add_job(self.collect_metrics, trigger='interval', seconds=main.metrics_report_seconds)
+        self.scheduler.start()
+
+        if main.WEBHOOK_URL:
+            main.bot.set_webhook(url=main.WEBHOOK_URL.rstrip('/') + self.path, secret_token=self.secret)
+        log.info('Listening for updates on port %d with %d workers', self.server.server_port, len(self.processes))
+
+    def serve(self):
+        # SIGTERM stops the server from another thread, shutdown() waits for serve_forever to return
+        signal.signal(signal.SIGTERM, lambda *args: Thread(target=self.server.shutdown).start())
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    # Graceful shutdown: stop taking updates, let the workers handle the queued ones, then stop the jobs
+    def stop(self, timeout=60):
+        log.info('Shutting down')
+        self.stopping = True
+        self.server.server_close()
+        for updates in self.queues:
+            updates.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        if self.scheduler is not None:
+            self.scheduler.shutdown(wait=False)
+        main.notifier.timers.stop()
+        main.outbox.flush(timeout=30)
+
+
+# # Run the bot behind a webhook: python webhook.py
+if __name__ == '__main__':
+    coordinator = Coordinator()
+    coordinator.start()
+    coordinator.serve()